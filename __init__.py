@@ -1,2 +1,48 @@
+import os
+
+from flask import g, has_app_context # type: ignore
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
\ No newline at end of file
+from flask_sqlalchemy.session import Session # type: ignore
+from sqlalchemy.dialects import postgresql, sqlite # type: ignore
+
+
+def engine_options():
+    """Pool settings shared by the primary and replica engines.
+
+    Pre-ping and recycling are always on. Pool sizes are only passed when
+    set, since SQLite's in-memory pools take no size arguments.
+    """
+    options = {
+        "pool_pre_ping": True,
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+    }
+    for option, env in (("pool_size", "DB_POOL_SIZE"), ("max_overflow", "DB_MAX_OVERFLOW"),
+                        ("pool_timeout", "DB_POOL_TIMEOUT")):
+        if os.environ.get(env):
+            options[option] = int(os.environ[env])
+    return options
+
+
+class RoutingSession(Session):
+    """Sends a request's reads to the replica engine picked by todo.replica.read_only.
+
+    Flushes always go to the primary, so a stray write inside a read-only
+    endpoint still lands in the right database.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get("db_read_engine")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(engine_options=engine_options(), session_options={"class_": RoutingSession})
+
+
+def dialect_insert(model):
+    """INSERT with on_conflict_do_update() for the database the session is bound to."""
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    return insert(model)
@@ -0,0 +1,276 @@
+"""Admission control for submissions: rate limits and load shedding.
+
+Two checks run before a submission is staged:
+
+- Load shedding. A pressure reading combines broker queue depth and recent
+  DB commit latency, each divided by its limit. Batch traffic is shed first,
+  with rising probability from ADMISSION_SOFT_PRESSURE and completely at
+  1.0. Urgent traffic is only shed at ADMISSION_URGENT_SHED_PRESSURE.
+- Token buckets per lab and one global bucket, charged one token per
+  sample. Batch submissions may not take the last ADMISSION_URGENT_RESERVE
+  of a bucket, so an exhausted batch client still leaves room for urgent
+  samples. A request bigger than a bucket can ever hold is refused outright.
+
+Buckets live in Redis (ADMISSION_URL, defaulting to a Redis broker URL) so
+every API process shares them. Without Redis each process keeps its own,
+and the limits apply per process. Rejections become 429 with Retry-After,
+or 413 for a request too large to ever be admitted.
+"""
+import os
+import math
+import time
+import random
+import logging
+import threading
+from collections import namedtuple
+
+from todo.metrics import Counter, stats_gauge, stage_seconds
+from todo.scheduling import JOB_CLASSES
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+ADMISSION_URL = os.environ.get("ADMISSION_URL", os.environ.get("CELERY_BROKER_URL", ""))
+# Sustained submissions per second and burst size; a rate of 0 turns a bucket off
+ADMISSION_LAB_RATE = float(os.environ.get("ADMISSION_LAB_RATE", "50"))
+# Batch traffic gets (1 - ADMISSION_URGENT_RESERVE) of a burst: 625 fits a
+# full MAX_BATCH_SIZE batch for one lab
+ADMISSION_LAB_BURST = float(os.environ.get("ADMISSION_LAB_BURST", "625"))
+ADMISSION_GLOBAL_RATE = float(os.environ.get("ADMISSION_GLOBAL_RATE", "500"))
+ADMISSION_GLOBAL_BURST = float(os.environ.get("ADMISSION_GLOBAL_BURST", "2000"))
+# Fraction of each bucket only urgent submissions may use
+ADMISSION_URGENT_RESERVE = float(os.environ.get("ADMISSION_URGENT_RESERVE", "0.2"))
+# Pressure 1.0 means queue depth or DB commit latency has reached its limit
+ADMISSION_MAX_QUEUE_DEPTH = int(os.environ.get("ADMISSION_MAX_QUEUE_DEPTH", "5000"))
+ADMISSION_MAX_DB_LATENCY = float(os.environ.get("ADMISSION_MAX_DB_LATENCY", "0.5"))
+ADMISSION_SOFT_PRESSURE = float(os.environ.get("ADMISSION_SOFT_PRESSURE", "0.7"))
+ADMISSION_URGENT_SHED_PRESSURE = float(os.environ.get("ADMISSION_URGENT_SHED_PRESSURE", "2.0"))
+# How long a pressure reading is reused
+ADMISSION_SIGNAL_INTERVAL = float(os.environ.get("ADMISSION_SIGNAL_INTERVAL", "5"))
+# Retry-After for shed requests, in seconds
+ADMISSION_SHED_RETRY_AFTER = int(os.environ.get("ADMISSION_SHED_RETRY_AFTER", "30"))
+
+Bucket = namedtuple("Bucket", "key rate burst")
+Decision = namedtuple("Decision", "admitted retry_after reason")
+ADMITTED = Decision(True, 0, None)
+
+rejections = Counter(
+    "coughoverflow_admission_rejections_total",
+    "Submissions refused by admission control, by reason and job class.",
+    labels=("reason", "job_class"),
+)
+
+# KEYS: one per bucket. ARGV: reserve fraction, then rate, burst, cost per
+# bucket. Either every bucket pays or none does; returns {admitted, wait}.
+TAKE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local reserve = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'at')
+    local tokens = tonumber(state[1]) or burst
+    local at = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - at, 0) * rate)
+    levels[i] = tokens - cost
+    if tokens - cost < burst * reserve then
+        wait = math.max(wait, (cost + burst * reserve - tokens) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+    local tokens = levels[i]
+    if wait > 0 then
+        tokens = tokens + tonumber(ARGV[i * 3 + 1])
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'at', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+return {1, '0'}
+"""
+
+
+class MemoryBuckets:
+    """Token buckets in this process; the fallback without Redis."""
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def take(self, charges, reserve=0.0):
+        """Charge every (bucket, cost) or none. Returns seconds to wait, 0 when admitted."""
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            wait = 0.0
+            for bucket, cost in charges:
+                tokens, at = self._state.get(bucket.key, (bucket.burst, now))
+                tokens = min(bucket.burst, tokens + (now - at) * bucket.rate)
+                levels.append((tokens, cost))
+                if tokens - cost < bucket.burst * reserve:
+                    wait = max(wait, (cost + bucket.burst * reserve - tokens) / bucket.rate)
+            for (bucket, _), (tokens, cost) in zip(charges, levels):
+                self._state[bucket.key] = (tokens if wait else tokens - cost, now)
+            return wait
+
+
+class RedisBuckets:
+    """Token buckets shared by every API process, updated atomically by a script."""
+
+    def __init__(self, url):
+        import redis  # type: ignore
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, charges, reserve=0.0):
+        keys = [f"admission:{bucket.key}" for bucket, _ in charges]
+        args = [reserve]
+        for bucket, cost in charges:
+            args += [bucket.rate, bucket.burst, cost]
+        admitted, wait = self._take(keys=keys, args=args)
+        return 0.0 if int(admitted) else float(wait)
+
+
+class LoadSignal:
+    """Cached pressure reading from queue depth and recent DB commit latency.
+
+    Depth is read from the broker at most every `interval` seconds. Latency
+    is the mean db_insert stage time since the previous reading. Failures
+    keep the last reading, so a broker hiccup does not start shedding.
+    """
+
+    def __init__(self, depth=None, interval=ADMISSION_SIGNAL_INTERVAL):
+        self.depth = depth
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._db_totals = (0.0, 0)
+        self.queue_depth = 0
+        self.db_latency = 0.0
+        self.pressure = 0.0
+
+    def read(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.interval:
+            return self.pressure
+        with self._lock:
+            if now - self._checked_at < self.interval:
+                return self.pressure
+            self._checked_at = now
+            if self.depth is not None:
+                try:
+                    self.queue_depth = sum(self.depth(cls.queue) for cls in JOB_CLASSES.values())
+                except Exception as e:
+                    logger.warning(f"Could not read queue depth for admission control: {e}")
+            series = stage_seconds.snapshot().get(("db_insert",))
+            if series is not None:
+                total, count = series["sum"], series["count"]
+                last_total, last_count = self._db_totals
+                if count > last_count:
+                    self.db_latency = (total - last_total) / (count - last_count)
+                self._db_totals = (total, count)
+            self.pressure = max(self.queue_depth / ADMISSION_MAX_QUEUE_DEPTH,
+                                self.db_latency / ADMISSION_MAX_DB_LATENCY)
+            return self.pressure
+
+
+class AdmissionController:
+    """Decides whether a submission is accepted now."""
+
+    def __init__(self, buckets, signal, enabled=ADMISSION_ENABLED):
+        self.buckets = buckets
+        self.signal = signal
+        self.enabled = enabled
+        self.admitted = 0
+        self.shed = 0
+        self.limited = 0
+
+    def admit(self, lab_counts, urgent):
+        """lab_counts is {lab_id: submissions}; returns a Decision."""
+        if not self.enabled:
+            return ADMITTED
+        job_class = "urgent" if urgent else "batch"
+
+        pressure = self.signal.read()
+        if urgent:
+            overloaded = pressure >= ADMISSION_URGENT_SHED_PRESSURE
+        elif pressure >= 1.0:
+            overloaded = True
+        elif pressure > ADMISSION_SOFT_PRESSURE:
+            # Shed a growing share of batch traffic as pressure nears the limit
+            overloaded = random.random() < (pressure - ADMISSION_SOFT_PRESSURE) / (1.0 - ADMISSION_SOFT_PRESSURE)
+        else:
+            overloaded = False
+        if overloaded:
+            self.shed += 1
+            rejections.inc("overloaded", job_class)
+            return Decision(False, ADMISSION_SHED_RETRY_AFTER, "overloaded")
+
+        reserve = 0.0 if urgent else ADMISSION_URGENT_RESERVE
+        charges = []
+        if ADMISSION_LAB_RATE > 0:
+            charges += [(Bucket(f"lab:{lab_id}", ADMISSION_LAB_RATE, ADMISSION_LAB_BURST), count)
+                        for lab_id, count in sorted(lab_counts.items())]
+        if ADMISSION_GLOBAL_RATE > 0:
+            charges.append((Bucket("global", ADMISSION_GLOBAL_RATE, ADMISSION_GLOBAL_BURST),
+                            sum(lab_counts.values())))
+        if any(cost > bucket.burst * (1 - reserve) for bucket, cost in charges):
+            # Waiting would never help; the client has to split the request
+            self.limited += 1
+            rejections.inc("too_large", job_class)
+            return Decision(False, None, "too_large")
+        if charges:
+            try:
+                wait = self.buckets.take(charges, reserve)
+            except Exception as e:
+                # A limiter outage must not take submissions down with it
+                logger.warning(f"Rate limiter unavailable, admitting: {e}")
+                wait = 0.0
+            if wait > 0:
+                self.limited += 1
+                rejections.inc("rate_limited", job_class)
+                return Decision(False, max(1, math.ceil(wait)), "rate_limited")
+        self.admitted += 1
+        return ADMITTED
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "rate_limited": self.limited,
+            "pressure": round(self.signal.pressure, 4),
+            "queue_depth": self.signal.queue_depth,
+            "db_latency_seconds": round(self.signal.db_latency, 6),
+        }
+
+
+def _queue_depth(queue):
+    # Imported on first use; the Celery app is configured after this module loads
+    from todo.tasks.ical import celery
+    from todo.backlog import broker_depth
+    return broker_depth(celery.connection_for_read)(queue)
+
+
+def build_controller():
+    """Build the process-wide controller from ADMISSION_* settings."""
+    buckets = MemoryBuckets()
+    if ADMISSION_URL.startswith("redis"):
+        try:
+            buckets = RedisBuckets(ADMISSION_URL)
+        except Exception as e:
+            logger.warning(f"Admission control Redis unavailable, limits are per process: {e}")
+    return AdmissionController(buckets, LoadSignal(_queue_depth if ADMISSION_ENABLED else None))
+
+
+admission = build_controller()
+stats_gauge("coughoverflow_admission", "Admission control decisions and the load pressure behind them.",
+            admission.stats)
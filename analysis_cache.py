@@ -0,0 +1,188 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+from todo.metrics import stats_gauge
+
+logger = logging.getLogger(__name__)
+
+# Only verdicts are cached; "pending"/"failed" mean the engine gave no answer.
+CACHEABLE_RESULTS = {"covid", "h5n1", "healthy"}
+
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", "4096"))
+ANALYSIS_CACHE_BACKEND = os.environ.get("ANALYSIS_CACHE_BACKEND", "memory")
+ANALYSIS_CACHE_DIR = os.environ.get("ANALYSIS_CACHE_DIR", "/tmp/analysis-cache")
+ANALYSIS_CACHE_MAX_FILES = int(os.environ.get("ANALYSIS_CACHE_MAX_FILES", "100000"))
+ANALYSIS_CACHE_URL = os.environ.get("ANALYSIS_CACHE_URL", os.environ.get("CELERY_BROKER_URL", ""))
+ANALYSIS_CACHE_TTL = int(os.environ.get("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def image_digest(image_data):
+    """Content address of a decoded image."""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU bounded by entry count."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskTier:
+    """One small file per digest; oldest files are evicted past max_files."""
+
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r') as entry:
+                return entry.read() or None
+        except OSError:
+            return None
+
+    def set(self, key, value):
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as entry:
+            entry.write(value)
+        os.replace(tmp_path, self._path(key))
+        self._writes += 1
+        # Listing the directory is not free, so only check every so often.
+        if self._writes % 256 == 0:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                entries.append((entry.stat().st_mtime, entry.path))
+        excess = len(entries) - self.max_files
+        if excess <= 0:
+            return 0
+        entries.sort()
+        for _, path in entries[:excess]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return excess
+
+
+class RedisTier:
+    """Shared across workers; Redis expires entries after the TTL."""
+
+    def __init__(self, url, ttl):
+        import redis  # type: ignore
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(f"analysis:{key}")
+        return value.decode() if value else None
+
+    def set(self, key, value):
+        self.client.set(f"analysis:{key}", value, ex=self.ttl)
+
+
+class AnalysisCache:
+    """Maps image digests to engine verdicts.
+
+    A bounded LRU sits in front of an optional shared tier (disk or Redis).
+    Tier errors are logged and treated as misses so a cache outage only costs
+    an engine run.
+    """
+
+    def __init__(self, max_entries=ANALYSIS_CACHE_SIZE, tier=None):
+        self.memory = LRUCache(max_entries)
+        self.tier = tier
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, key, nbytes=0):
+        status = self.memory.get(key)
+        if status is None and self.tier is not None:
+            try:
+                status = self.tier.get(key)
+            except Exception as e:
+                logger.warning(f"Analysis cache tier lookup failed: {e}")
+                status = None
+            if status is not None:
+                self.memory.set(key, status)
+
+        if status is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_saved += nbytes
+        return status
+
+    def put(self, key, status):
+        if status not in CACHEABLE_RESULTS:
+            return
+        self.memory.set(key, status)
+        if self.tier is not None:
+            try:
+                self.tier.set(key, status)
+            except Exception as e:
+                logger.warning(f"Analysis cache tier write failed: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "memory_entries": len(self.memory),
+            "tier": type(self.tier).__name__ if self.tier is not None else None,
+        }
+
+
+def build_cache():
+    """Build the process-wide cache from ANALYSIS_CACHE_* settings."""
+    tier = None
+    try:
+        if ANALYSIS_CACHE_BACKEND == "disk":
+            tier = DiskTier(ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_MAX_FILES)
+        elif ANALYSIS_CACHE_BACKEND == "redis" and ANALYSIS_CACHE_URL.startswith("redis"):
+            tier = RedisTier(ANALYSIS_CACHE_URL, ANALYSIS_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"Analysis cache tier '{ANALYSIS_CACHE_BACKEND}' unavailable, memory only: {e}")
+    return AnalysisCache(ANALYSIS_CACHE_SIZE, tier)
+
+
+analysis_cache = build_cache()
+stats_gauge("coughoverflow_analysis_cache", "Analysis result cache hits, misses and bytes saved.", analysis_cache.stats)
@@ -0,0 +1,264 @@
+"""Archive of finished jobs that have aged out of the Todo table.
+
+Finished jobs created before the retention cutoff are written to compact
+files under ARCHIVE_DIR (a local stand-in for an S3 prefix) and deleted from
+Todo, so the live table, and on Postgres its partitions, only hold recent
+months. Files are Parquet when pyarrow is installed and gzipped CSV
+otherwise:
+
+    ARCHIVE_DIR/manifest.json            {"horizon": "<cutoff>"}
+    ARCHIVE_DIR/2024-01/<run>-0001.parquet
+
+Listing endpoints merge archived rows back in when a query's `start`, or
+with no start its `end`, is before the horizon (or `archived=true` is
+passed), so historical ranges read the same as before.
+"""
+import os
+import csv
+import gzip
+import json
+import heapq
+import logging
+import datetime
+import threading
+from datetime import timezone
+
+from sqlalchemy import func, tuple_ # type: ignore
+from todo.models import db
+from todo.models.todo import Todo
+from todo.models.partitions import month_start, next_month, months_between, ensure_partitions, drop_empty_partitions
+from todo.job_cache import JOB_FIELDS, CachedJob, cached_job
+
+try:
+    import pyarrow  # type: ignore
+    import pyarrow.parquet as parquet  # type: ignore
+except ImportError:
+    pyarrow = parquet = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "/tmp/archive")
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", "90"))
+ARCHIVE_FORMAT = os.environ.get("ARCHIVE_FORMAT", "parquet" if parquet is not None else "csv")
+# Rows per archive file, and per delete transaction
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "50000"))
+# Rows per DELETE statement; two bound parameters each, well under SQLite's limit
+ARCHIVE_DELETE_CHUNK = 2000
+
+ARCHIVE_COLUMNS = tuple(getattr(Todo, field) for field in JOB_FIELDS)
+EXTENSIONS = {"parquet": ".parquet", "csv": ".csv.gz"}
+
+
+def _naive(timestamp):
+    if timestamp is not None and timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _sort_key(row):
+    return (row.created_at, row.request_id)
+
+
+def merge_rows(live, archived):
+    """Merge two (created_at, request_id)-ordered row streams.
+
+    A job can be in both for a while (archived, then changed before its
+    delete ran); the live row wins.
+    """
+    previous = None
+    for row in heapq.merge(live, archived, key=_sort_key):
+        if previous is not None and row.request_id == previous:
+            continue
+        previous = row.request_id
+        yield row
+
+
+def _parquet_schema():
+    return pyarrow.schema([
+        ("request_id", pyarrow.string()), ("lab_id", pyarrow.string()),
+        ("patient_id", pyarrow.string()), ("result", pyarrow.string()),
+        ("urgent", pyarrow.bool_()), ("created_at", pyarrow.timestamp("us")),
+        ("updated_at", pyarrow.timestamp("us")),
+    ])
+
+
+class ArchiveStore:
+    """Month directories of immutable archive files plus a horizon marker."""
+
+    def __init__(self, root=ARCHIVE_DIR, fmt=ARCHIVE_FORMAT):
+        self.root = root
+        self.format = fmt
+        self._horizon = None
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, "manifest.json")
+
+    def horizon(self):
+        """Jobs created before this may be archived; None if nothing ever was."""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime
+        except OSError:
+            return None
+        if mtime != self._manifest_mtime:
+            with self._lock:
+                with open(self.manifest_path) as manifest:
+                    horizon = json.load(manifest).get("horizon")
+                self._horizon = datetime.datetime.fromisoformat(horizon) if horizon else None
+                self._manifest_mtime = mtime
+        return self._horizon
+
+    def advance_horizon(self, cutoff):
+        current = self.horizon()
+        if current is not None and current >= cutoff:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as manifest:
+            json.dump({"horizon": cutoff.isoformat()}, manifest)
+        os.replace(tmp_path, self.manifest_path)
+
+    def reaches(self, start, end=None, requested=False):
+        """Whether a listing over [start, end] has to read the archive.
+
+        A range that starts, or with no start ends, before the horizon
+        does. An open-ended listing only does when asked to.
+        """
+        horizon = self.horizon()
+        if horizon is None:
+            return False
+        if start:
+            return _naive(start) < horizon
+        if end and _naive(end) < horizon:
+            return True
+        return requested
+
+    def write(self, month, name, rows):
+        """Write rows (CachedJob, sorted) as one file in month's directory."""
+        directory = os.path.join(self.root, f"{month:%Y-%m}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name + EXTENSIONS[self.format])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if self.format == "parquet":
+            table = pyarrow.Table.from_pylist([row._asdict() for row in rows], schema=_parquet_schema())
+            parquet.write_table(table, tmp_path, compression="zstd")
+        else:
+            with gzip.open(tmp_path, "wt", newline="") as output:
+                writer = csv.writer(output)
+                writer.writerow(JOB_FIELDS)
+                for row in rows:
+                    writer.writerow((row.request_id, row.lab_id, row.patient_id, row.result, int(row.urgent),
+                                     row.created_at.isoformat(), row.updated_at.isoformat()))
+        os.replace(tmp_path, path)
+        return path
+
+    def _read(self, path, filters):
+        if path.endswith(".parquet"):
+            pushdown = [(field, "=", value) for field, value in filters.items()]
+            table = parquet.read_table(path, filters=pushdown or None)
+            for values in table.to_pylist():
+                yield CachedJob(**values)
+            return
+        with gzip.open(path, "rt", newline="") as source:
+            reader = csv.reader(source)
+            next(reader, None)
+            for request_id, lab_id, patient_id, result, urgent, created_at, updated_at in reader:
+                yield CachedJob(request_id, lab_id, patient_id, result, urgent == "1",
+                                datetime.datetime.fromisoformat(created_at),
+                                datetime.datetime.fromisoformat(updated_at))
+
+    def scan(self, start=None, end=None, after=None, **filters):
+        """Archived jobs in [start, end] matching filters, in (created_at, request_id) order.
+
+        filters are equality matches on job fields, e.g. lab_id=..., urgent=True;
+        after is a (created_at, request_id) keyset position.
+        """
+        start, end = _naive(start), _naive(end)
+        filters = {field: value for field, value in filters.items() if value is not None}
+        try:
+            months = sorted(entry.name for entry in os.scandir(self.root) if entry.is_dir())
+        except OSError:
+            return
+        for name in months:
+            month = datetime.datetime.strptime(name, "%Y-%m")
+            if (start is not None and next_month(month) <= start) or (end is not None and month > end):
+                continue
+            directory = os.path.join(self.root, name)
+            paths = sorted(os.path.join(directory, entry) for entry in os.listdir(directory)
+                           if not entry.endswith(".tmp"))
+            for row in heapq.merge(*(self._read(path, filters) for path in paths), key=_sort_key):
+                if start is not None and row.created_at < start:
+                    continue
+                if end is not None and row.created_at > end:
+                    break
+                if after is not None and _sort_key(row) <= after:
+                    continue
+                if any(getattr(row, field) != value for field, value in filters.items()):
+                    continue
+                yield row
+
+    def count(self, **kwargs):
+        return sum(1 for _ in self.scan(**kwargs))
+
+
+archive_store = ArchiveStore()
+
+
+def archive_results(store=archive_store, retention_days=ARCHIVE_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move finished jobs created before the retention cutoff into the archive.
+
+    The cutoff is rounded down to a month start so whole partitions empty
+    out. Each batch is written to its own file and then deleted from Todo
+    in one transaction; rows changed after they were read (a reassignment)
+    stay live and shadow their archived copy. Pending jobs are never
+    archived. Returns a summary dict.
+    """
+    started = datetime.datetime.utcnow()
+    cutoff = month_start(started - datetime.timedelta(days=retention_days))
+    run = started.strftime("%Y%m%dT%H%M%S")
+    # Advanced first, so readers look in the archive as soon as rows leave Todo
+    store.advance_horizon(cutoff)
+
+    archived = 0
+    files = []
+    oldest = (db.session.query(func.min(Todo.created_at))
+              .filter(Todo.created_at < cutoff, Todo.result != 'pending')
+              .scalar())
+    if oldest is not None:
+        for month in months_between(oldest, cutoff - datetime.timedelta(microseconds=1)):
+            position = None
+            part = 0
+            while True:
+                query = (db.session.query(*ARCHIVE_COLUMNS)
+                         .filter(Todo.created_at >= month, Todo.created_at < next_month(month),
+                                 Todo.result != 'pending'))
+                if position is not None:
+                    query = query.filter(tuple_(Todo.created_at, Todo.request_id) > tuple_(*position))
+                rows = [cached_job(row) for row in
+                        query.order_by(Todo.created_at.asc(), Todo.request_id.asc()).limit(batch_size)]
+                if not rows:
+                    break
+                part += 1
+                files.append(store.write(month, f"{run}-{part:04d}", rows))
+                # Matching updated_at too keeps rows changed since the read;
+                # the chunks share one transaction
+                for index in range(0, len(rows), ARCHIVE_DELETE_CHUNK):
+                    chunk = rows[index:index + ARCHIVE_DELETE_CHUNK]
+                    (db.session.query(Todo)
+                     .filter(Todo.created_at >= month, Todo.created_at < next_month(month),
+                             tuple_(Todo.request_id, Todo.updated_at).in_(
+                                 [(row.request_id, row.updated_at) for row in chunk]))
+                     .delete(synchronize_session=False))
+                db.session.commit()
+                archived += len(rows)
+                position = _sort_key(rows[-1])
+                logger.info(f"Archived {len(rows)} jobs from {month:%Y-%m}")
+
+    connection = db.session.connection()
+    dropped = drop_empty_partitions(connection, cutoff)
+    created = ensure_partitions(connection)
+    db.session.commit()
+    return {"cutoff": cutoff.isoformat(), "archived": archived, "files": files,
+            "dropped_partitions": dropped, "partitions": created}
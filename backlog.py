@@ -0,0 +1,376 @@
+"""Queue backlog monitor and the autoscaling signal derived from it.
+
+For each job class (see todo.scheduling) the monitor samples the broker
+queue depth and the submission count, and over a sliding window works out:
+
+    arrival_rate    jobs/s submitted (from the LabRollup hourly totals)
+    service_rate    jobs/s leaving the queue (arrivals minus depth growth)
+    drain_seconds   time to empty the queue at the current net rate
+    desired_workers workers needed to absorb arrivals and clear the
+                    backlog within BACKLOG_DRAIN_FRACTION of the deadline
+
+Readings are exported as coughoverflow_backlog{job_class,stat} and, when
+BACKLOG_CLOUDWATCH_NAMESPACE is set, as CloudWatch metrics with a JobClass
+dimension that the worker services' target-tracking policies follow (see
+backlog.tf). Run it with `flask api backlog-monitor`.
+
+The simulator drives the same monitor against a kombu broker, in-memory
+by default or Redis, with simulated arrivals, workers and scaling:
+
+    python -m todo.backlog simulate [--broker redis://localhost:6379/15]
+                                    [--duration 7200] [--surge 10]
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import datetime
+from collections import deque
+
+from todo.metrics import Gauge
+from todo.scheduling import JOB_CLASSES
+
+try:
+    import boto3  # type: ignore
+except ImportError:
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+BACKLOG_SAMPLE_INTERVAL = float(os.environ.get("BACKLOG_SAMPLE_INTERVAL", "15"))
+# Rates are measured across this many seconds of samples
+BACKLOG_WINDOW = float(os.environ.get("BACKLOG_WINDOW", "300"))
+# Engine seconds per job, until the monitor has measured it under load
+BACKLOG_SERVICE_SECONDS = float(os.environ.get("BACKLOG_SERVICE_SECONDS", "30"))
+# Size the fleet to clear the backlog within this fraction of the class deadline
+BACKLOG_DRAIN_FRACTION = float(os.environ.get("BACKLOG_DRAIN_FRACTION", "0.5"))
+BACKLOG_MIN_WORKERS = int(os.environ.get("BACKLOG_MIN_WORKERS", "1"))
+BACKLOG_MAX_WORKERS = int(os.environ.get("BACKLOG_MAX_WORKERS", "20"))
+BACKLOG_CLOUDWATCH_NAMESPACE = os.environ.get("BACKLOG_CLOUDWATCH_NAMESPACE", "")
+BACKLOG_METRICS_PORT = int(os.environ.get("BACKLOG_METRICS_PORT", "0"))
+# CloudWatch takes no infinities; an undrainable queue reports this instead
+MAX_DRAIN_SECONDS = 7 * 24 * 3600
+
+# Pool size per worker, as start-celery.sh sets it. Shared workers are
+# counted against the batch class, urgent-only workers against urgent.
+WORKER_CONCURRENCY = {
+    "urgent": int(os.environ.get("URGENT_CONCURRENCY", "2")),
+    "batch": int(os.environ.get("SHARED_CONCURRENCY", "4")),
+}
+
+
+def desired_workers(depth, arrival_rate, service_seconds, concurrency, drain_within,
+                    minimum=BACKLOG_MIN_WORKERS, maximum=BACKLOG_MAX_WORKERS):
+    """Workers to keep up with arrivals and clear `depth` jobs within `drain_within` seconds."""
+    demand = arrival_rate + depth / max(drain_within, 1.0)
+    workers = math.ceil(demand * service_seconds / concurrency)
+    return max(minimum, min(maximum, workers))
+
+
+def drain_seconds(depth, depth_rate):
+    """Seconds until the queue is empty at the current rate of change."""
+    if depth <= 0:
+        return 0.0
+    if depth_rate >= 0:
+        return float("inf")
+    return depth / -depth_rate
+
+
+class BacklogMonitor:
+    """Sliding-window backlog readings per job class.
+
+    depth(queue) returns messages waiting in a broker queue; arrivals()
+    returns cumulative submissions per class; workers(), if given, returns
+    the running workers per class or None when that cannot be known. While
+    every worker is busy (the queue stayed non-empty across the window) the
+    observed service rate gives the real engine time per job, which
+    replaces BACKLOG_SERVICE_SECONDS.
+    """
+
+    def __init__(self, depth, arrivals, workers=None, classes=JOB_CLASSES,
+                 window=BACKLOG_WINDOW, clock=time.monotonic):
+        self.depth = depth
+        self.arrivals = arrivals
+        self.workers = workers
+        self.classes = classes
+        self.window = window
+        self.clock = clock
+        self._samples = {name: deque() for name in classes}
+        self._service_seconds = {name: BACKLOG_SERVICE_SECONDS for name in classes}
+        self.readings = {}
+
+    def sample(self):
+        now = self.clock()
+        arrived = self.arrivals()
+        workers = self.workers() if self.workers is not None else None
+        for name, cls in self.classes.items():
+            samples = self._samples[name]
+            samples.append((now, self.depth(cls.queue), arrived.get(name, 0)))
+            while len(samples) > 2 and now - samples[1][0] >= self.window:
+                samples.popleft()
+            self.readings[name] = self._reading(name, samples, workers.get(name) if workers else None)
+        return self.readings
+
+    def _reading(self, name, samples, running):
+        (first_at, first_depth, first_arrived), (now, depth, arrived) = samples[0], samples[-1]
+        elapsed = now - first_at
+        arrival_rate = (arrived - first_arrived) / elapsed if elapsed > 0 else 0.0
+        depth_rate = (depth - first_depth) / elapsed if elapsed > 0 else 0.0
+        service_rate = max(arrival_rate - depth_rate, 0.0)
+        concurrency = WORKER_CONCURRENCY.get(name, 1)
+        saturated = all(sample_depth > 0 for _, sample_depth, _ in samples)
+        if running and saturated and service_rate > 0 and len(samples) > 1:
+            observed = running * concurrency / service_rate
+            self._service_seconds[name] = 0.7 * self._service_seconds[name] + 0.3 * observed
+        service_seconds = self._service_seconds[name]
+        drain_within = self.classes[name].deadline * BACKLOG_DRAIN_FRACTION
+        return {
+            "depth": depth,
+            "arrival_rate": round(arrival_rate, 4),
+            "service_rate": round(service_rate, 4),
+            "service_seconds": round(service_seconds, 3),
+            "drain_seconds": min(drain_seconds(depth, depth_rate), MAX_DRAIN_SECONDS),
+            "workers": running if running is not None else -1,
+            "desired_workers": desired_workers(depth, arrival_rate, service_seconds, concurrency, drain_within),
+        }
+
+    def collect(self):
+        return {(name, stat): value for name, reading in self.readings.items()
+                for stat, value in reading.items()}
+
+
+def broker_depth(connection_factory):
+    """depth() for BacklogMonitor reading a kombu broker (Redis, SQS, memory)."""
+    def depth(queue):
+        with connection_factory() as connection:
+            return connection.default_channel.queue_declare(queue=queue, passive=True).message_count
+    return depth
+
+
+def broker_workers(celery_app, timeout=1.0):
+    """workers() for BacklogMonitor from worker broadcast replies.
+
+    Brokers without remote control (SQS) return None, which leaves the
+    monitor on BACKLOG_SERVICE_SECONDS.
+    """
+    def workers():
+        try:
+            replies = celery_app.control.inspect(timeout=timeout).active_queues() or {}
+        except Exception as e:
+            logger.debug(f"Worker inspection unavailable: {e}")
+            return None
+        counts = dict.fromkeys(JOB_CLASSES, 0)
+        for queues in replies.values():
+            names = {queue["name"] for queue in queues}
+            counts["batch" if JOB_CLASSES["batch"].queue in names else "urgent"] += 1
+        return counts
+    return workers
+
+
+class RollupArrivals:
+    """arrivals() for BacklogMonitor: cumulative submissions per class from LabRollup.
+
+    Every bucket's status columns add up to the jobs created in that hour,
+    however their verdicts move, so the sum from a fixed hour on only grows.
+    The base hour moves forward as time passes, carrying the count so far.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._base = None
+        self._carried = dict.fromkeys(JOB_CLASSES, 0)
+
+    def __call__(self):
+        from todo.models import rollup
+        with self.app.app_context():
+            base = rollup.bucket_for(datetime.datetime.utcnow())
+            if self._base is None:
+                self._base = base
+            total, urgent = rollup.submissions_since(self._base)
+            if base != self._base:
+                newer_total, newer_urgent = rollup.submissions_since(base)
+                self._carried["urgent"] += urgent - newer_urgent
+                self._carried["batch"] += (total - urgent) - (newer_total - newer_urgent)
+                self._base, total, urgent = base, newer_total, newer_urgent
+        return {"urgent": self._carried["urgent"] + urgent, "batch": self._carried["batch"] + total - urgent}
+
+
+def publish_cloudwatch(readings, namespace=BACKLOG_CLOUDWATCH_NAMESPACE, client=None):
+    client = client or boto3.client("cloudwatch")
+    data = []
+    for name, reading in readings.items():
+        dimensions = [{"Name": "JobClass", "Value": name}]
+        for metric, stat, unit in (("QueueDepth", "depth", "Count"),
+                                   ("ArrivalRate", "arrival_rate", "Count/Second"),
+                                   ("DrainSeconds", "drain_seconds", "Seconds"),
+                                   ("DesiredWorkers", "desired_workers", "Count")):
+            data.append({"MetricName": metric, "Dimensions": dimensions, "Value": float(reading[stat]), "Unit": unit})
+    client.put_metric_data(Namespace=namespace, MetricData=data)
+
+
+def monitor_forever(app, interval=BACKLOG_SAMPLE_INTERVAL):
+    """Sample and publish until interrupted; the `flask api backlog-monitor` loop."""
+    from todo.tasks.ical import celery
+    from todo import metrics
+
+    monitor = BacklogMonitor(broker_depth(celery.connection_for_read), RollupArrivals(app),
+                             broker_workers(celery))
+    Gauge("coughoverflow_backlog", "Queue backlog readings and desired workers, by job class.",
+          labels=("job_class", "stat"), collect=monitor.collect)
+    if BACKLOG_METRICS_PORT:
+        metrics.serve(BACKLOG_METRICS_PORT)
+    client = boto3.client("cloudwatch") if BACKLOG_CLOUDWATCH_NAMESPACE and boto3 is not None else None
+    while True:
+        started = time.monotonic()
+        try:
+            readings = monitor.sample()
+            logger.info(f"Backlog: {json.dumps(readings)}")
+            if client is not None:
+                publish_cloudwatch(readings, client=client)
+        except Exception as e:
+            logger.error(f"Backlog sample failed: {e}")
+        time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def simulate(broker="memory://", duration=7200.0, surge=10.0, surge_start=1800.0, surge_end=3600.0,
+             urgent_rate=0.02, batch_rate=0.05, service_mean=30.0, policy="backlog",
+             scale_interval=60.0, startup_delay=60.0, sample_interval=BACKLOG_SAMPLE_INTERVAL, seed=6400):
+    """Run a surge through a simulated worker fleet fed from a real kombu broker.
+
+    Arrivals are Poisson at the base rates, times `surge` between
+    surge_start and surge_end. With policy="backlog" each class's fleet
+    follows desired_workers every scale_interval, new workers starting
+    after startup_delay (Fargate task start); policy="fixed" keeps one
+    worker per class, as main.tf did. Returns queue waits, peak depth and
+    worker-seconds per class, plus the sampled timeline.
+    """
+    from kombu import Connection  # type: ignore
+
+    rng = random.Random(seed)
+    clock = [0.0]
+    arrived = dict.fromkeys(JOB_CLASSES, 0)
+    rates = {"urgent": urgent_rate, "batch": batch_rate}
+    fleets = {name: {"active": [0.0] * WORKER_CONCURRENCY[name], "starting": [], "target": 1}
+              for name in JOB_CLASSES}
+    waits = {name: [] for name in JOB_CLASSES}
+    peak = dict.fromkeys(JOB_CLASSES, 0)
+    worker_seconds = dict.fromkeys(JOB_CLASSES, 0.0)
+    timeline = []
+
+    with Connection(broker) as connection:
+        queues = {name: connection.SimpleQueue(cls.queue) for name, cls in JOB_CLASSES.items()}
+        for queue in queues.values():
+            queue.clear()
+        monitor = BacklogMonitor(
+            broker_depth(lambda: Connection(broker)),
+            lambda: dict(arrived),
+            lambda: {name: len(fleet["active"]) // WORKER_CONCURRENCY[name] for name, fleet in fleets.items()},
+            clock=lambda: clock[0])
+
+        while clock[0] < duration:
+            now = clock[0]
+            multiplier = surge if surge_start <= now < surge_end else 1.0
+            for name, queue in queues.items():
+                fleet = fleets[name]
+                # Poisson arrivals in this one-second step
+                count, threshold, product = 0, math.exp(-rates[name] * multiplier), rng.random()
+                while product > threshold:
+                    count += 1
+                    product *= rng.random()
+                for _ in range(count):
+                    queue.put({"arrival": now, "service": rng.expovariate(1.0 / service_mean)})
+                arrived[name] += count
+
+                while fleet["starting"] and fleet["starting"][0] <= now:
+                    fleet["starting"].pop(0)
+                    fleet["active"].extend([now] * WORKER_CONCURRENCY[name])
+                for slot, free_at in enumerate(fleet["active"]):
+                    if free_at > now:
+                        continue
+                    try:
+                        message = queue.get(block=False)
+                    except queue.Empty:
+                        break
+                    job = message.payload
+                    message.ack()
+                    waits[name].append(now - job["arrival"])
+                    fleet["active"][slot] = now + job["service"]
+                worker_seconds[name] += len(fleet["active"]) / WORKER_CONCURRENCY[name]
+                peak[name] = max(peak[name], len(queue))
+
+            if now % sample_interval == 0:
+                readings = monitor.sample()
+                timeline.append({"t": now, **{name: dict(reading, running=len(fleets[name]["active"])
+                                                          // WORKER_CONCURRENCY[name])
+                                              for name, reading in readings.items()}})
+            if policy == "backlog" and now % scale_interval == 0 and monitor.readings:
+                for name, fleet in fleets.items():
+                    _scale(fleet, monitor.readings[name]["desired_workers"], WORKER_CONCURRENCY[name],
+                           now, startup_delay)
+            clock[0] += 1.0
+
+        for queue in queues.values():
+            queue.clear()
+            queue.close()
+
+    result = {"policy": policy, "broker": broker.split("://")[0], "duration": duration, "surge": surge}
+    for name, cls in JOB_CLASSES.items():
+        ordered = sorted(waits[name])
+        result[name] = {
+            "started": len(ordered),
+            "p50_wait": ordered[len(ordered) // 2] if ordered else None,
+            "p99_wait": ordered[min(int(0.99 * len(ordered)), len(ordered) - 1)] if ordered else None,
+            "deadline_misses": sum(1 for wait in ordered if wait > cls.deadline),
+            "peak_depth": peak[name],
+            "worker_hours": round(worker_seconds[name] / 3600, 2),
+        }
+    result["timeline"] = timeline
+    return result
+
+
+def _scale(fleet, desired, concurrency, now, startup_delay):
+    running = len(fleet["active"]) // concurrency + len(fleet["starting"])
+    if desired > running:
+        fleet["starting"].extend([now + startup_delay] * (desired - running))
+        fleet["starting"].sort()
+    elif desired < running:
+        # Scale in idle workers only, as ECS would after draining
+        for _ in range(running - desired):
+            if fleet["starting"]:
+                fleet["starting"].pop()
+                continue
+            idle = [i for i in range(0, len(fleet["active"]), concurrency)
+                    if all(free_at <= now for free_at in fleet["active"][i:i + concurrency])]
+            if not idle or len(fleet["active"]) <= concurrency:
+                break
+            del fleet["active"][idle[-1]:idle[-1] + concurrency]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m todo.backlog")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("simulate", help="compare a fixed fleet with backlog-driven scaling")
+    run.add_argument("--broker", default="memory://")
+    run.add_argument("--duration", type=float, default=7200.0)
+    run.add_argument("--surge", type=float, default=10.0)
+    run.add_argument("--service-mean", type=float, default=30.0)
+    run.add_argument("--timeline", action="store_true", help="include the sampled timeline")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for policy in ("fixed", "backlog"):
+        result = simulate(args.broker, duration=args.duration, surge=args.surge,
+                          service_mean=args.service_mean, policy=policy)
+        if not args.timeline:
+            result.pop("timeline")
+        runs.append(result)
+    json.dump(runs, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
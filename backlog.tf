@@ -0,0 +1,164 @@
+# Backlog-driven scaling for the Celery worker services.
+#
+# The backlog monitor (`flask api backlog-monitor`, todo/backlog.py) publishes
+# CoughOverflow/DesiredWorkers per JobClass. Each worker service tracks
+# DesiredWorkers / RunningTaskCount at 1, i.e. it scales to whatever the
+# monitor asks for. Shared workers (celery-worker) follow the batch class;
+# urgent-only workers follow the urgent class.
+
+locals {
+  backlog_namespace = "CoughOverflow"
+  worker_services = {
+    batch  = aws_ecs_service.celery_worker.name
+    urgent = aws_ecs_service.celery_urgent_worker.name
+  }
+}
+
+resource "aws_ecs_task_definition" "backlog_monitor" {
+  family                   = "backlog-monitor"
+  network_mode             = "awsvpc"
+  requires_compatibilities = ["FARGATE"]
+  cpu                      = 256
+  memory                   = 512
+  execution_role_arn       = data.aws_iam_role.lab.arn
+  # Needs cloudwatch:PutMetricData
+  task_role_arn            = data.aws_iam_role.lab.arn
+  container_definitions = <<DEFINITION
+[
+  {
+    "image": "${local.image}",
+    "cpu": 256,
+    "memory": 512,
+    "name": "backlog-monitor",
+    "networkMode": "awsvpc",
+    "command": ["poetry", "run", "flask", "api", "backlog-monitor"],
+    "environment": [
+      {
+        "name": "FLASK_APP",
+        "value": "todo"
+      },
+      {
+        "name": "SQLALCHEMY_DATABASE_URI",
+        "value": "postgresql://${local.database_username}:${local.database_password}@${aws_db_instance.CoughOverflow_database.address}:${aws_db_instance.CoughOverflow_database.port}/${aws_db_instance.CoughOverflow_database.db_name}"
+      },
+      {
+        "name": "CELERY_BROKER_URL",
+        "value": "sqs://"
+      },
+      {
+        "name": "AWS_REGION",
+        "value": "us-east-1"
+      },
+      {
+        "name": "OUTBOX_RELAY_IN_PROCESS",
+        "value": "false"
+      },
+      {
+        "name": "BACKLOG_CLOUDWATCH_NAMESPACE",
+        "value": "${local.backlog_namespace}"
+      },
+      {
+        "name": "BACKLOG_MAX_WORKERS",
+        "value": "${var.worker_max_capacity}"
+      }
+    ],
+    "logConfiguration": {
+      "logDriver": "awslogs",
+      "options": {
+        "awslogs-group": "/todo/backlog-monitor",
+        "awslogs-region": "us-east-1",
+        "awslogs-stream-prefix": "ecs",
+        "awslogs-create-group": "true"
+      }
+    }
+  }
+]
+DEFINITION
+}
+
+resource "aws_ecs_service" "backlog_monitor" {
+  name            = "backlog-monitor"
+  cluster         = aws_ecs_cluster.todo.id
+  task_definition = aws_ecs_task_definition.backlog_monitor.arn
+  desired_count   = 1
+  launch_type     = "FARGATE"
+  network_configuration {
+    subnets          = data.aws_subnets.private.ids
+    security_groups  = [aws_security_group.todo.id]
+    assign_public_ip = true
+  }
+}
+
+variable "worker_max_capacity" {
+  description = "Upper bound on tasks per Celery worker service."
+  type        = number
+  default     = 20
+}
+
+resource "aws_appautoscaling_target" "workers" {
+  for_each           = local.worker_services
+  max_capacity       = var.worker_max_capacity
+  min_capacity       = 1
+  resource_id        = "service/${aws_ecs_cluster.todo.name}/${each.value}"
+  scalable_dimension = "ecs:service:DesiredCount"
+  service_namespace  = "ecs"
+}
+
+resource "aws_appautoscaling_policy" "workers_backlog" {
+  for_each           = local.worker_services
+  name               = "${each.value}-backlog-scaling"
+  policy_type        = "TargetTrackingScaling"
+  resource_id        = aws_appautoscaling_target.workers[each.key].resource_id
+  scalable_dimension = aws_appautoscaling_target.workers[each.key].scalable_dimension
+  service_namespace  = aws_appautoscaling_target.workers[each.key].service_namespace
+
+  target_tracking_scaling_policy_configuration {
+    customized_metric_specification {
+      metrics {
+        id          = "desired"
+        return_data = false
+        metric_stat {
+          stat = "Maximum"
+          metric {
+            namespace   = local.backlog_namespace
+            metric_name = "DesiredWorkers"
+            dimensions {
+              name  = "JobClass"
+              value = each.key
+            }
+          }
+        }
+      }
+      metrics {
+        id          = "running"
+        return_data = false
+        metric_stat {
+          stat = "Average"
+          metric {
+            namespace   = "ECS/ContainerInsights"
+            metric_name = "RunningTaskCount"
+            dimensions {
+              name  = "ClusterName"
+              value = aws_ecs_cluster.todo.name
+            }
+            dimensions {
+              name  = "ServiceName"
+              value = each.value
+            }
+          }
+        }
+      }
+      metrics {
+        id          = "demand"
+        label       = "Desired workers per running worker"
+        expression  = "desired / running"
+        return_data = true
+      }
+    }
+
+    target_value       = 1
+    scale_out_cooldown = 60
+    # Let a drained queue stay drained before giving workers back
+    scale_in_cooldown  = 300
+  }
+}
@@ -0,0 +1,334 @@
+"""Benchmark harness: submit throughput, listing and summary latency, worker drain.
+
+Everything runs in-process against the Flask test client with an in-memory
+Celery broker and the fake engine (fake_overflowengine.py), so a run needs
+no deployed stack. The database is a throwaway SQLite file unless
+SQLALCHEMY_DATABASE_URI points elsewhere (e.g. a local Postgres).
+
+    python -m todo.bench run [--scenarios submit,listing,summary,drain]
+                             [--rows N] [--samples N] [--output FILE]
+    python -m todo.bench seed --rows 2000000
+    python -m todo.bench compare BASE.json HEAD.json
+
+`run` prints one JSON document (and writes it to --output), tagged with the
+git commit, so results from two commits can be put through `compare`.
+"""
+import os
+import json
+import time
+import random
+import base64
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_LAB_ID = os.environ.get("BENCH_LAB_ID", "BENCHLAB1")
+BENCH_LAB_COUNT = int(os.environ.get("BENCH_LAB_COUNT", "20"))
+BENCH_PATIENT_ID = "12345678901"
+# Any bytes will do: the fake engine only hashes them.
+BENCH_IMAGE = base64.b64encode(os.urandom(64 * 1024)).decode()
+SCENARIOS = ("submit", "listing", "summary", "drain")
+SEED_CHUNK = 10000
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_overflowengine.py")
+
+
+def bench_labs():
+    return [BENCH_LAB_ID] + [f"BENCHLAB{i}" for i in range(2, BENCH_LAB_COUNT + 1)]
+
+
+def _configure_environment(workdir):
+    os.environ.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{workdir}/bench.db")
+    os.environ.setdefault("CELERY_BROKER_URL", "memory://")
+    os.environ.setdefault("CELERY_RESULT_BACKEND", "cache+memory://")
+    os.environ.setdefault("STAGING_DIR", os.path.join(workdir, "staging"))
+    os.environ.setdefault("ENGINE_SCRATCH_DIR", workdir)
+    os.environ.setdefault("OVERFLOWENGINE_PATH", FAKE_ENGINE)
+    # Submissions stop at the outbox commit; keep the relay off SQLite's single writer
+    os.environ.setdefault("OUTBOX_RELAY_IN_PROCESS", "false")
+    # The bench measures throughput; rate limits would only measure themselves
+    os.environ.setdefault("ADMISSION_ENABLED", "false")
+    # Pin the registry to the bench labs without touching the network
+    snapshot = os.path.join(workdir, "labs.csv")
+    with open(snapshot, "w") as labs:
+        labs.write("\n".join(bench_labs()) + "\n")
+    os.environ.setdefault("LABS_SNAPSHOT_PATH", snapshot)
+    os.environ.setdefault("LABS_URL", "http://127.0.0.1:9/labs.csv")
+
+
+def make_app():
+    from todo import create_app
+    from todo.models import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _percentiles(samples):
+    """Latency summary in milliseconds."""
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": pick(0.50), "p95_ms": pick(0.95),
+            "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def _timed_get(client, url, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, (url, response.get_data(as_text=True)[:200])
+    return _percentiles(samples)
+
+
+def seed(app, rows, days=90, seed_value=6400):
+    """Bulk-load `rows` Todo rows spread over the bench labs, then rebuild rollups.
+
+    Half of the rows go to BENCH_LAB_ID so the listing scenario has depth to
+    page through. Inserts bypass the ORM in chunks of SEED_CHUNK rows, which
+    keeps a few million rows to minutes.
+    """
+    import uuid
+    from todo.models import db, rollup
+    from todo.models import lab as lab_model
+    from todo.models.todo import Todo
+    from todo.labs import lab_registry
+
+    rng = random.Random(seed_value)
+    labs = bench_labs()
+    statuses = ("pending", "covid", "h5n1", "healthy", "healthy", "healthy", "failed")
+    now = datetime.datetime.utcnow()
+    span = days * 86400
+    started = time.perf_counter()
+    with app.app_context():
+        inserted = 0
+        while inserted < rows:
+            chunk = []
+            for _ in range(min(SEED_CHUNK, rows - inserted)):
+                created_at = now - datetime.timedelta(seconds=rng.random() * span)
+                chunk.append({
+                    "request_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    "lab_id": BENCH_LAB_ID if rng.random() < 0.5 else rng.choice(labs),
+                    "patient_id": str(rng.randrange(10 ** 10, 10 ** 11)),
+                    "result": rng.choice(statuses),
+                    "urgent": rng.random() < 0.1,
+                    "created_at": created_at,
+                    "updated_at": created_at,
+                })
+            db.session.execute(Todo.__table__.insert(), chunk)
+            db.session.commit()
+            inserted += len(chunk)
+        rollup_rows = rollup.rebuild()
+        lab_model.sync_from_registry(lab_registry.labs())
+        lab_model.backfill_activity()
+    return {"rows": rows, "rollup_rows": rollup_rows, "seconds": round(time.perf_counter() - started, 3)}
+
+
+def bench_submit(client, samples, batch_size):
+    start = time.perf_counter()
+    for _ in range(samples):
+        response = client.post(
+            f"/api/v1/analysis?lab_id={BENCH_LAB_ID}&patient_id={BENCH_PATIENT_ID}",
+            json={"image": BENCH_IMAGE},
+        )
+        assert response.status_code == 201, response.get_data(as_text=True)
+    single = time.perf_counter() - start
+
+    item = {"patient_id": BENCH_PATIENT_ID, "lab_id": BENCH_LAB_ID, "image": BENCH_IMAGE}
+    start = time.perf_counter()
+    remaining = samples
+    while remaining > 0:
+        size = min(batch_size, remaining)
+        response = client.post("/api/v1/analysis/batch", json=[item] * size)
+        assert response.status_code == 201, response.get_data(as_text=True)
+        remaining -= size
+    batch = time.perf_counter() - start
+
+    return {
+        "samples": samples,
+        "batch_size": batch_size,
+        "single_samples_per_second": round(samples / single, 1),
+        "batch_samples_per_second": round(samples / batch, 1),
+        "speedup": round(single / batch, 2),
+    }
+
+
+def bench_listing(app, client, repeat, page_size=100):
+    """First page, then a page deep in the lab's history by offset and by cursor."""
+    from todo.models.todo import Todo
+
+    with app.app_context():
+        total = Todo.query.filter_by(lab_id=BENCH_LAB_ID).count()
+    depth = max(total - page_size - 1, page_size) * 9 // 10
+
+    base = f"/api/v1/labs/results/{BENCH_LAB_ID}?limit={page_size}"
+    # The page before `depth` hands out the cursor that seeks to it
+    cursor = client.get(f"{base}&offset={depth - page_size}").headers.get("X-Next-Cursor")
+    result = {"lab_rows": total, "depth": depth, "first_page": _timed_get(client, base, repeat),
+              "offset_at_depth": _timed_get(client, f"{base}&offset={depth}", repeat)}
+    if cursor:
+        result["cursor_at_depth"] = _timed_get(client, f"{base}&{urlencode({'after': cursor})}", repeat)
+    return result
+
+
+def bench_summary(client, repeat):
+    base = f"/api/v1/labs/results/{BENCH_LAB_ID}/summary"
+    now = datetime.datetime.utcnow()
+    # Unaligned edges make the summary count the partial hours from Todo
+    start = (now - datetime.timedelta(days=30, minutes=17)).replace(microsecond=0).isoformat() + "Z"
+    end = (now - datetime.timedelta(minutes=43)).replace(microsecond=0).isoformat() + "Z"
+    return {"all_time": _timed_get(client, base, repeat),
+            "window_30d": _timed_get(client, f"{base}?start={start}&end={end}", repeat)}
+
+
+def bench_drain(app, jobs, concurrency):
+    """Run `jobs` staged samples through the ical task body against the fake engine."""
+    import uuid
+    from todo.models import db
+    from todo.models.todo import Todo
+    from todo.staging import blob_store
+    from todo.tasks.ical import ical
+    from todo.writebehind import result_buffer
+
+    now = datetime.datetime.utcnow()
+    work = []
+    with app.app_context():
+        for _ in range(jobs):
+            # Distinct bytes per job, so the analysis cache never short-circuits
+            blob_key, checksum = blob_store.put(os.urandom(16 * 1024))
+            job = Todo(request_id=str(uuid.uuid4()), patient_id=BENCH_PATIENT_ID, lab_id=BENCH_LAB_ID,
+                       urgent=False, result="pending", created_at=now, updated_at=now)
+            db.session.add(job)
+            work.append((job.request_id, blob_key, checksum))
+        db.session.commit()
+
+    def run(item):
+        request_id, blob_key, checksum = item
+        return ical(BENCH_PATIENT_ID, BENCH_LAB_ID, None, False, request_id,
+                    blob_key=blob_key, checksum=checksum)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        completed = sum(1 for outcome in pool.map(run, work) if outcome)
+    result_buffer.flush()
+    elapsed = time.perf_counter() - start
+    return {
+        "jobs": jobs,
+        "completed": completed,
+        "concurrency": concurrency,
+        "engine_latency": float(os.environ.get("FAKE_ENGINE_LATENCY", "0.05")),
+        "jobs_per_second": round(jobs / elapsed, 2),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(scenarios=SCENARIOS, rows=100000, samples=500, batch_size=100, repeat=50,
+        drain_jobs=200, drain_concurrency=1):
+    from todo.models import db
+
+    app = make_app()
+    client = app.test_client()
+    with app.app_context():
+        dialect = db.engine.dialect.name
+    report = {
+        "commit": _git_commit(),
+        "generated_at": datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+        "python": platform.python_version(),
+        "database": dialect,
+        "scenarios": {},
+    }
+    if "listing" in scenarios or "summary" in scenarios:
+        report["seed"] = seed(app, rows)
+    if "submit" in scenarios:
+        report["scenarios"]["submit"] = bench_submit(client, samples, batch_size)
+    if "listing" in scenarios:
+        report["scenarios"]["listing"] = bench_listing(app, client, repeat)
+    if "summary" in scenarios:
+        report["scenarios"]["summary"] = bench_summary(client, repeat)
+    if "drain" in scenarios:
+        report["scenarios"]["drain"] = bench_drain(app, drain_jobs, drain_concurrency)
+    return report
+
+
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(base, head):
+    """{metric: {base, head, change}} for every numeric result both reports share."""
+    base_values = dict(_flatten(base["scenarios"]))
+    result = {}
+    for name, value in _flatten(head["scenarios"]):
+        if name in base_values:
+            before = base_values[name]
+            change = round((value - before) / before, 4) if before else None
+            result[name] = {"base": before, "head": value, "change": change}
+    return {"base": base.get("commit"), "head": head.get("commit"), "metrics": result}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m todo.bench")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    run_parser.add_argument("--rows", type=int, default=100000)
+    run_parser.add_argument("--samples", type=int, default=500)
+    run_parser.add_argument("--batch-size", type=int, default=100)
+    run_parser.add_argument("--repeat", type=int, default=50)
+    run_parser.add_argument("--drain-jobs", type=int, default=200)
+    run_parser.add_argument("--drain-concurrency", type=int, default=1)
+    run_parser.add_argument("--output")
+    seed_parser = commands.add_parser("seed")
+    seed_parser.add_argument("--rows", type=int, default=1000000)
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.base) as base, open(args.head) as head:
+            print(json.dumps(compare(json.load(base), json.load(head)), indent=2))
+        return
+
+    if args.command == "seed" and "SQLALCHEMY_DATABASE_URI" not in os.environ:
+        parser.error("seed loads an existing database; set SQLALCHEMY_DATABASE_URI")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        _configure_environment(workdir)
+        if args.command == "seed":
+            print(json.dumps(seed(make_app(), args.rows)))
+            return
+        if args.command is None:
+            args = run_parser.parse_args([])
+        report = run([name.strip() for name in args.scenarios.split(",") if name.strip()],
+                     rows=args.rows, samples=args.samples, batch_size=args.batch_size,
+                     repeat=args.repeat, drain_jobs=args.drain_jobs,
+                     drain_concurrency=args.drain_concurrency)
+        print(json.dumps(report))
+        if args.output:
+            with open(args.output, "w") as output:
+                json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
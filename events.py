@@ -0,0 +1,162 @@
+import os
+import json
+import queue
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+EVENTS_URL = os.environ.get("EVENTS_URL", os.environ.get("CELERY_BROKER_URL", ""))
+EVENTS_PREFIX = "coughoverflow:"
+
+
+def job_channel(request_id):
+    return f"analysis:{request_id}"
+
+
+def lab_channel(lab_id):
+    return f"lab:{lab_id}"
+
+
+class Subscription:
+    """A set of channels being listened to by one waiting request."""
+
+    def __init__(self, bus, channels):
+        self.bus = bus
+        self.channels = channels
+        self.queue = queue.Queue(maxsize=1000)
+
+    def get(self, timeout=None):
+        """Next message dict, or None if nothing arrived within timeout seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.bus._unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InProcessBus:
+    """Fan-out of messages to subscriptions within this process.
+
+    Used directly in tests and single-process runs, and as the local
+    delivery half of RedisBus.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, *channels):
+        subscription = Subscription(self, channels)
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                listeners = self._subscribers.get(channel)
+                if listeners is not None:
+                    listeners.discard(subscription)
+                    if not listeners:
+                        del self._subscribers[channel]
+
+    def publish(self, channel, message):
+        self._deliver(channel, message)
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            listeners = list(self._subscribers.get(channel, ()))
+        for subscription in listeners:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # A client that is not reading does not hold up the others
+                logger.warning(f"Dropping event for slow subscriber on {channel}")
+
+
+class RedisBus(InProcessBus):
+    """Publishes through Redis pub/sub.
+
+    Each process holds a single Redis subscription (a pattern over every
+    channel) and fans messages out to its local waiters. A waiting HTTP
+    client therefore costs a queue, not a Redis connection.
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        import redis  # type: ignore
+        self.client = redis.Redis.from_url(url)
+        self._listener_pid = None
+
+    def subscribe(self, *channels):
+        self._ensure_listener()
+        return super().subscribe(*channels)
+
+    def publish(self, channel, message):
+        self.client.publish(EVENTS_PREFIX + channel, json.dumps(message))
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            threading.Thread(target=self._listen, name="event-bus", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(EVENTS_PREFIX + "*")
+                for raw in pubsub.listen():
+                    self._dispatch(raw)
+            except Exception as e:
+                # Job waiters re-read the DB on timeout; lab streams miss events meanwhile
+                logger.warning(f"Event bus subscription lost, reconnecting: {e}")
+                time.sleep(1)
+
+    def _dispatch(self, raw):
+        try:
+            channel = raw["channel"].decode()[len(EVENTS_PREFIX):]
+            self._deliver(channel, json.loads(raw["data"]))
+        except Exception as e:
+            logger.warning(f"Ignoring malformed event {raw!r}: {e}")
+
+
+def build_bus():
+    if EVENTS_URL.startswith("redis"):
+        try:
+            return RedisBus(EVENTS_URL)
+        except Exception as e:
+            logger.warning(f"Redis event bus unavailable, using in-process bus: {e}")
+    return InProcessBus()
+
+
+event_bus = build_bus()
+
+
+def publish_job(job):
+    """Announce a job's new state to waiters on the job and on its lab."""
+    publish_message(job.to_dict())
+
+
+def publish_message(message):
+    """publish_job() for a job already serialised with Todo.to_dict()."""
+    try:
+        event_bus.publish(job_channel(message["request_id"]), message)
+        event_bus.publish(lab_channel(message["lab_id"]), message)
+    except Exception as e:
+        # Pollers still see the result in the DB; never fail the write for this
+        logger.warning(f"Failed to publish event for {message['request_id']}: {e}")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Stand-in for overflowengine with configurable latency and verdicts.
+
+Takes the same arguments as the real engine (--input PATH --output PATH) so
+EngineRunner can run it unchanged; point OVERFLOWENGINE_PATH at this file.
+
+    FAKE_ENGINE_LATENCY   mean seconds per image (default 0.05)
+    FAKE_ENGINE_JITTER    +/- fraction of the mean, uniform (default 0.2)
+    FAKE_ENGINE_VERDICTS  weighted outputs, e.g. "covid-19:1,h5n1:1,healthy:8"
+    FAKE_ENGINE_FAIL_RATE fraction of runs that exit non-zero (default 0)
+
+The verdict is chosen from the image's hash, so the same bytes always get
+the same answer, as they do with the real engine.
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+
+DEFAULT_VERDICTS = "covid-19:1,h5n1:1,healthy:8"
+
+
+def parse_verdicts(spec):
+    verdicts = []
+    for part in spec.split(","):
+        name, _, weight = part.partition(":")
+        verdicts.append((name.strip(), float(weight or 1)))
+    return verdicts
+
+
+def choose_verdict(data, verdicts):
+    seed = int.from_bytes(hashlib.sha256(data).digest()[:8], "big")
+    total = sum(weight for _, weight in verdicts)
+    point = (seed / 2 ** 64) * total
+    for name, weight in verdicts:
+        point -= weight
+        if point < 0:
+            return name
+    return verdicts[-1][0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args(argv)
+
+    latency = float(os.environ.get("FAKE_ENGINE_LATENCY", "0.05"))
+    jitter = float(os.environ.get("FAKE_ENGINE_JITTER", "0.2"))
+    fail_rate = float(os.environ.get("FAKE_ENGINE_FAIL_RATE", "0"))
+    verdicts = parse_verdicts(os.environ.get("FAKE_ENGINE_VERDICTS", DEFAULT_VERDICTS))
+
+    with open(args.input, "rb") as image:
+        data = image.read()
+    time.sleep(max(latency * (1 + random.uniform(-jitter, jitter)), 0))
+    if random.random() < fail_rate:
+        print("overflowengine: analysis failed", file=sys.stderr)
+        return 1
+    with open(args.output, "w") as output:
+        output.write(f"{choose_verdict(data, verdicts)}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
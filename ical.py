@@ -1,12 +1,48 @@
 import os
 import base64
-import uuid
-import subprocess
+import binascii
+import logging
 from datetime import datetime
 from celery import Celery
 from todo.models import db
 from todo.models.todo import Todo
+from todo.models import rollup
+from todo.analysis_cache import analysis_cache, image_digest
+from todo.worker import runtime, EngineError, ENGINE_TIMEOUT
+from todo.staging import blob_store, StagingError
+from todo.events import publish_job
+from todo.job_cache import job_cache
+from todo.scheduling import queue_wait
+from todo.metrics import Counter, timed
+from todo.writebehind import RESULT_WRITE_BEHIND, result_buffer
 from kombu import Queue  # type: ignore
+from celery.exceptions import Ignore, Retry  # type: ignore
+from celery.worker.control import inspect_command  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+analysis_results = Counter(
+    "coughoverflow_analysis_results_total",
+    "Analyses completed by the worker, by verdict and whether the cache answered.",
+    labels=("result", "cached"),
+)
+task_errors = Counter("coughoverflow_task_errors_total", "ical tasks that raised.")
+engine_failures = Counter(
+    "coughoverflow_engine_failures_total",
+    "overflowengine runs that timed out or crashed.",
+    labels=("kind",),
+)
+dead_letters = Counter(
+    "coughoverflow_dead_letters_total",
+    "Samples given up on and marked failed, by reason.",
+    labels=("reason",),
+)
+
+# Transient failures (engine timeout/crash, DB errors) are retried this many
+# times, ENGINE_RETRY_BACKOFF seconds apart and doubling, then dead-lettered.
+ENGINE_MAX_RETRIES = int(os.environ.get("ENGINE_MAX_RETRIES", "3"))
+ENGINE_RETRY_BACKOFF = float(os.environ.get("ENGINE_RETRY_BACKOFF", "5"))
+ENGINE_RETRY_BACKOFF_MAX = 300
 
 # Initialize Celery app
 celery = Celery(__name__)
@@ -21,66 +57,238 @@ celery.conf.task_queues = [
 
 celery.conf.broker_transport_options = {
     'region': os.environ.get("AWS_REGION", "us-east-1"),
+    # Redis: drain queues in -Q order (urgent first) instead of round-robin
+    'queue_order_strategy': 'priority',
 }
 
-@celery.task(name="ical")
-def ical(patient_id, lab_id, image_base64, urgent, request_id):
+# Ack after the task runs and prefetch a single message, so a flood of
+# batch work cannot sit reserved in a worker ahead of newer urgent samples.
+celery.conf.task_acks_late = True
+celery.conf.worker_prefetch_multiplier = int(os.environ.get("CELERY_PREFETCH_MULTIPLIER", "1"))
+
+
+@inspect_command()
+def analysis_cache_stats(state):
+    """`celery -A todo.tasks.ical inspect analysis_cache_stats`"""
+    return analysis_cache.stats()
+
+
+def record_result(request_id, status):
+    """Write the analysis verdict back to the job row, if it is still pending.
+
+    Tasks can run twice (outbox relay and late acks are at-least-once), so a
+    job that already has a verdict keeps it. Returns False when nothing was
+    written; buffered writes return True and are guarded the same way.
+    """
+    if RESULT_WRITE_BEHIND:
+        # Coalesced with other verdicts into one bulk UPDATE
+        result_buffer.add(request_id, status, datetime.utcnow())
+        return True
+    with timed("result_commit"):
+        job = (Todo.query.filter_by(request_id=request_id, result='pending')
+               .with_for_update()
+               .first())
+        if job is None:
+            db.session.rollback()
+            logger.info(f"Not recording {status} for {request_id}: job is missing or already finished")
+            return False
+        job.result = status
+        job.updated_at = datetime.utcnow()
+        rollup.record_transition(job, 'pending')
+        db.session.commit()
+    job_cache.put(job)
+    publish_job(job)
+    return True
+
+
+def finished_result(request_id):
+    """The job's verdict if it already has one, else None."""
+    result = db.session.query(Todo.result).filter_by(request_id=request_id).scalar()
+    return result if result not in (None, 'pending') else None
+
+
+@inspect_command()
+def queue_wait_stats(state):
+    """`celery -A todo.tasks.ical inspect queue_wait_stats`"""
+    return {
+        job_class: {"count": series["count"], "p50": queue_wait.quantile(0.5, job_class),
+                    "p99": queue_wait.quantile(0.99, job_class)}
+        for (job_class,), series in queue_wait.snapshot().items()
+    }
+
+
+@inspect_command()
+def write_behind_stats(state):
+    """`celery -A todo.tasks.ical inspect write_behind_stats`"""
+    return result_buffer.stats()
+
+
+@inspect_command()
+def engine_stats(state):
+    """`celery -A todo.tasks.ical inspect engine_stats`"""
+    return runtime.breaker.stats()
+
+
+def parse_verdict(output):
+    """Map engine output to a result, or None if it is not one we recognise."""
+    output = output.lower()
+    if "covid-19" in output:
+        return "covid"
+    if "h5n1" in output:
+        return "h5n1"
+    if "healthy" in output:
+        return "healthy"
+    return None
+
+
+def dead_letter(request_id, blob_key, image_data, reason, **details):
+    """Give up on a sample: mark its job failed and keep the bytes for inspection.
+
+    A job that already has a verdict (a duplicate delivery) is left alone.
+    """
+    try:
+        if not record_result(request_id, "failed"):
+            return {"request_id": request_id, "result": finished_result(request_id), "duplicate": True}
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Could not mark {request_id} failed: {e}")
+    dead_letters.inc(reason)
+    logger.error(f"Dead-lettering {request_id} ({reason}): {details}")
+    try:
+        if blob_key is None and image_data is not None:
+            blob_key, _ = blob_store.put(bytes(image_data))
+        if blob_key is not None:
+            blob_store.dead_letter(blob_key, reason, request_id=request_id, **details)
+    except OSError as e:
+        logger.error(f"Could not keep dead-lettered sample {request_id}: {e}")
+    return {"request_id": request_id, "result": "failed", "dead_letter": reason}
+
+
+def _retry_countdown(retries):
+    return min(ENGINE_RETRY_BACKOFF * 2 ** retries, ENGINE_RETRY_BACKOFF_MAX)
+
+
+def _engine_failed(task, error):
+    """Trip the breaker if needed; pausing stops this node consuming the task's queue."""
+    engine_failures.inc(type(error).__name__)
+    hostname = task.request.hostname
+    queue = (task.request.delivery_info or {}).get("routing_key")
+    if not hostname or not queue:
+        runtime.breaker.record_failure()
+        return
+    runtime.breaker.record_failure(
+        on_open=lambda: celery.control.cancel_consumer(queue, destination=[hostname]),
+        on_half_open=lambda: celery.control.add_consumer(queue, destination=[hostname]),
+    )
+
+
+def _defer(task, countdown):
+    """Requeue the task as-is without spending one of its engine retries."""
+    request = task.request
+    if request.is_eager:
+        # Eager runs have no queue to hand the task back to
+        raise task.retry(countdown=countdown, max_retries=request.retries + 1)
+    task.signature_from_request(request, countdown=countdown, retries=request.retries).apply_async()
+    raise Ignore()
+
+
+# time_limit is a backstop for a task stuck outside the engine, whose runs
+# are already bounded by ENGINE_TIMEOUT.
+@celery.task(name="ical", bind=True, time_limit=ENGINE_TIMEOUT + 120)
+def ical(self, patient_id, lab_id, image_base64, urgent, request_id, blob_key=None, checksum=None):
+    image_path = None
+    image_data = None
+    admitted = runtime.breaker.allow()
+    if not admitted:
+        # Reserved while the breaker is open or a trial is running: put it back
+        _defer(self, countdown=max(runtime.breaker.remaining(), 1))
     try:
-        # Import create_app inside the task function to avoid circular imports
-        from todo import create_app
-
-        # Create Flask app instance and push the app context
-        app = create_app()
-        with app.app_context():
-            # Decode the image data
-            image_data = base64.b64decode(image_base64)
-            image_filename = f"temp_{str(uuid.uuid4())}.jpg"
-            image_path = os.path.join('/tmp', image_filename)
-
-            # Save the image temporarily
-            with open(image_path, 'wb') as image_file:
-                image_file.write(image_data)
-
-            # Run the image analysis command
-            result_filename = f"result_{str(uuid.uuid4())}.txt"
-            result_path = os.path.join('/tmp', result_filename)
-            binary_path = "/app/overflowengine"
-            command = f"{binary_path} --input {image_path} --output {result_path}"
-
-            result = subprocess.run(command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            # Read analysis results
-            with open(result_path, 'r') as result_file:
-                analysis_result = result_file.read()
-            print(f"[DEBUG] Analysis result: {analysis_result}")
-            # Handle cases with no results
-            if "covid-19" in analysis_result.lower():
-                status = "covid"
-            elif "h5n1" in analysis_result.lower():
-                status = "h5n1"
-            elif "healthy" in analysis_result.lower():
-                status = "healthy"
-            else:
-                status = "pending"
-            print(f"[DEBUG] Analysis result: {status}")
+        # The app and its DB pool are built once per worker process
+        with runtime.app.app_context():
+            # A redelivered task whose job already has a verdict has nothing to do
+            finished = finished_result(request_id)
+            if finished is not None:
+                logger.info(f"Skipping duplicate delivery of {request_id}: already {finished}")
+                return {"request_id": request_id, "result": finished, "duplicate": True}
+            try:
+                if blob_key is not None:
+                    # Staged by the API: verify the bytes in place and let the
+                    # engine read the blob file directly, no temp copy.
+                    with timed("blob_verify"), blob_store.open(blob_key, checksum) as staged:
+                        nbytes = len(staged)
+                    digest = checksum
+                    engine_input = blob_store.path(blob_key)
+                else:
+                    # Messages queued before staging still carry base64 inline
+                    with timed("base64_decode"):
+                        image_data = base64.b64decode(image_base64)
+                    nbytes = len(image_data)
+                    digest = image_digest(image_data)
+                    engine_input = None
+            except (StagingError, binascii.Error, TypeError, ValueError) as e:
+                # Missing or corrupt bytes do not get better on retry
+                return dead_letter(request_id, blob_key, None, "unreadable_sample", error=str(e))
+
+            # Identical bytes always get the same verdict, so a retried or
+            # resubmitted sample can skip the engine entirely.
+            cached_status = analysis_cache.get(digest, nbytes)
+            if cached_status is not None:
+                record_result(request_id, cached_status)
+                analysis_results.inc(cached_status, "true")
+                if blob_key is not None:
+                    blob_store.delete(blob_key)
+                return {"request_id": request_id, "result": cached_status, "cached": True}
+
+            if engine_input is None:
+                # Save the image temporarily
+                image_path = engine_input = runtime.engine.scratch_path("temp", ".jpg")
+                with timed("temp_file_write"), open(image_path, 'wb') as image_file:
+                    image_file.write(image_data)
+
+            # Run the image analysis
+            try:
+                with timed("engine"):
+                    analysis_result = runtime.engine.run(engine_input)
+            except EngineError as e:
+                _engine_failed(self, e)
+                if self.request.retries < ENGINE_MAX_RETRIES:
+                    logger.warning(f"Engine failed on {request_id}, retrying: {e}")
+                    raise self.retry(exc=e, countdown=_retry_countdown(self.request.retries),
+                                     max_retries=ENGINE_MAX_RETRIES)
+                return dead_letter(request_id, blob_key, image_data, "engine_failed",
+                                   error=str(e), attempts=self.request.retries + 1)
+            logger.debug(f"Engine output for {request_id}: {analysis_result}")
+
+            # The engine ran to completion, whatever it made of the sample
+            runtime.breaker.record_success()
+            with timed("result_parse"):
+                status = parse_verdict(analysis_result)
+            if status is None:
+                # A poisoned sample, not an unhealthy engine: leave the breaker alone
+                return dead_letter(request_id, blob_key, image_data, "unrecognised_output",
+                                   output=analysis_result[:500])
+            analysis_cache.put(digest, status)
             # Update the job in the database with the result
-            job = Todo.query.filter_by(request_id=request_id).first()
-            if job:
-                job.result = status
-                job.updated_at = datetime.utcnow()
-                db.session.commit()
-            print(f"[DEBUG] Analysis result: {status}")
-            print(f"[DEBUG] Analysis result: {result}")
+            record_result(request_id, status)
+            analysis_results.inc(status, "false")
+            if blob_key is not None:
+                blob_store.delete(blob_key)
             return {"request_id": request_id, "result": status}
 
+    except Retry:
+        raise
     except Exception as e:
-        # Log the error in case of failure
-        import logging
-        logging.error(f"Error in ical task for request {request_id}: {e}")
+        task_errors.inc()
+        logger.exception(f"Error in ical task for request {request_id}: {e}")
+        if self.request.retries < ENGINE_MAX_RETRIES:
+            raise self.retry(exc=e, countdown=_retry_countdown(self.request.retries),
+                             max_retries=ENGINE_MAX_RETRIES)
+        with runtime.app.app_context():
+            return dead_letter(request_id, blob_key, image_data, "error", error=str(e))
 
     finally:
+        if admitted == "trial":
+            runtime.breaker.end_trial()
         # Clean up files even if an exception occurred
         if image_path and os.path.exists(image_path):
             os.remove(image_path)
-        if result_path and os.path.exists(result_path):
-            os.remove(result_path)
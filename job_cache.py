@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from todo.analysis_cache import LRUCache
+from todo.metrics import stats_gauge
+
+logger = logging.getLogger(__name__)
+
+JOB_CACHE_BACKEND = os.environ.get("JOB_CACHE_BACKEND", "redis")
+JOB_CACHE_URL = os.environ.get("JOB_CACHE_URL", os.environ.get("CELERY_BROKER_URL", ""))
+JOB_CACHE_SIZE = int(os.environ.get("JOB_CACHE_SIZE", "10000"))
+# Pending jobs are rewritten by the worker when they finish, so the TTL only
+# bounds how long a missed write-through can leave a poller on "pending".
+JOB_CACHE_PENDING_TTL = int(os.environ.get("JOB_CACHE_PENDING_TTL", "30"))
+JOB_CACHE_FINISHED_TTL = int(os.environ.get("JOB_CACHE_FINISHED_TTL", "3600"))
+# The memory tier only sees its own process's write-throughs, so entries
+# there never live longer than this.
+JOB_CACHE_MEMORY_MAX_TTL = int(os.environ.get("JOB_CACHE_MEMORY_MAX_TTL", "5"))
+
+JOB_FIELDS = ("request_id", "lab_id", "patient_id", "result", "urgent", "created_at", "updated_at")
+CachedJob = namedtuple("CachedJob", JOB_FIELDS)
+
+
+def cached_job(job, **changes):
+    """Detached copy of a Todo (or a JOB_COLUMNS row) that is safe to keep after commit."""
+    return CachedJob(*(getattr(job, field) for field in JOB_FIELDS))._replace(**changes)
+
+
+def _encode(job):
+    values = job._asdict()
+    values["created_at"] = job.created_at.isoformat()
+    values["updated_at"] = job.updated_at.isoformat()
+    return json.dumps(values)
+
+
+def _decode(payload):
+    values = json.loads(payload)
+    values["created_at"] = datetime.fromisoformat(values["created_at"])
+    values["updated_at"] = datetime.fromisoformat(values["updated_at"])
+    return CachedJob(**values)
+
+
+class MemoryTier:
+    """In-process LRU with per-entry expiry, for tests and single-process runs."""
+
+    def __init__(self, max_entries, max_ttl=JOB_CACHE_MEMORY_MAX_TTL):
+        self.entries = LRUCache(max_entries)
+        self.max_ttl = max_ttl
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, payload = entry
+        if expires_at <= time.monotonic():
+            self.entries.delete(key)
+            return None
+        return payload
+
+    def set(self, key, payload, ttl, only_if_absent=False):
+        with self._lock:
+            if only_if_absent and self.get(key) is not None:
+                return False
+            self.entries.set(key, (time.monotonic() + min(ttl, self.max_ttl), payload))
+            return True
+
+
+class RedisTier:
+    """Shared by every API and worker process."""
+
+    def __init__(self, url):
+        import redis  # type: ignore
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(f"job:{key}")
+        return value.decode() if value else None
+
+    def set(self, key, payload, ttl, only_if_absent=False):
+        return bool(self.client.set(f"job:{key}", payload, ex=ttl, nx=only_if_absent))
+
+
+class JobCache:
+    """Read-through cache of job rows keyed by request_id.
+
+    Reads fill missing entries with SET NX; writers (the worker's verdict
+    and lab reassignment) overwrite after their commit. A fill that raced
+    with a write therefore loses instead of restoring the old row. Tier
+    errors are logged and treated as misses, so an outage costs DB reads.
+    """
+
+    def __init__(self, tier):
+        self.tier = tier
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.writes = 0
+        self.errors = 0
+
+    @staticmethod
+    def ttl_for(job):
+        return JOB_CACHE_PENDING_TTL if job.result == 'pending' else JOB_CACHE_FINISHED_TTL
+
+    def get(self, request_id):
+        try:
+            payload = self.tier.get(request_id)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Job cache lookup failed: {e}")
+            payload = None
+        if payload is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _decode(payload)
+
+    def lookup(self, request_id, load):
+        """The cached job, or load() it (a Todo or None) and fill the cache."""
+        job = self.get(request_id)
+        if job is not None:
+            return job
+        row = load()
+        if row is None:
+            return None
+        job = cached_job(row)
+        self._set(job, only_if_absent=True)
+        self.fills += 1
+        return job
+
+    def put(self, job):
+        """Write through a committed change; job is a Todo or CachedJob."""
+        if not isinstance(job, CachedJob):
+            job = cached_job(job)
+        self._set(job)
+        self.writes += 1
+
+    def _set(self, job, only_if_absent=False):
+        try:
+            self.tier.set(job.request_id, _encode(job), self.ttl_for(job), only_if_absent)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Job cache write for {job.request_id} failed: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "fills": self.fills,
+            "writes": self.writes,
+            "errors": self.errors,
+            "tier": type(self.tier).__name__,
+        }
+
+
+def build_cache():
+    """Build the process-wide cache from JOB_CACHE_* settings."""
+    if JOB_CACHE_BACKEND == "redis" and JOB_CACHE_URL.startswith("redis"):
+        try:
+            return JobCache(RedisTier(JOB_CACHE_URL))
+        except Exception as e:
+            logger.warning(f"Job cache Redis tier unavailable, memory only: {e}")
+    return JobCache(MemoryTier(JOB_CACHE_SIZE))
+
+
+job_cache = build_cache()
+stats_gauge("coughoverflow_job_cache", "Job lookup cache hits, misses, fills and write-throughs.", job_cache.stats)
@@ -5,7 +5,7 @@ export const options = {
     duration: '30s',
   };
 // Base URL of your app
-const BASE_URL = 'http://localhost:8080/api/v1/';
+const BASE_URL = __ENV.BASE_URL || 'http://localhost:8080/api/v1/';
 
 // Define a valid patient ID, lab ID, and base64-encoded image data
 const patientId = "33858315221";  // Replace with the actual patient ID
@@ -28,42 +28,36 @@ export default function () {
     // Send POST request with patient_id and lab_id as query parameters
     const postRes = http.post(`${BASE_URL}analysis?patient_id=${patientId}&lab_id=${labId}`, payload, params);
 
-    // Check that the POST request was successful (HTTP 202)
+    // Check that the POST request was successful (HTTP 201)
     check(postRes, {
-        'POST /analysis returns status 202': (r) => r.status === 202,
+        'POST /analysis returns status 201': (r) => r.status === 201,
     });
+    if (postRes.status !== 201) {
+        return;
+    }
+
+    // Extract the job id from the response body
+    const requestId = JSON.parse(postRes.body).id;
 
-    // Extract task_id from the response body
-    const taskId = JSON.parse(postRes.body).task_id;
+    // Step 2: Poll the job until the worker has recorded a verdict
+    let analysisRes;
+    let result = 'pending';
+    const deadline = Date.now() + 120 * 1000;
 
-    // Step 2: Poll the task status using the task_id
-    let taskStatusRes;
-    let taskStatus;
-    
     do {
-        taskStatusRes = http.get(`${BASE_URL}todos/ical/${taskId}/status`);
+        sleep(1);
+        analysisRes = http.get(`${BASE_URL}analysis?request_id=${requestId}`);
         try {
-            const parsedBody = JSON.parse(taskStatusRes.body);
-            taskStatus = parsedBody.task_status;
+            result = JSON.parse(analysisRes.body).result;
         } catch (e) {
-            console.error('Failed to parse task status response as JSON:', taskStatusRes.body);
-            return; // or break, depending on your desired flow
+            console.error('Failed to parse analysis response as JSON:', analysisRes.body);
+            return;
         }
-    
-        sleep(1);
-    } while (taskStatus !== 'SUCCESS' && taskStatus !== 'FAILURE');
-    
+    } while (result === 'pending' && Date.now() < deadline);
 
-    // Check if the task finished successfully
-    check(taskStatusRes, {
-        'GET /todos/ical/task_id/status returns SUCCESS': (r) => taskStatus === 'SUCCESS',
+    // Check that the job finished
+    check(analysisRes, {
+        'GET /analysis returns status 200': (r) => r.status === 200,
+        'analysis completed': () => result !== 'pending',
     });
-
-    // If the task succeeded, you can optionally fetch the result
-    if (taskStatus === 'SUCCESS') {
-        const taskResultRes = http.get(`${BASE_URL}/todos/ical/${taskId}/result`);
-        check(taskResultRes, {
-            'GET /todos/ical/task_id/result returns status 200': (r) => r.status === 200,
-        });
-    }
 }
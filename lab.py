@@ -0,0 +1,110 @@
+import datetime
+from collections import Counter
+
+from . import db, dialect_insert
+from .todo import Todo
+
+
+class Lab(db.Model):
+    """A lab from the registry plus its submission activity.
+
+    Rows are upserted from the lab registry (labs that drop out of it are
+    kept but marked inactive) and bumped by every submission, so GET /labs
+    never has to scan Todo.
+    """
+    __tablename__ = 'Lab'
+
+    lab_id = db.Column(db.String(50), primary_key=True)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    job_count = db.Column(db.Integer, nullable=False, default=0)
+    first_activity = db.Column(db.DateTime, nullable=True)
+    last_activity = db.Column(db.DateTime, nullable=True)
+    synced_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        def stamp(value):
+            return value.replace(microsecond=0).isoformat() + "Z" if value else None
+
+        return {
+            'lab_id': self.lab_id,
+            'active': self.active,
+            'job_count': self.job_count,
+            'first_activity': stamp(self.first_activity),
+            'last_activity': stamp(self.last_activity),
+        }
+
+    def __repr__(self):
+        return f'<Lab lab_id={self.lab_id} active={self.active} job_count={self.job_count}>'
+
+
+def sync_from_registry(lab_ids):
+    """Upsert the registry's labs as active and deactivate the rest. Commits."""
+    now = datetime.datetime.utcnow()
+    if lab_ids:
+        stmt = dialect_insert(Lab).values([
+            {'lab_id': lab_id, 'active': True, 'job_count': 0, 'synced_at': now}
+            for lab_id in sorted(lab_ids)
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Lab.lab_id],
+            set_={'active': True, 'synced_at': now},
+        )
+        db.session.execute(stmt)
+        (db.session.query(Lab)
+         .filter(Lab.active.is_(True), Lab.lab_id.notin_(list(lab_ids)))
+         .update({'active': False, 'synced_at': now}, synchronize_session=False))
+    db.session.commit()
+
+
+def backfill_activity():
+    """Recompute job counts and activity dates from Todo. Commits; returns labs touched."""
+    grouped = (db.session.query(Todo.lab_id, db.func.count(), db.func.min(Todo.created_at),
+                                db.func.max(Todo.created_at))
+               .group_by(Todo.lab_id)
+               .all())
+    for lab_id, job_count, first_activity, last_activity in grouped:
+        stmt = dialect_insert(Lab).values(
+            lab_id=lab_id, active=False, job_count=job_count,
+            first_activity=first_activity, last_activity=last_activity,
+        )
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[Lab.lab_id],
+            set_={'job_count': job_count, 'first_activity': first_activity, 'last_activity': last_activity},
+        ))
+    db.session.commit()
+    return len(grouped)
+
+
+def record_activity(jobs):
+    """Count submitted jobs against their labs, in the caller's transaction."""
+    _apply_counts(Counter(job.lab_id for job in jobs), max(job.created_at for job in jobs))
+
+
+def record_reassignment(job, old_lab_id):
+    """Move one job's count from old_lab_id to its current lab."""
+    if old_lab_id != job.lab_id:
+        _apply_counts({old_lab_id: -1, job.lab_id: 1}, job.updated_at)
+
+
+def record_reassignments(jobs, lab_id, when):
+    """Move the counts of jobs (read before the change) from their labs to lab_id."""
+    counts = Counter()
+    for job in jobs:
+        if job.lab_id != lab_id:
+            counts[job.lab_id] -= 1
+            counts[lab_id] += 1
+    if counts:
+        _apply_counts(counts, when)
+
+
+def _apply_counts(counts, when):
+    for lab_id, delta in counts.items():
+        stmt = dialect_insert(Lab).values(
+            lab_id=lab_id, active=True, job_count=max(delta, 0),
+            first_activity=when, last_activity=when,
+        )
+        changes = {'job_count': Lab.job_count + delta}
+        if delta > 0:
+            changes['first_activity'] = db.func.coalesce(Lab.first_activity, stmt.excluded.first_activity)
+            changes['last_activity'] = stmt.excluded.last_activity
+        db.session.execute(stmt.on_conflict_do_update(index_elements=[Lab.lab_id], set_=changes))
@@ -0,0 +1,170 @@
+import csv
+import os
+import threading
+import time
+import logging
+
+import requests  # type: ignore
+from todo.metrics import stats_gauge
+
+logger = logging.getLogger(__name__)
+
+LABS_URL = os.environ.get("LABS_URL", "https://csse6400.uqcloud.net/resources/labs.csv")
+LABS_TTL = float(os.environ.get("LABS_TTL", "300"))
+LABS_FETCH_TIMEOUT = float(os.environ.get("LABS_FETCH_TIMEOUT", "5"))
+LABS_SNAPSHOT_PATH = os.environ.get("LABS_SNAPSHOT_PATH", "/tmp/labs.csv")
+
+
+def parse_lab_ids(text):
+    """Parse the labs.csv body into a set of lab ids."""
+    valid_lab_ids = set()
+    cleaned_text = text.lstrip('\ufeff')
+    for row in csv.reader(cleaned_text.splitlines()):
+        if row:
+            lab_id = row[0].strip()
+            if lab_id:
+                valid_lab_ids.add(lab_id)
+    return valid_lab_ids
+
+
+class LabRegistry:
+    """Shared set of authorised lab ids.
+
+    Lookups only ever touch the in-memory set. A daemon thread refreshes it
+    from LABS_URL once it is older than the TTL and writes a last-known-good
+    snapshot to disk, which is what cold starts and offline runs load from.
+    """
+
+    def __init__(self, url=LABS_URL, ttl=LABS_TTL, snapshot_path=LABS_SNAPSHOT_PATH,
+                 timeout=LABS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.timeout = timeout
+        self.version = 0
+        self._labs = frozenset()
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "stale_reads": 0,
+            "refreshes": 0,
+            "refresh_failures": 0,
+        }
+
+    def __contains__(self, lab_id):
+        self._ensure_started()
+        if self.is_stale():
+            self._counters["stale_reads"] += 1
+            self._wakeup.set()
+        if lab_id in self._labs:
+            self._counters["hits"] += 1
+            return True
+        self._counters["misses"] += 1
+        return False
+
+    def __iter__(self):
+        self._ensure_started()
+        return iter(self._labs)
+
+    def __len__(self):
+        self._ensure_started()
+        return len(self._labs)
+
+    def is_stale(self):
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def labs(self):
+        """Return the current lab ids as a frozenset."""
+        self._ensure_started()
+        return self._labs
+
+    def stats(self):
+        return dict(self._counters, labs=len(self._labs), version=self.version,
+                    age_seconds=round(time.monotonic() - self._loaded_at, 3))
+
+    def start(self):
+        """Load the snapshot and start the refresher thread for this process."""
+        self._ensure_started()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so gunicorn/celery children each
+        # start their own refresher the first time they touch the registry.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            if not self._labs and not self._load_snapshot():
+                # Nothing on disk yet: one bounded fetch so the first
+                # submissions are not all rejected.
+                self.refresh()
+            thread = threading.Thread(target=self._run, name="lab-registry", daemon=True)
+            thread.start()
+
+    def _run(self):
+        while True:
+            wait = max(self.ttl - (time.monotonic() - self._loaded_at), 1.0)
+            self._wakeup.wait(timeout=wait)
+            self._wakeup.clear()
+            if self.is_stale():
+                if not self.refresh():
+                    # Back off instead of hammering an unreachable host.
+                    time.sleep(min(self.ttl, 30))
+
+    def refresh(self):
+        """Fetch labs.csv and swap it in. Returns True on success."""
+        try:
+            response = requests.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            labs = parse_lab_ids(response.text)
+            if not labs:
+                raise ValueError("labs.csv contained no lab ids")
+        except Exception as e:
+            self._counters["refresh_failures"] += 1
+            logger.warning(f"Failed to refresh lab registry from {self.url}: {e}")
+            return False
+
+        self._swap(labs)
+        self._counters["refreshes"] += 1
+        self._write_snapshot(response.text)
+        return True
+
+    def _swap(self, labs):
+        labs = frozenset(labs)
+        if labs != self._labs:
+            # Consumers (e.g. the Lab table sync) key off version changes
+            self.version += 1
+        self._labs = labs
+        self._loaded_at = time.monotonic()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r') as snapshot:
+                labs = parse_lab_ids(snapshot.read())
+        except OSError:
+            return False
+        if not labs:
+            return False
+        self._swap(labs)
+        # Served until the refresher replaces it, but counted as stale.
+        self._loaded_at = time.monotonic() - self.ttl - 1
+        return True
+
+    def _write_snapshot(self, text):
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as snapshot:
+                snapshot.write(text)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.warning(f"Failed to write lab snapshot {self.snapshot_path}: {e}")
+
+
+lab_registry = LabRegistry()
+stats_gauge("coughoverflow_lab_registry", "Lab registry lookups and snapshot state.", lab_registry.stats)
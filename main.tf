@@ -50,6 +50,12 @@ resource "docker_image" "todo" {
 }
 resource "aws_ecs_cluster" "todo" {
   name = "todo-cluster"
+
+  # RunningTaskCount for the worker scaling policies in backlog.tf
+  setting {
+    name  = "containerInsights"
+    value = "enabled"
+  }
 }
 
 resource "aws_appautoscaling_policy" "todo_cpu_policy" {
@@ -102,6 +108,8 @@ resource "aws_ecs_service" "todo" {
     task_definition = aws_ecs_task_definition.todo.arn
     desired_count = 1
     launch_type = "FARGATE"
+    # EFS volumes need the mount targets up before tasks start
+    depends_on = [aws_efs_mount_target.staging]
     network_configuration {
      subnets = data.aws_subnets.private.ids
      security_groups = [aws_security_group.todo.id]
@@ -208,6 +216,14 @@ resource "aws_ecs_task_definition" "todo" {
   memory                   = 2048
   execution_role_arn       = data.aws_iam_role.lab.arn
 
+  volume {
+    name = "staging"
+    efs_volume_configuration {
+      file_system_id     = aws_efs_file_system.staging.id
+      transit_encryption = "ENABLED"
+    }
+  }
+
   container_definitions = <<DEFINITION
 [
   {
@@ -222,7 +238,17 @@ resource "aws_ecs_task_definition" "todo" {
         "hostPort": 8080
       }
     ],
+    "mountPoints": [
+      {
+        "sourceVolume": "staging",
+        "containerPath": "${local.staging_dir}"
+      }
+    ],
     "environment": [
+      {
+        "name": "STAGING_DIR",
+        "value": "${local.staging_dir}"
+      },
       {
         "name": "SQLALCHEMY_DATABASE_URI",
         "value": "postgresql://${local.database_username}:${local.database_password}@${aws_db_instance.CoughOverflow_database.address}:${aws_db_instance.CoughOverflow_database.port}/${aws_db_instance.CoughOverflow_database.db_name}"
@@ -283,6 +309,15 @@ resource "aws_ecs_task_definition" "celery_worker" {
   cpu                      = 1024
   memory                   = 2048
   execution_role_arn       = data.aws_iam_role.lab.arn
+
+  volume {
+    name = "staging"
+    efs_volume_configuration {
+      file_system_id     = aws_efs_file_system.staging.id
+      transit_encryption = "ENABLED"
+    }
+  }
+
   container_definitions = <<DEFINITION
 [
   {
@@ -291,7 +326,17 @@ resource "aws_ecs_task_definition" "celery_worker" {
     "memory": 2048,
     "name": "celery-worker",
     "networkMode": "awsvpc",
+    "mountPoints": [
+      {
+        "sourceVolume": "staging",
+        "containerPath": "${local.staging_dir}"
+      }
+    ],
     "environment": [
+      {
+        "name": "STAGING_DIR",
+        "value": "${local.staging_dir}"
+      },
       {
         "name": "SQLALCHEMY_DATABASE_URI",
         "value": "postgresql://${local.database_username}:${local.database_password}@${aws_db_instance.CoughOverflow_database.address}:${aws_db_instance.CoughOverflow_database.port}/${aws_db_instance.CoughOverflow_database.db_name}"
@@ -318,6 +363,10 @@ resource "aws_ecs_task_definition" "celery_worker" {
       {
         "name": "CELERY_DEFAULT_QUEUE",
         "value": "celerytaskqueue"
+      },
+      {
+        "name": "WORKER_CLASS",
+        "value": "shared"
       }
     ],
     "logConfiguration": {
@@ -341,6 +390,15 @@ resource "aws_ecs_task_definition" "celery_urgent_worker" {
   cpu                      = 1024
   memory                   = 2048
   execution_role_arn       = data.aws_iam_role.lab.arn
+
+  volume {
+    name = "staging"
+    efs_volume_configuration {
+      file_system_id     = aws_efs_file_system.staging.id
+      transit_encryption = "ENABLED"
+    }
+  }
+
   container_definitions = <<DEFINITION
 [
   {
@@ -349,7 +407,17 @@ resource "aws_ecs_task_definition" "celery_urgent_worker" {
     "memory": 2048,
     "name": "celery-urgent-worker",
     "networkMode": "awsvpc",
+    "mountPoints": [
+      {
+        "sourceVolume": "staging",
+        "containerPath": "${local.staging_dir}"
+      }
+    ],
     "environment": [
+      {
+        "name": "STAGING_DIR",
+        "value": "${local.staging_dir}"
+      },
       {
         "name": "SQLALCHEMY_DATABASE_URI",
         "value": "postgresql://${local.database_username}:${local.database_password}@${aws_db_instance.CoughOverflow_database.address}:${aws_db_instance.CoughOverflow_database.port}/${aws_db_instance.CoughOverflow_database.db_name}"
@@ -373,6 +441,10 @@ resource "aws_ecs_task_definition" "celery_urgent_worker" {
       {
         "name": "CELERY_DEFAULT_QUEUE",
         "value": "urgentqueue"
+      },
+      {
+        "name": "WORKER_CLASS",
+        "value": "urgent"
       }
     ],
     "logConfiguration": {
@@ -395,6 +467,8 @@ resource "aws_ecs_service" "celery_worker" {
   task_definition = aws_ecs_task_definition.celery_worker.arn
   desired_count   = 1
   launch_type     = "FARGATE"
+  # EFS volumes need the mount targets up before tasks start
+  depends_on = [aws_efs_mount_target.staging]
   network_configuration {
     subnets          = data.aws_subnets.private.ids
     security_groups  = [aws_security_group.todo.id]
@@ -407,6 +481,8 @@ resource "aws_ecs_service" "celery_urgent_worker" {
   task_definition = aws_ecs_task_definition.celery_urgent_worker.arn
   desired_count   = 1
   launch_type     = "FARGATE"
+  # EFS volumes need the mount targets up before tasks start
+  depends_on = [aws_efs_mount_target.staging]
   network_configuration {
     subnets          = data.aws_subnets.private.ids
     security_groups  = [aws_security_group.todo.id]
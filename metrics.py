@@ -0,0 +1,211 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Spans fast DB writes up to batch jobs that wait out a surge.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+# Every metric registers itself here; render() writes them all out.
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Gauge:
+    """Point-in-time values, either set directly or read from `collect` at scrape time.
+
+    `collect` returns {label values tuple: number}, so a component's existing
+    stats() can be exported without touching its hot path.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), collect=None, registry=REGISTRY):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values = {}
+        registry.append(self)
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def samples(self):
+        values = dict(self._values)
+        if self.collect is not None:
+            try:
+                values.update(self.collect())
+            except Exception as e:
+                logger.warning(f"Could not collect {self.name}: {e}")
+        for label_values, value in values.items():
+            if isinstance(value, (int, float)):
+                yield self.name, _format_labels(self.labels, label_values), value
+
+
+def stats_gauge(name, help_text, stats):
+    """Gauge over the numeric entries of a stats() dict, labelled by key."""
+    def collect():
+        return {(key,): value for key, value in stats().items()
+                if isinstance(value, (int, float))}
+    return Gauge(name, help_text, labels=("stat",), collect=collect)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """{label values: {"buckets": {le: cumulative count}, "sum": s, "count": n}}"""
+        result = {}
+        with self._lock:
+            for label_values, (counts, total, count) in self._series.items():
+                cumulative = 0
+                buckets = {}
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    buckets[bound] = cumulative
+                result[label_values] = {"buckets": buckets, "sum": total, "count": count}
+        return result
+
+    def quantile(self, q, *label_values):
+        """Upper bucket bound below which a fraction q of observations fall."""
+        series = self.snapshot().get(label_values)
+        if not series or not series["count"]:
+            return None
+        target = q * series["count"]
+        for bound, cumulative in series["buckets"].items():
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for label_values, series in self.snapshot().items():
+            for bound, cumulative in series["buckets"].items():
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labels, label_values, [("le", _format_value(bound))]),
+                       cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), series["sum"]
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), series["count"]
+
+
+def render(registry=REGISTRY):
+    """Prometheus text exposition of every registered metric."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Sub-millisecond steps (validation, parsing) up to a slow engine run.
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+stage_seconds = Histogram(
+    "coughoverflow_stage_seconds",
+    "Time spent in each step of submitting and analysing a sample.",
+    labels=("stage",),
+    buckets=STAGE_BUCKETS,
+)
+
+
+@contextmanager
+def timed(stage):
+    """Record the duration of the with-block under stage_seconds{stage=...}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="0.0.0.0"):
+    """Serve render() over HTTP from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name=f"metrics-{port}", daemon=True).start()
+    logger.info(f"Serving metrics for pid {os.getpid()} on :{port}")
+    return server
@@ -0,0 +1,78 @@
+import logging
+
+from sqlalchemy import text # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+def _todo_composite_indexes(conn, dialect):
+    # CONCURRENTLY keeps the live Todo table writable while Postgres builds
+    # the index; it cannot run inside a transaction, hence AUTOCOMMIT below.
+    concurrently = "CONCURRENTLY " if dialect == "postgresql" else ""
+    conn.execute(text(f'CREATE INDEX {concurrently}IF NOT EXISTS ix_todo_lab_id_created_at '
+                      f'ON "Todo" (lab_id, created_at)'))
+    conn.execute(text(f'CREATE INDEX {concurrently}IF NOT EXISTS ix_todo_patient_id_created_at '
+                      f'ON "Todo" (patient_id, created_at)'))
+
+
+def _lab_rollup_table(conn, dialect):
+    # Counters start empty; backfill with `flask api rebuild-rollups`.
+    from todo.models.rollup import LabRollup
+    LabRollup.__table__.create(conn, checkfirst=True)
+
+
+def _lab_table(conn, dialect):
+    # Populated on the first GET /labs, or with `flask api sync-labs`.
+    from todo.models.lab import Lab
+    Lab.__table__.create(conn, checkfirst=True)
+
+
+def _outbox_table(conn, dialect):
+    # Drained by the relay; see todo.relay.
+    from todo.models.outbox import OutboxMessage
+    OutboxMessage.__table__.create(conn, checkfirst=True)
+
+
+def _submission_key_table(conn, dialect):
+    from todo.models.submission_key import SubmissionKey
+    SubmissionKey.__table__.create(conn, checkfirst=True)
+
+
+def _todo_partitions(conn, dialect):
+    # Postgres only; elsewhere Todo stays a plain table and archival just
+    # deletes rows. See todo.models.partitions.
+    if dialect != "postgresql":
+        return
+    from todo.models.partitions import convert_to_partitioned
+    convert_to_partitioned(conn)
+
+
+# Applied in order, each at most once. Steps must be idempotent: they run in
+# autocommit mode, so a step that fails halfway is simply re-run.
+MIGRATIONS = [
+    ("0001_todo_composite_indexes", _todo_composite_indexes),
+    ("0002_lab_rollup_table", _lab_rollup_table),
+    ("0003_lab_table", _lab_table),
+    ("0004_outbox_table", _outbox_table),
+    ("0005_submission_key_table", _submission_key_table),
+    ("0006_todo_partitions", _todo_partitions),
+]
+
+
+def apply_migrations(engine):
+    """Apply pending migrations and return the names that ran."""
+    applied = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "name VARCHAR(100) PRIMARY KEY, applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        done = {row[0] for row in conn.execute(text("SELECT name FROM schema_migrations"))}
+        for name, step in MIGRATIONS:
+            if name in done:
+                continue
+            logger.info(f"Applying migration {name}")
+            step(conn, engine.dialect.name)
+            conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+            applied.append(name)
+    return applied
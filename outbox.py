@@ -0,0 +1,44 @@
+import datetime
+
+from . import db
+
+
+class OutboxMessage(db.Model):
+    """A task message waiting to be published to the broker.
+
+    Rows are written in the same transaction as the jobs they start, so a
+    committed job always has a message on its way; the relay (todo.relay)
+    publishes them and deletes the rows it has handed to the broker.
+    """
+    __tablename__ = 'Outbox'
+    __table_args__ = (
+        db.Index('ix_outbox_available_at', 'available_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    task = db.Column(db.String(100), nullable=False)
+    args = db.Column(db.JSON, nullable=False, default=list)
+    kwargs = db.Column(db.JSON, nullable=False, default=dict)
+    options = db.Column(db.JSON, nullable=False, default=dict)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f'<OutboxMessage id={self.id} task={self.task} attempts={self.attempts}>'
+
+
+def enqueue(task, args=(), kwargs=None, options=None):
+    """Add a task message to the caller's transaction; it is sent after commit."""
+    now = datetime.datetime.utcnow()
+    message = OutboxMessage(
+        task=task,
+        args=list(args),
+        kwargs=kwargs or {},
+        options=options or {},
+        created_at=now,
+        available_at=now,
+    )
+    db.session.add(message)
+    return message
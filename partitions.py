@@ -0,0 +1,164 @@
+"""Monthly range partitions of Todo on created_at (Postgres only).
+
+Partitions are named Todo_YYYY_MM and cover [first of month, first of next
+month). A DEFAULT partition catches rows outside every range, so an insert
+never fails because a partition was not created in time; run
+`flask api ensure-partitions` (or the archive job, which calls it) at least
+monthly to keep TODO_PARTITION_AHEAD_MONTHS of headroom.
+"""
+import os
+import logging
+import datetime
+
+from sqlalchemy import text # type: ignore
+
+logger = logging.getLogger(__name__)
+
+TODO_PARTITION_AHEAD_MONTHS = int(os.environ.get("TODO_PARTITION_AHEAD_MONTHS", "3"))
+DEFAULT_PARTITION = "Todo_default"
+
+
+def month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(timestamp):
+    return (month_start(timestamp) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month):
+    return f"Todo_{month:%Y_%m}"
+
+
+def months_between(first, last):
+    """Month starts from first's month through last's month, inclusive."""
+    month = month_start(first)
+    while month <= last:
+        yield month
+        month = next_month(month)
+
+
+def _partition_ddl(month, parent="Todo"):
+    return (f'CREATE TABLE IF NOT EXISTS "{partition_name(month)}" PARTITION OF "{parent}" '
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')")
+
+
+def _create_partition(conn, month):
+    """Create month's partition, first moving any of its rows out of DEFAULT.
+
+    Postgres refuses to create a partition while DEFAULT holds rows in its
+    range, which happens once a month was written before its partition
+    existed. DEFAULT is detached for the move and reattached after, all in
+    the caller's transaction; the detach locks Todo, so writers wait
+    rather than fail. Returns the number of rows moved.
+    """
+    name = partition_name(month)
+    if conn.execute(text("SELECT to_regclass(:name)"), {"name": f'"{name}"'}).scalar() is not None:
+        return 0
+    bounds = {"start": month, "end": next_month(month)}
+    in_range = "created_at >= :start AND created_at < :end"
+    stray = conn.execute(text(
+        f'SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE {in_range} LIMIT 1'), bounds).first()
+    if stray is None:
+        conn.execute(text(_partition_ddl(month)))
+        return 0
+    conn.execute(text(f'ALTER TABLE "Todo" DETACH PARTITION "{DEFAULT_PARTITION}"'))
+    conn.execute(text(_partition_ddl(month)))
+    moved = conn.execute(text(
+        f'INSERT INTO "Todo" SELECT * FROM "{DEFAULT_PARTITION}" WHERE {in_range}'), bounds).rowcount
+    conn.execute(text(f'DELETE FROM "{DEFAULT_PARTITION}" WHERE {in_range}'), bounds)
+    conn.execute(text(f'ALTER TABLE "Todo" ATTACH PARTITION "{DEFAULT_PARTITION}" DEFAULT'))
+    logger.warning(f"Moved {moved} rows from {DEFAULT_PARTITION} into new partition {name}")
+    return moved
+
+
+def is_partitioned(conn):
+    return bool(conn.execute(text(
+        "SELECT c.relkind = 'p' FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relname = 'Todo' AND n.nspname = current_schema()"
+    )).scalar())
+
+
+def convert_to_partitioned(conn, ahead=TODO_PARTITION_AHEAD_MONTHS):
+    """Rebuild a plain Todo table as a partitioned one, copying every row.
+
+    Sent as one multi-statement query, which Postgres runs as a single
+    transaction: either the swap happens or nothing changes. Writers are
+    blocked for the duration of the copy.
+
+    The primary key becomes (request_id, created_at), since Postgres only
+    enforces uniqueness per partition when the key includes the partition
+    column. request_ids are server-generated UUIDs, so that loses nothing.
+    """
+    if is_partitioned(conn):
+        return
+    now = datetime.datetime.utcnow()
+    oldest = conn.execute(text('SELECT min(created_at) FROM "Todo"')).scalar() or now
+    last = month_start(now)
+    for _ in range(ahead):
+        last = next_month(last)
+    statements = [
+        'LOCK TABLE "Todo" IN ACCESS EXCLUSIVE MODE',
+        'CREATE TABLE "Todo_new" (LIKE "Todo" INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)',
+        f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF "Todo_new" DEFAULT',
+    ]
+    statements += [_partition_ddl(month, "Todo_new") for month in months_between(oldest, last)]
+    statements += [
+        'INSERT INTO "Todo_new" SELECT * FROM "Todo"',
+        'DROP TABLE "Todo"',
+        'ALTER TABLE "Todo_new" RENAME TO "Todo"',
+        'ALTER TABLE "Todo" ADD PRIMARY KEY (request_id, created_at)',
+        'CREATE INDEX ix_todo_lab_id_created_at ON "Todo" (lab_id, created_at)',
+        'CREATE INDEX ix_todo_patient_id_created_at ON "Todo" (patient_id, created_at)',
+    ]
+    conn.execute(text(";\n".join(statements)))
+
+
+def ensure_partitions(conn, ahead=TODO_PARTITION_AHEAD_MONTHS):
+    """Create partitions from this month through `ahead` months out. Returns the names checked.
+
+    Earlier months whose rows ended up in DEFAULT (the job lapsed) get
+    their partitions too, and those rows are moved into them.
+    """
+    if conn.dialect.name != "postgresql" or not is_partitioned(conn):
+        return []
+    now = datetime.datetime.utcnow()
+    last = month_start(now)
+    for _ in range(ahead):
+        last = next_month(last)
+    stray = conn.execute(text(f'SELECT min(created_at) FROM "{DEFAULT_PARTITION}"')).scalar()
+    first = min(now, stray) if stray is not None else now
+    names = []
+    for month in months_between(first, last):
+        _create_partition(conn, month)
+        names.append(partition_name(month))
+    return names
+
+
+def drop_empty_partitions(conn, before):
+    """Drop month partitions that end on or before `before` and hold no rows.
+
+    The archive job empties them; anything still there (jobs pending since
+    then) keeps its partition alive. Returns the names dropped.
+    """
+    if conn.dialect.name != "postgresql" or not is_partitioned(conn):
+        return []
+    children = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'Todo' AND c.relname <> :default ORDER BY c.relname"
+    ), {"default": DEFAULT_PARTITION}).scalars().all()
+    dropped = []
+    for name in children:
+        try:
+            month = datetime.datetime.strptime(name, "Todo_%Y_%m")
+        except ValueError:
+            continue
+        if next_month(month) > before:
+            continue
+        if conn.execute(text(f'SELECT 1 FROM "{name}" LIMIT 1')).first() is not None:
+            continue
+        conn.execute(text(f'ALTER TABLE "Todo" DETACH PARTITION "{name}"'))
+        conn.execute(text(f'DROP TABLE "{name}"'))
+        dropped.append(name)
+    return dropped
@@ -0,0 +1,119 @@
+import os
+import logging
+import datetime
+
+from sqlalchemy import tuple_ # type: ignore
+from todo.models import db, rollup
+from todo.models import lab as lab_model
+from todo.models.todo import Todo
+from todo.job_cache import JOB_FIELDS, job_cache, cached_job
+from todo.events import publish_message
+from todo.serialize import stamp
+
+logger = logging.getLogger(__name__)
+
+# Rows locked, updated and committed together
+REASSIGN_BATCH_SIZE = int(os.environ.get("REASSIGN_BATCH_SIZE", "500"))
+# Jobs moved per request; a filter matching more reports has_more
+MAX_REASSIGN_JOBS = int(os.environ.get("MAX_REASSIGN_JOBS", "10000"))
+
+COLUMNS = tuple(getattr(Todo, field) for field in JOB_FIELDS)
+
+
+def _move(rows, lab_id):
+    """Reassign locked rows to lab_id in the caller's transaction; returns their new snapshots."""
+    now = datetime.datetime.utcnow()
+    ids = [row.request_id for row in rows]
+    # The created_at bounds let Postgres skip partitions the batch is not in
+    (db.session.query(Todo)
+     .filter(Todo.request_id.in_(ids),
+             Todo.created_at >= min(row.created_at for row in rows),
+             Todo.created_at <= max(row.created_at for row in rows))
+     .update({Todo.lab_id: lab_id, Todo.updated_at: now}, synchronize_session=False))
+    rollup.record_reassignments(rows, lab_id)
+    lab_model.record_reassignments(rows, lab_id, now)
+    return [cached_job(row, lab_id=lab_id, updated_at=now) for row in rows]
+
+
+def _announce(jobs):
+    for job in jobs:
+        job_cache.put(job)
+        publish_message(dict(job._asdict(), created_at=stamp(job.created_at), updated_at=stamp(job.updated_at)))
+
+
+def reassign_ids(request_ids, lab_id, batch_size=REASSIGN_BATCH_SIZE):
+    """Move the listed jobs to lab_id, one transaction per batch.
+
+    Returns counts: reassigned, unchanged (already on lab_id) and the ids
+    not found. Batches already committed stay committed if a later one fails.
+    """
+    reassigned = unchanged = 0
+    not_found = []
+    request_ids = list(dict.fromkeys(request_ids))
+    for index in range(0, len(request_ids), batch_size):
+        chunk = request_ids[index:index + batch_size]
+        try:
+            rows = (db.session.query(*COLUMNS)
+                    .filter(Todo.request_id.in_(chunk))
+                    .order_by(Todo.created_at.asc(), Todo.request_id.asc())
+                    .with_for_update()
+                    .all())
+            found = {row.request_id for row in rows}
+            not_found.extend(request_id for request_id in chunk if request_id not in found)
+            rows = [row for row in rows if row.lab_id != lab_id]
+            unchanged += len(found) - len(rows)
+            moved = _move(rows, lab_id) if rows else []
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        reassigned += len(moved)
+        _announce(moved)
+    return {"reassigned": reassigned, "unchanged": unchanged, "not_found": not_found}
+
+
+def reassign_matching(lab_id, from_lab_id, status=None, start=None, end=None, urgent=None,
+                      batch_size=REASSIGN_BATCH_SIZE, limit=MAX_REASSIGN_JOBS):
+    """Move up to `limit` jobs on from_lab_id matching the filters to lab_id.
+
+    Walks the (lab_id, created_at) index in keyset batches; each batch is
+    locked, updated with one UPDATE and committed with its counter changes.
+    Returns counts and whether more matching jobs are left.
+    """
+    reassigned = 0
+    position = None
+    has_more = False
+    while True:
+        query = db.session.query(*COLUMNS).filter(Todo.lab_id == from_lab_id)
+        if status:
+            query = query.filter(Todo.result == status)
+        if start:
+            query = query.filter(Todo.created_at >= start)
+        if end:
+            query = query.filter(Todo.created_at <= end)
+        if urgent is not None:
+            query = query.filter(Todo.urgent == urgent)
+        if position is not None:
+            query = query.filter(tuple_(Todo.created_at, Todo.request_id) > tuple_(*position))
+        size = min(batch_size, limit - reassigned)
+        if size <= 0:
+            has_more = query.first() is not None
+            db.session.rollback()
+            break
+        try:
+            rows = (query.order_by(Todo.created_at.asc(), Todo.request_id.asc())
+                    .limit(size)
+                    .with_for_update()
+                    .all())
+            moved = _move(rows, lab_id) if rows else []
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if not rows:
+            break
+        reassigned += len(moved)
+        position = (rows[-1].created_at, rows[-1].request_id)
+        _announce(moved)
+        logger.info(f"Reassigned {len(moved)} jobs from {from_lab_id} to {lab_id}")
+    return {"reassigned": reassigned, "has_more": has_more}
@@ -0,0 +1,147 @@
+import os
+import time
+import datetime
+import threading
+import logging
+
+from todo.metrics import stats_gauge, timed
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_MAX_BACKOFF = float(os.environ.get("OUTBOX_MAX_BACKOFF", "60"))
+# Run the relay as a thread inside each API process. Turn off when running
+# `flask api relay-outbox` as its own service instead.
+OUTBOX_RELAY_IN_PROCESS = os.environ.get("OUTBOX_RELAY_IN_PROCESS", "true").lower() in ("1", "true", "yes")
+
+
+class OutboxRelay:
+    """Publishes committed outbox rows to the broker.
+
+    Each pass claims up to batch_size due rows with SELECT ... FOR UPDATE
+    SKIP LOCKED, so any number of relays (one per API process, or the CLI)
+    can run side by side without sending a row twice. Published rows are
+    deleted in the same transaction; a row whose publish fails is pushed
+    back with exponential backoff and retried. Delivery is at-least-once:
+    a crash between publishing and committing re-sends that batch.
+    """
+
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 max_backoff=OUTBOX_MAX_BACKOFF):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.published = 0
+        self.failures = 0
+        self.passes = 0
+
+    def start(self, app):
+        """Start the background relay thread for this process (once per pid)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self.run, args=(app,), name="outbox-relay", daemon=True).start()
+
+    def notify(self):
+        """Wake the relay thread now rather than at its next poll."""
+        self._wakeup.set()
+
+    def run(self, app):
+        while True:
+            self._wakeup.wait(timeout=self.poll_interval)
+            self._wakeup.clear()
+            try:
+                with app.app_context():
+                    # Keep going while passes come back full
+                    while self.relay_once() >= self.batch_size:
+                        pass
+            except Exception as e:
+                logger.error(f"Outbox relay pass failed: {e}")
+
+    def relay_once(self):
+        """Publish one batch of due rows. Returns the number published."""
+        from todo.models import db
+        from todo.models.outbox import OutboxMessage
+        from todo.tasks.ical import celery
+
+        now = datetime.datetime.utcnow()
+        try:
+            rows = (OutboxMessage.query
+                    .filter(OutboxMessage.available_at <= now)
+                    .order_by(OutboxMessage.id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                    .all())
+            if not rows:
+                db.session.rollback()
+                return 0
+            sent = []
+            # One producer connection for the whole batch
+            with timed("enqueue_publish"), celery.producer_or_acquire() as producer:
+                for row in rows:
+                    try:
+                        celery.send_task(row.task, args=row.args, kwargs=row.kwargs,
+                                         producer=producer, **row.options)
+                    except Exception as e:
+                        row.attempts += 1
+                        row.last_error = str(e)
+                        backoff = min(2 ** row.attempts, self.max_backoff)
+                        row.available_at = now + datetime.timedelta(seconds=backoff)
+                        self.failures += 1
+                        logger.warning(f"Publishing outbox row {row.id} failed "
+                                       f"(attempt {row.attempts}), retrying in {backoff:.0f}s: {e}")
+                        # The broker is likely down; leave the rest for the next pass
+                        break
+                    sent.append(row.id)
+            if sent:
+                (db.session.query(OutboxMessage)
+                 .filter(OutboxMessage.id.in_(sent))
+                 .delete(synchronize_session=False))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.passes += 1
+        self.published += len(sent)
+        return len(sent)
+
+    def stats(self):
+        from todo.models import db
+        from todo.models.outbox import OutboxMessage
+
+        pending, oldest = db.session.query(
+            db.func.count(OutboxMessage.id), db.func.min(OutboxMessage.created_at)).one()
+        return {
+            "pending": pending,
+            "oldest_age_seconds": (datetime.datetime.utcnow() - oldest).total_seconds() if oldest else 0.0,
+            "published": self.published,
+            "failures": self.failures,
+            "passes": self.passes,
+        }
+
+
+outbox_relay = OutboxRelay()
+# Counters only: the pending count needs a DB query, see OutboxRelay.stats()
+stats_gauge("coughoverflow_outbox_relay", "Outbox messages published by this process.", lambda: {
+    "published": outbox_relay.published, "failures": outbox_relay.failures, "passes": outbox_relay.passes})
+
+
+def relay_forever(app):
+    """Blocking loop for a dedicated relay process."""
+    logger.info(f"Outbox relay started (batch {outbox_relay.batch_size}, poll {outbox_relay.poll_interval}s)")
+    while True:
+        try:
+            with app.app_context():
+                published = outbox_relay.relay_once()
+        except Exception as e:
+            logger.error(f"Outbox relay pass failed: {e}")
+            published = 0
+        if published < outbox_relay.batch_size:
+            time.sleep(outbox_relay.poll_interval)
@@ -0,0 +1,138 @@
+"""Route read-only endpoints to a replica database.
+
+Set SQLALCHEMY_REPLICA_URI to enable. Any second database with the same
+schema works as a stand-in when trying this locally, e.g. two SQLite files
+(copy the primary's file to the replica's path) or two Postgres instances.
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g # type: ignore
+from sqlalchemy import create_engine, text # type: ignore
+from todo.models import engine_options
+from todo.metrics import stats_gauge
+
+logger = logging.getLogger(__name__)
+
+SQLALCHEMY_REPLICA_URI = os.environ.get("SQLALCHEMY_REPLICA_URI", "")
+# Default tolerance for endpoints that do not pass their own max_lag.
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", "5"))
+# How long a lag reading (or a failed replica check) is reused.
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get("REPLICA_LAG_CHECK_INTERVAL", "1"))
+
+# Seconds the replica is behind. Zero when caught up, when the server is not
+# in recovery (e.g. a second instance standing in for a replica locally), and
+# when primary is idle (the replay timestamp stands still while nothing is
+# written).
+POSTGRES_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+class ReplicaRouter:
+    """Per-app replica engine plus a cached reading of its replication lag."""
+
+    def __init__(self, uri=SQLALCHEMY_REPLICA_URI, check_interval=REPLICA_LAG_CHECK_INTERVAL):
+        self.uri = uri
+        self.check_interval = check_interval
+        self._engines = {}
+        self._lag = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.replica_reads = 0
+        self.primary_fallbacks = 0
+
+    @property
+    def enabled(self):
+        return bool(self.uri)
+
+    def engine(self, app):
+        key = (id(app), os.getpid())
+        engine = self._engines.get(key)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(key)
+                if engine is None:
+                    engine = self._engines[key] = create_engine(self.uri, **engine_options())
+        return engine
+
+    def lag(self, engine):
+        """Replication lag in seconds, or None if the replica cannot be reached."""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._lag
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return self._lag
+            try:
+                if engine.dialect.name == "postgresql":
+                    with engine.connect() as conn:
+                        self._lag = float(conn.execute(text(POSTGRES_LAG_SQL)).scalar() or 0)
+                else:
+                    with engine.connect() as conn:
+                        conn.execute(text("SELECT 1"))
+                    self._lag = 0.0
+            except Exception as e:
+                logger.warning(f"Replica unavailable, reading from primary: {e}")
+                self._lag = None
+            self._checked_at = now
+            return self._lag
+
+    def choose(self, max_lag):
+        """The engine reads should use for this request, or None for the primary."""
+        if not self.enabled:
+            return None
+        engine = self.engine(current_app._get_current_object())
+        lag = self.lag(engine)
+        if lag is None or lag > max_lag:
+            self.primary_fallbacks += 1
+            return None
+        self.replica_reads += 1
+        return engine
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "lag_seconds": self._lag,
+            "replica_reads": self.replica_reads,
+            "primary_fallbacks": self.primary_fallbacks,
+        }
+
+
+replica_router = ReplicaRouter()
+stats_gauge("coughoverflow_replica", "Replica lag and read routing decisions.", replica_router.stats)
+
+
+def read_only(max_lag=REPLICA_MAX_LAG):
+    """Serve the decorated endpoint's reads from the replica while it is within max_lag seconds."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Lives on g, so it also covers streamed bodies read after return
+            g.db_read_engine = replica_router.choose(max_lag)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside a read_only endpoint, e.g. to confirm a miss."""
+    engine = g.get("db_read_engine")
+    g.db_read_engine = None
+    try:
+        yield
+    finally:
+        g.db_read_engine = engine
+
+
+def on_replica():
+    return g.get("db_read_engine") is not None
@@ -0,0 +1,195 @@
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import func, case, or_, and_, insert as sa_insert, text # type: ignore
+from . import db, dialect_insert
+from .todo import Todo, VALID_RESULTS
+
+BUCKET = datetime.timedelta(hours=1)
+COUNTERS = tuple(sorted(VALID_RESULTS)) + ("urgent",)
+
+
+def bucket_for(timestamp):
+    """Start of the hourly bucket a job created at `timestamp` is counted in."""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class LabRollup(db.Model):
+    """Per-lab, per-hour job counters, kept in step with Todo by every writer.
+
+    Jobs are counted in the bucket of their created_at, the column the
+    summary endpoint filters on, so a verdict moves a count between status
+    columns of the same row.
+    """
+    __tablename__ = 'LabRollup'
+
+    lab_id = db.Column(db.String(50), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    pending = db.Column(db.Integer, nullable=False, default=0)
+    covid = db.Column(db.Integer, nullable=False, default=0)
+    h5n1 = db.Column(db.Integer, nullable=False, default=0)
+    healthy = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    urgent = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<LabRollup lab_id={self.lab_id} bucket={self.bucket}>'
+
+
+def apply_deltas(deltas):
+    """Upsert {(lab_id, bucket): {counter: delta}} into the caller's transaction."""
+    for (lab_id, bucket), changes in deltas.items():
+        changes = {name: delta for name, delta in changes.items() if delta}
+        if not changes:
+            continue
+        values = {name: 0 for name in COUNTERS}
+        values.update(changes, lab_id=lab_id, bucket=bucket)
+        stmt = dialect_insert(LabRollup).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[LabRollup.lab_id, LabRollup.bucket],
+            set_={name: getattr(LabRollup, name) + getattr(stmt.excluded, name) for name in changes},
+        )
+        db.session.execute(stmt)
+
+
+def record_submissions(jobs):
+    """Count newly created pending jobs."""
+    deltas = defaultdict(lambda: defaultdict(int))
+    for job in jobs:
+        counters = deltas[(job.lab_id, bucket_for(job.created_at))]
+        counters[job.result] += 1
+        counters["urgent"] += int(bool(job.urgent))
+    apply_deltas(deltas)
+
+
+def record_transition(job, old_result):
+    """Move a job's count from old_result to its current result."""
+    if old_result == job.result:
+        return
+    apply_deltas({(job.lab_id, bucket_for(job.created_at)): {old_result: -1, job.result: 1}})
+
+
+def record_reassignment(job, old_lab_id):
+    """Move a job's counts from old_lab_id to its current lab."""
+    if old_lab_id == job.lab_id:
+        return
+    bucket = bucket_for(job.created_at)
+    urgent = int(bool(job.urgent))
+    apply_deltas({
+        (old_lab_id, bucket): {job.result: -1, "urgent": -urgent},
+        (job.lab_id, bucket): {job.result: 1, "urgent": urgent},
+    })
+
+
+def record_reassignments(jobs, lab_id):
+    """Move the counts of jobs (read before the change) from their labs to lab_id."""
+    deltas = defaultdict(lambda: defaultdict(int))
+    for job in jobs:
+        if job.lab_id == lab_id:
+            continue
+        bucket = bucket_for(job.created_at)
+        urgent = int(bool(job.urgent))
+        deltas[(job.lab_id, bucket)][job.result] -= 1
+        deltas[(job.lab_id, bucket)]["urgent"] -= urgent
+        deltas[(lab_id, bucket)][job.result] += 1
+        deltas[(lab_id, bucket)]["urgent"] += urgent
+    apply_deltas(deltas)
+
+
+def _ceil_bucket(timestamp):
+    floor = bucket_for(timestamp)
+    return floor if floor == timestamp else floor + BUCKET
+
+
+def summarise(lab_id, start=None, end=None):
+    """Counts per status plus urgent for lab_id with created_at in [start, end].
+
+    Whole hours come from LabRollup in one aggregate read. When start/end
+    fall inside an hour, the rows in those partial hours (at most two hours'
+    worth, via the (lab_id, created_at) index) are counted from Todo.
+    """
+    lo = _ceil_bucket(start) if start else None
+    hi = bucket_for(end) if end else None
+    totals = dict.fromkeys(COUNTERS, 0)
+
+    if lo is None or hi is None or lo < hi:
+        query = db.session.query(*[func.coalesce(func.sum(getattr(LabRollup, name)), 0) for name in COUNTERS])
+        query = query.filter(LabRollup.lab_id == lab_id)
+        if lo is not None:
+            query = query.filter(LabRollup.bucket >= lo)
+        if hi is not None:
+            query = query.filter(LabRollup.bucket < hi)
+        for name, value in zip(COUNTERS, query.one()):
+            totals[name] += int(value)
+        edges = []
+        if start is not None and start < lo:
+            edges.append(and_(Todo.created_at >= start, Todo.created_at < lo))
+        if end is not None:
+            edges.append(and_(Todo.created_at >= hi, Todo.created_at <= end))
+    else:
+        # The whole range sits inside one hour
+        edges = [and_(Todo.created_at >= start, Todo.created_at <= end)]
+
+    if edges:
+        rows = (db.session.query(Todo.result, func.count(), func.sum(case((Todo.urgent, 1), else_=0)))
+                .filter(Todo.lab_id == lab_id, or_(*edges))
+                .group_by(Todo.result))
+        for result, count, urgent in rows:
+            totals[result] = totals.get(result, 0) + count
+            totals["urgent"] += int(urgent or 0)
+    return totals
+
+
+def submissions_since(bucket):
+    """(jobs, urgent jobs) created from `bucket` on, over every lab."""
+    jobs = sum(getattr(LabRollup, name) for name in COUNTERS[:-1])
+    total, urgent = (db.session.query(func.coalesce(func.sum(jobs), 0),
+                                      func.coalesce(func.sum(LabRollup.urgent), 0))
+                     .filter(LabRollup.bucket >= bucket)
+                     .one())
+    return int(total), int(urgent)
+
+
+def lab_has_rollups(lab_id):
+    return db.session.query(LabRollup.lab_id).filter_by(lab_id=lab_id).first() is not None
+
+
+def rebuild(chunk_size=1000, since=None):
+    """Recompute LabRollup from Todo in one transaction and return the row count.
+
+    With since (an hour boundary), only buckets from then on are rebuilt;
+    pass the archive horizon so counts for archived jobs are kept.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        # Block writers so no job is counted twice or missed mid-rebuild
+        db.session.execute(text('LOCK TABLE "Todo" IN SHARE MODE'))
+        bucket = func.date_trunc('hour', Todo.created_at)
+    else:
+        bucket = func.strftime('%Y-%m-%d %H:00:00', Todo.created_at)
+
+    columns = [func.sum(case((Todo.result == name, 1), else_=0)) for name in COUNTERS[:-1]]
+    columns.append(func.sum(case((Todo.urgent, 1), else_=0)))
+    grouped = db.session.query(Todo.lab_id, bucket, *columns)
+    stale = db.session.query(LabRollup)
+    if since is not None:
+        grouped = grouped.filter(Todo.created_at >= since)
+        stale = stale.filter(LabRollup.bucket >= since)
+    grouped = grouped.group_by(Todo.lab_id, bucket).all()
+
+    stale.delete()
+    rows = []
+    count = 0
+    for lab_id, bucket_value, *counts in grouped:
+        if isinstance(bucket_value, str):
+            bucket_value = datetime.datetime.fromisoformat(bucket_value)
+        rows.append(dict(zip(COUNTERS, (int(c) for c in counts)), lab_id=lab_id, bucket=bucket_value))
+        if len(rows) >= chunk_size:
+            db.session.execute(sa_insert(LabRollup), rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        db.session.execute(sa_insert(LabRollup), rows)
+        count += len(rows)
+    db.session.commit()
+    return count
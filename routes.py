@@ -1,61 +1,176 @@
-from email import parser
-from flask import Blueprint, jsonify, request # type: ignore
+from flask import Blueprint, current_app, jsonify, request, stream_with_context # type: ignore
 from todo.models import db
 from todo.models.todo import Todo
+from todo.models import rollup
+from todo.models import lab as lab_model
+from todo.models.lab import Lab
+from todo.models import outbox
+from todo.models import submission_key
+from todo.labs import lab_registry
+from todo.events import event_bus, job_channel, lab_channel, publish_job
+from todo.export import export_format, stream_export, MIMETYPES as EXPORT_FORMATS
+from todo.job_cache import job_cache
+from todo.archive import archive_store, archive_results, merge_rows
+from todo.models.partitions import ensure_partitions
+from todo.serialize import (JOB_COLUMNS, FINISHED_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL,
+                            conditional_json, job_etag, stamp)
+from todo.migrations import apply_migrations
+from todo.scheduling import submission_options
+from todo.staging import blob_store, iter_chunks, BlobTooLarge
+from todo.replica import read_only, primary, on_replica
+from todo import metrics
+from todo.metrics import Counter, timed
+from todo.relay import outbox_relay, relay_forever, OUTBOX_RELAY_IN_PROCESS
+from todo.backlog import monitor_forever
+from todo.reassign import reassign_ids, reassign_matching, MAX_REASSIGN_JOBS
+from todo.admission import admission
 import subprocess
 import base64
+import binascii
+import json
 import uuid
 import os
 import re
+import time
 
-import csv
-import requests # type: ignore
 import logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__) 
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+from itertools import islice
+from sqlalchemy import tuple_ # type: ignore
+from sqlalchemy.exc import IntegrityError # type: ignore
 
 api = Blueprint('api', __name__, url_prefix='/api/v1')
 
-def get_valid_lab_ids():
-    url = "https://csse6400.uqcloud.net/resources/labs.csv"
-    response = requests.get(url)
-    
-    if response.status_code != 200:
-        raise Exception("Failed to fetch lab data from the URL")
-    
-    valid_lab_ids = set()
-    
-    
-    cleaned_text = response.text.lstrip('\ufeff')
-    
-    csv_reader = csv.reader(cleaned_text.splitlines())
-    
-    for row in csv_reader:
-        if row:
-            lab_id = row[0].strip()  
-            valid_lab_ids.add(lab_id)
-    
-    return valid_lab_ids
-
-VALID_LABS = get_valid_lab_ids()
+# Warm the shared registry at import: loads the on-disk snapshot and starts
+# the background refresher, so request handlers never fetch labs.csv.
+lab_registry.start()
 
 
 @api.route('/health')
 def health():
     return jsonify({"status": "ok"})
 
+@api.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target for this API process."""
+    return current_app.response_class(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
 from celery.result import AsyncResult # type: ignore
 from todo.tasks import ical
 from todo.tasks.ical import ical
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+
+submissions = Counter(
+    "coughoverflow_submissions_total",
+    "Jobs accepted by the API, by job class.",
+    labels=("job_class",),
+)
+submissions_collapsed = Counter(
+    "coughoverflow_submissions_collapsed_total",
+    "Submissions answered with an identical job already in flight.",
+)
+
+@api.before_app_request
+def _start_relay():
+    """Start this process's relay on its first request, health checks included.
+
+    Rows committed before a restart are then published without waiting for
+    new submissions. Celery workers and CLI commands build the app too but
+    serve no requests, so they never start one.
+    """
+    if OUTBOX_RELAY_IN_PROCESS:
+        outbox_relay.start(current_app._get_current_object())
+
+
+def _wake_relay():
+    """Have this process's relay publish the outbox rows just committed."""
+    if OUTBOX_RELAY_IN_PROCESS:
+        outbox_relay.start(current_app._get_current_object())
+        outbox_relay.notify()
+
+
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+RAW_IMAGE_TYPES = {"image/jpeg", "image/png", "application/octet-stream"}
+
+
+def _stage_upload():
+    """Stage the submitted image and return (blob_key, checksum, error_response).
+
+    Raw image bodies and multipart uploads are streamed to staging in chunks,
+    so memory use does not depend on image size. The JSON/base64 form is
+    kept for existing clients.
+    """
+    if request.content_length is not None and request.content_length > MAX_IMAGE_BYTES * 4 // 3 + 1024:
+        raise BlobTooLarge(f"Upload exceeds {MAX_IMAGE_BYTES} bytes")
+
+    content_type = (request.mimetype or "").lower()
+    if content_type in RAW_IMAGE_TYPES:
+        blob_key, checksum = blob_store.put_stream(iter_chunks(request.stream), MAX_IMAGE_BYTES)
+    elif content_type == "multipart/form-data":
+        # Werkzeug spools file parts to disk past a small threshold.
+        upload = request.files.get('image')
+        if upload is None:
+            return None, None, (jsonify({'error': 'Missing image in request body'}), 400)
+        extra_keys = [key for key in list(request.files) + list(request.form) if key != 'image']
+        if extra_keys:
+            return None, None, (jsonify({
+                "error": "invalid_request",
+                "detail": f"Unexpected field(s) in request body: {', '.join(extra_keys)}. Only 'image' is allowed."
+            }), 400)
+        blob_key, checksum = blob_store.put_stream(iter_chunks(upload.stream), MAX_IMAGE_BYTES)
+    else:
+        if not request.is_json:
+            return None, None, (jsonify({'error': 'Request must be JSON'}), 400)
+
+        if not request.json or 'image' not in request.json:
+            return None, None, (jsonify({'error': 'Missing image in request body'}), 400)
+
+        valid_body_keys = {'image'}
+        extra_keys = [key for key in request.json.keys() if key not in valid_body_keys]
+        if extra_keys:
+            return None, None, (jsonify({
+                "error": "invalid_request",
+                "detail": f"Unexpected key(s) in request body: {', '.join(extra_keys)}. Only 'image' is allowed."
+            }), 400)
+
+        try:
+            image_data = base64.b64decode(request.json['image'], validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            return None, None, (jsonify({
+                "error": "invalid_request",
+                "detail": "The 'image' field must be base64-encoded."
+            }), 400)
+        if len(image_data) > MAX_IMAGE_BYTES:
+            raise BlobTooLarge(f"Upload exceeds {MAX_IMAGE_BYTES} bytes")
+        blob_key, checksum = blob_store.put(image_data)
+
+    if os.path.getsize(blob_store.path(blob_key)) == 0:
+        blob_store.delete(blob_key)
+        return None, None, (jsonify({'error': 'Missing image in request body'}), 400)
+    return blob_key, checksum, None
+
+
+def _not_admitted(decision):
+    """429 for a submission refused by admission control, 413 if it can never be admitted."""
+    if decision.reason == 'too_large':
+        return jsonify({
+            'error': decision.reason,
+            'detail': 'Too many samples for one lab in a single request; split the batch.'
+        }), 413
+    detail = ('The service is overloaded; retry later.' if decision.reason == 'overloaded'
+              else 'Submission rate limit exceeded; retry later.')
+    response = jsonify({'error': decision.reason, 'detail': detail})
+    response.headers['Retry-After'] = str(decision.retry_after)
+    return response, 429
+
 
 @api.route('/analysis', methods=['POST'])
 def analyze_image():
     """Validate and initiate image analysis for pathogen markers using Celery."""
- 
+    validation_started = time.perf_counter()
 
     data = request.args
 
@@ -68,7 +183,7 @@ def analyze_image():
     lab_id = data.get('lab_id')
     patient_id = data.get('patient_id')
 
-    if lab_id not in get_valid_lab_ids():
+    if lab_id not in lab_registry:
         return jsonify({'error': 'invalid_lab_id'}), 400
 
     if not (patient_id.isnumeric() and len(patient_id) == 11):
@@ -81,26 +196,52 @@ def analyze_image():
 
     urgent = request.args.get('urgent', 'false').lower() == 'true'
 
-    if not request.is_json:
-        return jsonify({'error': 'Request must be JSON'}), 400
-
-    if not request.json or 'image' not in request.json:
-        return jsonify({'error': 'Missing image in request body'}), 400
-
-    valid_body_keys = {'image'}
-    extra_keys = [key for key in request.json.keys() if key not in valid_body_keys]
-    if extra_keys:
+    # A client retry with the same Idempotency-Key gets the original job back
+    # before the upload is even staged.
+    keys = []
+    client_key = request.headers.get('Idempotency-Key')
+    if client_key is not None:
+        if not client_key or len(client_key) > 200:
+            return jsonify({'error': 'invalid_idempotency_key'}), 400
+        key = submission_key.idempotency_key(lab_id, client_key)
+        existing = submission_key.find_job(key)
+        if existing is not None:
+            return _existing_submission(existing, patient_id, 'Idempotent-Replayed')
+        keys.append((key, submission_key.IDEMPOTENCY_TTL))
+    metrics.stage_seconds.observe(time.perf_counter() - validation_started, "validation")
+
+    # Replays above are free; new work has to get past admission control.
+    decision = admission.admit({lab_id: 1}, urgent)
+    if not decision.admitted:
+        return _not_admitted(decision)
+
+    # Stage the image bytes once; the broker message only carries the key.
+    try:
+        with timed("stage_upload"):
+            blob_key, checksum, error = _stage_upload()
+    except BlobTooLarge:
         return jsonify({
             "error": "invalid_request",
-            "detail": f"Unexpected key(s) in request body: {', '.join(extra_keys)}. Only 'image' is allowed."
-        }), 400
+            "detail": f"Image exceeds the {MAX_IMAGE_BYTES} byte limit."
+        }), 413
+    if error is not None:
+        return error
+
+    if submission_key.COLLAPSE_DUPLICATES:
+        key = submission_key.content_key(patient_id, checksum)
+        existing = submission_key.find_job(key, pending_only=True)
+        # An urgent sample never joins a batch job; it would lose its priority
+        if existing is not None and (existing.urgent or not urgent):
+            blob_store.delete(blob_key)
+            submission_key.remember(existing, keys)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+            submissions_collapsed.inc()
+            return _existing_submission(existing, patient_id, 'Submission-Collapsed')
+        keys.append((key, submission_key.COLLAPSE_TTL))
 
-    image_base64 = request.json['image']
-
-    #try:
-    # request_id = str(uuid.uuid4())
-        # Create the database entry first with status 'pending' and generate the request_id
-       
     new_job = Todo(
                 request_id=str(uuid.uuid4()),
                 patient_id=patient_id,
@@ -110,14 +251,33 @@ def analyze_image():
                 created_at=datetime.utcnow(),
                 updated_at=datetime.utcnow()
             )
-    db.session.add(new_job)
-    db.session.commit()
-    queue_name = "urgentqueue" if urgent else "celerytaskqueue"
-    task = ical.apply_async(
-    args=(patient_id, lab_id, image_base64, urgent, new_job.request_id),
-    queue=queue_name,
-   
-)
+    # The task message commits with the job and is published by the relay,
+    # so the response waits on one DB commit and never on the broker.
+    with timed("enqueue"):
+        outbox.enqueue(
+            ical.name,
+            args=(patient_id, lab_id, None, urgent, new_job.request_id),
+            kwargs={"blob_key": blob_key, "checksum": checksum},
+            options=submission_options(urgent),
+        )
+    try:
+        with timed("db_insert"):
+            db.session.add(new_job)
+            rollup.record_submissions([new_job])
+            lab_model.record_activity([new_job])
+            submission_key.remember(new_job, keys)
+            db.session.commit()
+    except IntegrityError:
+        # A concurrent request claimed one of our keys first; answer with its job
+        db.session.rollback()
+        blob_store.delete(blob_key)
+        for key, _ in keys:
+            existing = submission_key.find_job(key)
+            if existing is not None:
+                return _existing_submission(existing, patient_id, 'Idempotent-Replayed')
+        raise
+    submissions.inc("urgent" if urgent else "batch")
+    _wake_relay()
 
 
     return jsonify({
@@ -130,6 +290,161 @@ def analyze_image():
 
 
 
+def _existing_submission(job, patient_id, header):
+    """The 201 body of an earlier submission, returned for a retry or a duplicate."""
+    if job.patient_id != patient_id:
+        return jsonify({
+            'error': 'idempotency_key_reused',
+            'detail': 'This Idempotency-Key was already used for a different patient.'
+        }), 422
+    return jsonify({
+        "id": job.request_id,
+        "created_at": job.created_at.replace(microsecond=0).isoformat() + "Z",
+        "updated_at": job.updated_at.replace(microsecond=0).isoformat() + "Z",
+        "status": job.result
+    }), 201, {header: 'true'}
+
+
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "500"))
+
+
+def _parse_batch_body():
+    """Return the list of samples from a JSON array or NDJSON body."""
+    content_type = (request.mimetype or "").lower()
+    if content_type in ("application/x-ndjson", "application/ndjson"):
+        items = []
+        for line in request.get_data(cache=False).splitlines():
+            if line.strip():
+                items.append(json.loads(line))
+        return items
+    if not request.is_json:
+        raise ValueError("Request must be a JSON array or NDJSON")
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise ValueError("Request body must be a JSON array of samples")
+    return items
+
+
+def _validate_sample(item):
+    """Validate one batch sample and return an error code, or None."""
+    if not isinstance(item, dict):
+        return 'invalid_request'
+    extra_keys = set(item) - {'patient_id', 'lab_id', 'image', 'urgent'}
+    if extra_keys:
+        return 'invalid_request'
+    if 'patient_id' not in item:
+        return 'missing_patient_id'
+    if 'lab_id' not in item:
+        return 'missing_lab_id'
+    if item['lab_id'] not in lab_registry:
+        return 'invalid_lab_id'
+    patient_id = item['patient_id']
+    if not (isinstance(patient_id, str) and patient_id.isnumeric() and len(patient_id) == 11):
+        return 'invalid_patient_id'
+    if not isinstance(item.get('urgent', False), bool):
+        return 'invalid_urgent'
+    if not isinstance(item.get('image'), str):
+        return 'missing_image'
+    return None
+
+
+@api.route('/analysis/batch', methods=['POST'])
+def analyze_image_batch():
+    """Submit many samples in one request: one transaction, one grouped enqueue."""
+    try:
+        items = _parse_batch_body()
+    except ValueError as e:
+        return jsonify({'error': 'invalid_request', 'detail': str(e)}), 400
+
+    if not items:
+        return jsonify({'error': 'invalid_request', 'detail': 'No samples in request body'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({
+            'error': 'invalid_request',
+            'detail': f'At most {MAX_BATCH_SIZE} samples per batch'
+        }), 413
+
+    # The whole batch is admitted or refused; it only counts as urgent if every sample is.
+    lab_counts = {}
+    for item in items:
+        if isinstance(item, dict) and item.get('lab_id') in lab_registry:
+            lab_counts[item['lab_id']] = lab_counts.get(item['lab_id'], 0) + 1
+    if lab_counts:
+        decision = admission.admit(lab_counts, all(isinstance(item, dict) and item.get('urgent') is True
+                                                   for item in items))
+        if not decision.admitted:
+            return _not_admitted(decision)
+
+    now = datetime.utcnow()
+    results = []
+    accepted = []
+    for index, item in enumerate(items):
+        error = _validate_sample(item)
+        image_data = None
+        if error is None:
+            try:
+                image_data = base64.b64decode(item['image'], validate=True)
+            except (binascii.Error, ValueError):
+                error = 'invalid_image'
+            else:
+                if not image_data:
+                    error = 'missing_image'
+                elif len(image_data) > MAX_IMAGE_BYTES:
+                    error = 'image_too_large'
+        if error is not None:
+            results.append({"index": index, "error": error})
+            continue
+
+        blob_key, checksum = blob_store.put(image_data)
+        job = Todo(
+            request_id=str(uuid.uuid4()),
+            patient_id=item['patient_id'],
+            lab_id=item['lab_id'],
+            urgent=item.get('urgent', False),
+            result='pending',
+            created_at=now,
+            updated_at=now
+        )
+        accepted.append((job, blob_key, checksum))
+        results.append({
+            "index": index,
+            "id": job.request_id,
+            "created_at": now.replace(microsecond=0).isoformat() + "Z",
+            "updated_at": now.replace(microsecond=0).isoformat() + "Z",
+            "status": "pending"
+        })
+
+    if not accepted:
+        return jsonify({"accepted": 0, "rejected": len(results), "items": results}), 400
+
+    try:
+        with timed("db_insert"):
+            db.session.add_all([job for job, _, _ in accepted])
+            rollup.record_submissions([job for job, _, _ in accepted])
+            lab_model.record_activity([job for job, _, _ in accepted])
+            for job, blob_key, checksum in accepted:
+                outbox.enqueue(
+                    ical.name,
+                    args=(job.patient_id, job.lab_id, None, job.urgent, job.request_id),
+                    kwargs={"blob_key": blob_key, "checksum": checksum},
+                    options=submission_options(job.urgent),
+                )
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception("Failed to insert batch of %d jobs", len(accepted))
+        return jsonify({'error': 'Failed to update the database'}), 500
+    for job, _, _ in accepted:
+        submissions.inc("urgent" if job.urgent else "batch")
+    _wake_relay()
+
+    return jsonify({
+        "accepted": len(accepted),
+        "rejected": len(results) - len(accepted),
+        "items": results
+    }), 201
+
+
 @api.route('/todos/ical/<task_id>/status', methods=['GET'])
 def get_task_status(task_id):
     task_result = AsyncResult(task_id)
@@ -150,7 +465,30 @@ def get_task_result(task_id):
         return jsonify({'error': 'Task not finished'}), 404
 
 
+def encode_cursor(job):
+    """Opaque page token for the row a page ended on."""
+    raw = json.dumps([job.created_at.isoformat(), job.request_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor(); raises ValueError for anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        created_at, request_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(request_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+# Replica lag each read endpoint tolerates before falling back to the primary
+RESULTS_MAX_LAG = float(os.environ.get("RESULTS_MAX_LAG", "5"))
+SUMMARY_MAX_LAG = float(os.environ.get("SUMMARY_MAX_LAG", "30"))
+ANALYSIS_MAX_LAG = float(os.environ.get("ANALYSIS_MAX_LAG", "1"))
+
+
 @api.route('/labs/results/<string:lab_id>', methods=['GET'])
+@read_only(max_lag=RESULTS_MAX_LAG)
 def get_lab_results(lab_id):
     """Retrieve lab analysis results with optional filters."""
     try:
@@ -160,12 +498,18 @@ def get_lab_results(lab_id):
             logger.debug("Missing lab_id in request")
             return jsonify({'error': 'missing_lab_id'}), 400
 
-        if lab_id not in VALID_LABS:
+        if lab_id not in lab_registry:
             logger.debug(f"Invalid lab_id provided: {lab_id}")
             return jsonify({'error': 'invalid_lab_id'}), 404
 
         limit = request.args.get('limit', default=100, type=int)
         offset = request.args.get('offset', default=0, type=int)
+        after = request.args.get('after')
+        include_total = request.args.get('include_total', 'false').lower() in ['true', '1']
+        include_archived = request.args.get('archived', 'false').lower() in ['true', '1']
+        fmt = export_format(request)
+        if fmt is not None and fmt not in EXPORT_FORMATS:
+            return jsonify({'error': 'Invalid format. Must be ndjson or csv'}), 400
         start = request.args.get('start')
         end = request.args.get('end')
         patient_id = request.args.get('patient_id')
@@ -180,6 +524,14 @@ def get_lab_results(lab_id):
         if offset < 0:
             logger.debug(f"Invalid offset value: {offset}")
             return jsonify({'error': 'Offset must be greater than or equal to 0'}), 400
+        if after and offset:
+            return jsonify({'error': 'Use either after or offset, not both'}), 400
+        if after:
+            try:
+                after = decode_cursor(after)
+            except ValueError:
+                logger.debug(f"Invalid cursor: {after}")
+                return jsonify({'error': 'Invalid cursor'}), 400
 
         valid_statuses = {"pending", "covid", "h5n1", "healthy", "failed"}
         if result and result not in valid_statuses:
@@ -230,38 +582,77 @@ def get_lab_results(lab_id):
             query = query.filter(Todo.urgent == urgent)
             logger.debug(f"Filtering results by urgent: {urgent}")
 
-        query = query.order_by(Todo.created_at.asc())
-
-        total_results = query.count()
-        logger.debug(f"Total results found: {total_results}")
-
-        if offset >= total_results:
-            logger.debug("Offset is out of range, returning empty list.")
-            return jsonify([]), 200
-
-        results = query.offset(offset).limit(limit).all()
+        # Jobs older than the archive horizon have left the Todo table
+        archive_filters = None
+        if archive_store.reaches(start, end, include_archived):
+            archive_filters = dict(start=start, end=end, after=after, lab_id=lab_id,
+                                   patient_id=patient_id or None, result=result or None, urgent=urgent)
+
+        if fmt is not None:
+            # Export mode: every matching row, streamed, no page limit
+            if after:
+                query = query.filter(tuple_(Todo.created_at, Todo.request_id) > tuple_(*after))
+            query = query.order_by(Todo.created_at.asc(), Todo.request_id.asc())
+            archived = archive_store.scan(**archive_filters) if archive_filters else None
+            return stream_export(query, fmt, f"{lab_id}-results", archived=archived)
+
+        headers = {}
+        if include_total:
+            # Only on request: a count is a scan of every matching row.
+            total = query.order_by(None).count()
+            if archive_filters:
+                total += archive_store.count(**dict(archive_filters, after=None))
+            headers['X-Total-Count'] = str(total)
+
+        # Keyset pagination: seek past the last row of the previous page
+        # through the (lab_id, created_at) index instead of skipping rows.
+        if after:
+            query = query.filter(tuple_(Todo.created_at, Todo.request_id) > tuple_(*after))
+        query = query.order_by(Todo.created_at.asc(), Todo.request_id.asc()).with_entities(*JOB_COLUMNS)
+        if archive_filters:
+            # The offset applies to the merged stream, so skip rows after merging
+            live = query.limit(offset + limit + 1)
+            results = list(islice(merge_rows(live, archive_store.scan(**archive_filters)),
+                                  offset, offset + limit + 1))
+        else:
+            if offset:
+                query = query.offset(offset)
+            results = query.limit(limit + 1).all()
+        if len(results) > limit:
+            results = results[:limit]
+            cursor = encode_cursor(results[-1])
+            headers['X-Next-Cursor'] = cursor
+            next_args = request.args.to_dict()
+            next_args.pop('offset', None)
+            next_args['after'] = cursor
+            headers['Link'] = f'<{request.base_url}?{urlencode(next_args)}>; rel="next"'
         logger.debug(f"Returning {len(results)} results.")
 
-        response = [
-            {
-                "request_id": result.request_id,
-                "lab_id": result.lab_id,
-                "patient_id": result.patient_id,
-                "result": result.result,
-                "urgent": result.urgent,
-                "created_at": result.created_at.isoformat() + "Z",
-                "updated_at": result.updated_at.isoformat() + "Z"
-            }
-            for result in results
-        ]
-        logger.debug("Response successfully generated.")
-        return jsonify(response), 200
+        def build():
+            return [
+                {
+                    "request_id": request_id,
+                    "lab_id": row_lab_id,
+                    "patient_id": row_patient_id,
+                    "result": row_result,
+                    "urgent": row_urgent,
+                    "created_at": created_at.isoformat() + "Z",
+                    "updated_at": updated_at.isoformat() + "Z"
+                }
+                for request_id, row_lab_id, row_patient_id, row_result, row_urgent, created_at, updated_at
+                in results
+            ]
+
+        # No Last-Modified: a row leaving the list does not raise its newest
+        # updated_at, so only the content ETag can tell the page changed
+        return conditional_json(build, job_etag(results), headers=headers)
 
     except Exception as e:
         logger.debug(f"Unexpected error: {str(e)}", exc_info=True)
         return jsonify({'error': 'An unknown error occurred trying to process the request'}), 500
 
 @api.route('/patients/results', methods=['GET'])
+@read_only(max_lag=RESULTS_MAX_LAG)
 def get_patient_results():
     """List all analysis jobs associated with a patient with optional filters."""
     
@@ -270,6 +661,8 @@ def get_patient_results():
     end = request.args.get('end')
     status = request.args.get('status')
     urgent = request.args.get('urgent', type=bool)
+    include_archived = request.args.get('archived', 'false').lower() in ['true', '1']
+    fmt = export_format(request)
 
   
     if not patient_id or not patient_id.isdigit() or len(patient_id) != 11:
@@ -280,6 +673,8 @@ def get_patient_results():
     if status and status not in valid_statuses:
         return jsonify({'error': 'Invalid status'}), 400
 
+    if fmt is not None and fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'Invalid format. Must be ndjson or csv'}), 400
    
     try:
         if start:
@@ -301,80 +696,120 @@ def get_patient_results():
     if urgent is not None:
         query = query.filter(Todo.urgent == urgent)
 
+    archived = None
+    if archive_store.reaches(start, end, include_archived):
+        archived = archive_store.scan(start=start, end=end, patient_id=patient_id,
+                                      result=status or None, urgent=urgent)
+
+    if fmt is not None:
+        query = query.order_by(Todo.created_at.asc(), Todo.request_id.asc())
+        return stream_export(query, fmt, f"{patient_id}-results", archived=archived)
 
-    results = query.all()
+    results = (query.with_entities(*JOB_COLUMNS)
+               .order_by(Todo.created_at.asc(), Todo.request_id.asc())
+               .all())
+    if archived is not None:
+        results = list(merge_rows(results, archived))
 
+    def build():
+        return [
+            {
+                "lab_id": row_lab_id,
+                "request_id": request_id,
+                "patient_id": row_patient_id,
+                "result": row_result,
+                "urgent": row_urgent,
+                "created_at": stamp(created_at),
+                "updated_at": stamp(updated_at),
+            }
+            for request_id, row_lab_id, row_patient_id, row_result, row_urgent, created_at, updated_at
+            in results
+        ]
 
-    return jsonify([result.to_dict() for result in results])
+    # Validated by the content ETag alone, as for lab results
+    return conditional_json(build, job_etag(results))
+
+
+LABS_RESPONSE_TTL = float(os.environ.get("LABS_RESPONSE_TTL", "30"))
+# detail flag -> (registry version, built at, response body)
+_labs_response_cache = {}
+_labs_synced_version = None
+
+
+def invalidate_labs_cache():
+    _labs_response_cache.clear()
+
+
+def _sync_labs():
+    """Mirror the lab registry into the Lab table once per registry version."""
+    global _labs_synced_version
+    version = lab_registry.version
+    if version == _labs_synced_version:
+        return
+    lab_model.sync_from_registry(lab_registry.labs())
+    _labs_synced_version = version
+    invalidate_labs_cache()
 
 
 @api.route('/labs', methods=['GET'])
 def get_labs():
     """Retrieve the list of labs with permission to use this service."""
-    
-    labs = db.session.query(Todo.lab_id).distinct().all()
-    
-
-    lab_ids = [lab[0] for lab in labs]
-    
-    return jsonify(lab_ids)
+    detail = request.args.get('detail', 'false').lower() in ['true', '1']
+
+    _sync_labs()
+    cached = _labs_response_cache.get(detail)
+    # The id list only changes with the registry; activity counts go stale.
+    if cached and cached[0] == lab_registry.version and (
+            not detail or time.monotonic() - cached[1] < LABS_RESPONSE_TTL):
+        body = cached[2]
+    else:
+        labs = Lab.query.filter_by(active=True).order_by(Lab.lab_id).all()
+        if detail:
+            body = json.dumps([lab.to_dict() for lab in labs])
+        else:
+            body = json.dumps([lab.lab_id for lab in labs])
+        _labs_response_cache[detail] = (lab_registry.version, time.monotonic(), body)
 
+    return current_app.response_class(body, mimetype='application/json')
 
 
-from datetime import datetime
 
 @api.route('/labs/results/<string:lab_id>/summary', methods=['GET'])
+@read_only(max_lag=SUMMARY_MAX_LAG)
 def get_lab_summary(lab_id):
     """Retrieve a summary of analysis jobs associated with the given lab ID."""
     
-    if lab_id not in VALID_LABS:
+    if lab_id not in lab_registry:
         return jsonify({'error': 'Lab ID not found in the list of valid lab IDs'}), 404
-    
-   
-    lab_exists = Todo.query.filter_by(lab_id=lab_id).first()
-    print(f"DEBUG: Checking if lab_id {lab_id} exists in Todo: {lab_exists}")
-
-    if not lab_exists:
-        print(f"DEBUG: Lab ID {lab_id} does not exist in the database.")
-        return jsonify({'error': 'Lab ID not found'}), 404
 
     start = request.args.get('start')
     end = request.args.get('end')
 
-
-    print(f"DEBUG: Received lab_id={lab_id}, start={start}, end={end}")
-
-
     try:
         if start:
-            start = parser.isoparse(start)
+            start = _to_naive_utc(datetime.fromisoformat(start.replace("Z", "+00:00")))
         if end:
-            end = parser.isoparse(end)
+            end = _to_naive_utc(datetime.fromisoformat(end.replace("Z", "+00:00")))
     except ValueError:
         return jsonify({'error': 'Invalid date format. Must be in RFC3339 format'}), 400
 
     try:
- 
-        query = db.session.query(Todo).filter_by(lab_id=lab_id)
+        # Served from the LabRollup counters rather than counting Todo rows
+        counts = rollup.summarise(lab_id, start or None, end or None)
 
-        if start:
-            query = query.filter(Todo.created_at >= start)
-        if end:
-            query = query.filter(Todo.created_at <= end)
-
-      
-        if query.count() == 0:
+        if sum(counts[status] for status in rollup.VALID_RESULTS) == 0:
+            if not rollup.lab_has_rollups(lab_id):
+                return jsonify({'error': 'Lab ID not found'}), 404
             return jsonify({'error': 'Analysis request identifier does not correspond to any submitted analysis requests.'}), 404
 
-   
         summary = {
             "lab_id": lab_id,
-            "pending": query.filter(Todo.result == "pending").count(),
-            "covid": query.filter(Todo.result == "covid").count(),
-            "h5n1": query.filter(Todo.result == "h5n1").count(),
-            "healthy": query.filter(Todo.result == "healthy").count(),
-            "failed": query.filter(Todo.result == "failed").count(),
-            "urgent": query.filter(Todo.result == True).count(),
+            "pending": counts["pending"],
+            "covid": counts["covid"],
+            "h5n1": counts["h5n1"],
+            "healthy": counts["healthy"],
+            "failed": counts["failed"],
+            "urgent": counts["urgent"],
             "generated_at": datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
         }
 
@@ -384,7 +819,130 @@ def get_lab_summary(lab_id):
    
         return jsonify({'error': f'An unknown error occurred: {str(e)}'}), 500
 
+
+def _to_naive_utc(timestamp):
+    """Stored timestamps are naive UTC; convert offset-aware query values to match."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+EVENTS_MAX_WAIT = float(os.environ.get("EVENTS_MAX_WAIT", "30"))
+SSE_MAX_DURATION = float(os.environ.get("SSE_MAX_DURATION", "300"))
+SSE_HEARTBEAT = 15
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _event_stream(subscription, initial=(), stop_when_done=False, refresh=None):
+    """SSE body: initial events, then bus messages and heartbeats until the deadline.
+
+    Between messages no DB connection is held. When refresh is given it is
+    called on each heartbeat instead, so a verdict the bus never delivered
+    (in-process bus, another API process) still reaches the client.
+    """
+    deadline = time.monotonic() + SSE_MAX_DURATION
+    try:
+        yield "retry: 3000\n\n"
+        for message in initial:
+            yield _sse("result", message)
+            if stop_when_done and message["result"] != "pending":
+                return
+        while time.monotonic() < deadline:
+            message = subscription.get(timeout=min(SSE_HEARTBEAT, deadline - time.monotonic()))
+            if message is None and refresh is not None:
+                message = refresh()
+                if message is not None and message["result"] == "pending":
+                    message = None
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield _sse("result", message)
+            if stop_when_done and message["result"] != "pending":
+                return
+    finally:
+        subscription.close()
+
+
+def _reload_job(request_id):
+    """Re-read a job for a waiter whose event may not have arrived; releases the connection."""
+    try:
+        job = db.session.get(Todo, request_id, populate_existing=True)
+        return job.to_dict() if job is not None else None
+    finally:
+        db.session.close()
+
+
+def _load_job_for_events():
+    """Validate ?request_id= and return (job, error_response)."""
+    request_id = request.args.get('request_id')
+    if not request_id:
+        return None, (jsonify({'error': 'Missing request_id'}), 400)
+    try:
+        uuid.UUID(request_id)
+    except ValueError:
+        return None, (jsonify({'error': 'Invalid request_id format. It must be a valid UUIDv4.'}), 404)
+    job = db.session.get(Todo, request_id)
+    if job is None:
+        return None, (jsonify({'error': 'Analysis not found'}), 404)
+    return job, None
+
+
+@api.route('/analysis/wait', methods=['GET'])
+def wait_for_analysis():
+    """Long-poll: answer as soon as the job leaves pending, or at the timeout."""
+    timeout = min(request.args.get('timeout', default=EVENTS_MAX_WAIT, type=float), EVENTS_MAX_WAIT)
+    request_id = request.args.get('request_id', '')
+    # Subscribe before reading the row so a result written in between is not missed
+    with event_bus.subscribe(job_channel(request_id)) as subscription:
+        job, error = _load_job_for_events()
+        if error is not None:
+            return error
+        current = job.to_dict()
+        # Hand the DB connection back to the pool while we wait
+        db.session.close()
+        if current['result'] == 'pending' and timeout > 0:
+            # No event when the bus does not reach this process: read the row again
+            current = subscription.get(timeout=timeout) or _reload_job(request_id) or current
+    return jsonify(current), 200
+
+
+@api.route('/analysis/events', methods=['GET'])
+def stream_analysis_events():
+    """Server-sent events for one job; the stream ends once it has a result."""
+    request_id = request.args.get('request_id', '')
+    subscription = event_bus.subscribe(job_channel(request_id))
+    job, error = _load_job_for_events()
+    if error is not None:
+        subscription.close()
+        return error
+    current = job.to_dict()
+    db.session.close()
+    return current_app.response_class(
+        stream_with_context(_event_stream(subscription, [current], stop_when_done=True,
+                                          refresh=lambda: _reload_job(request_id))),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@api.route('/labs/<string:lab_id>/events', methods=['GET'])
+def stream_lab_events(lab_id):
+    """Server-sent events for every job update in a lab."""
+    if lab_id not in lab_registry:
+        return jsonify({'error': 'invalid_lab_id'}), 404
+    subscription = event_bus.subscribe(lab_channel(lab_id))
+    return current_app.response_class(
+        _event_stream(subscription),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
 @api.route('/analysis', methods=['GET'])
+@read_only(max_lag=ANALYSIS_MAX_LAG)
 def get_analysis_by_request_id():
     """Retrieve an analysis job by its request ID."""
     
@@ -401,46 +959,35 @@ def get_analysis_by_request_id():
         return jsonify({'error': 'Invalid request_id format. It must be a valid UUIDv4.'}), 404
 
 
-    analysis = Todo.query.filter_by(request_id=request_id).first()
+    def load():
+        analysis = Todo.query.filter_by(request_id=request_id).first()
+        if analysis is None and on_replica():
+            # A job submitted a moment ago may not have replicated yet
+            with primary():
+                analysis = Todo.query.filter_by(request_id=request_id).first()
+        return analysis
 
-    
-  
-    if analysis:
-     return jsonify({
+    analysis = job_cache.lookup(request_id, load)
+
+    # Accepted jobs are committed before the response, so there is nothing
+    # left to find in the Celery result backend.
+    if analysis is None:
+        return jsonify({'error': 'Analysis not found'}), 404
+
+    def build():
+        return {
             "request_id": analysis.request_id,
             "lab_id": analysis.lab_id,
             "patient_id": analysis.patient_id,
             "result": analysis.result,
             "urgent": analysis.urgent,
-            "created_at": analysis.created_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "updated_at": analysis.updated_at.strftime('%Y-%m-%dT%H:%M:%SZ')
-        }), 200
+            "created_at": stamp(analysis.created_at),
+            "updated_at": stamp(analysis.updated_at)
+        }
 
-    task_result = AsyncResult(request_id)
-    if task_result.state == 'PENDING':
-        # Return the same format as above, with result = "pending"
-        # You can mock values or infer them if needed
-        return jsonify({
-            "request_id": request_id,
-            "lab_id": None,
-            "patient_id": None,
-            "result": "pending",
-            "urgent": None,
-            "created_at": None,
-            "updated_at": None
-        }), 200
-    elif task_result.state == 'SUCCESS':
-    # Return the same format as the DB response but with 'pending' placeholder values
-     return jsonify({
-        "request_id": request_id,
-        "lab_id": None,
-        "patient_id": None,
-        "result": "pending",
-        "urgent": None,
-        "created_at": None,
-        "updated_at": None
-    }), 200
-    return jsonify({'error': 'Analysis not found'}), 404
+    finished = analysis.result != 'pending'
+    return conditional_json(build, job_etag([analysis]), analysis.updated_at,
+                            cache_control=FINISHED_CACHE_CONTROL if finished else REVALIDATE_CACHE_CONTROL)
 
 @api.route('/analysis', methods=['PUT'])
 def update_lab_for_analysis():
@@ -457,10 +1004,16 @@ def update_lab_for_analysis():
     except ValueError:
         return jsonify({'error': 'Invalid request_id format'}), 404  
 
-    todo_item = Todo.query.filter_by(request_id=request_id).first()
+    # A cached job exists, so only an uncached one needs the row for the 404
+    cached = job_cache.get(request_id)
+    todo_item = None
+    if cached is None:
+        # Locked until commit: a verdict landing meanwhile would make the
+        # rollup move a count for a result the job no longer has
+        todo_item = Todo.query.filter_by(request_id=request_id).with_for_update().first()
     
-    if not todo_item:
-        return jsonify({'error': 'Analysis job not found'}), 404  
+        if not todo_item:
+            return jsonify({'error': 'Analysis job not found'}), 404  
 
 
    
@@ -468,10 +1021,26 @@ def update_lab_for_analysis():
         return jsonify({'error': 'Missing lab_id parameter'}), 400  
 
    
-    if lab_id not in VALID_LABS:
+    if lab_id not in lab_registry:
         return jsonify({'error': 'Invalid lab identifier'}), 400  
 
-    
+    # A reassignment to the lab the job is already on changes nothing. Only
+    # a finished entry is trusted: its verdict can no longer change, while a
+    # pending one may be older than a verdict just written.
+    if cached is not None and cached.result != 'pending' and cached.lab_id == lab_id:
+        return jsonify({
+            "request_id": cached.request_id,
+            "lab_id": cached.lab_id,
+            "patient_id": cached.patient_id,
+            "result": cached.result,
+            "urgent": cached.urgent,
+        }), 200
+
+    if todo_item is None:
+        todo_item = Todo.query.filter_by(request_id=request_id).with_for_update().first()
+        if not todo_item:
+            return jsonify({'error': 'Analysis job not found'}), 404
+
     if todo_item.lab_id == lab_id:
         return jsonify({
             "request_id": todo_item.request_id,
@@ -485,12 +1054,19 @@ def update_lab_for_analysis():
 
 
     try:
+        old_lab_id = todo_item.lab_id
         todo_item.lab_id = lab_id
         todo_item.updated_at = datetime.utcnow() 
+        rollup.record_reassignment(todo_item, old_lab_id)
+        lab_model.record_reassignment(todo_item, old_lab_id)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Failed to update the database'}), 500
+    # The commit expired the row, so this re-reads the committed state
+    # rather than caching what was read before the lock was taken
+    job_cache.put(todo_item)
+    publish_job(todo_item)
 
     return jsonify({
         "request_id": todo_item.request_id,
@@ -502,4 +1078,143 @@ def update_lab_for_analysis():
             "updated_at": todo_item.updated_at.strftime('%Y-%m-%dT%H:%M:%SZ')
 
    
-    }), 200  
\ No newline at end of file
+    }), 200  
+
+@api.route('/analysis/reassign', methods=['POST'])
+def reassign_analyses():
+    """Move many jobs to another lab: a list of request_ids, or every job on a lab matching filters.
+
+    {"lab_id": "...", "request_ids": [...]}
+    {"lab_id": "...", "from_lab_id": "...", "status": "pending", "start": "...", "end": "...", "urgent": true}
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': 'invalid_request', 'detail': 'Request body must be a JSON object'}), 400
+    extra_keys = set(body) - {'lab_id', 'request_ids', 'from_lab_id', 'status', 'start', 'end', 'urgent'}
+    if extra_keys:
+        return jsonify({'error': 'invalid_request', 'detail': f'Unknown fields: {", ".join(sorted(extra_keys))}'}), 400
+
+    lab_id = body.get('lab_id')
+    if not lab_id:
+        return jsonify({'error': 'Missing lab_id parameter'}), 400
+    if lab_id not in lab_registry:
+        return jsonify({'error': 'Invalid lab identifier'}), 400
+
+    request_ids = body.get('request_ids')
+    from_lab_id = body.get('from_lab_id')
+    if (request_ids is None) == (from_lab_id is None):
+        return jsonify({'error': 'invalid_request', 'detail': 'Give either request_ids or from_lab_id'}), 400
+
+    if request_ids is not None:
+        if set(body) - {'lab_id', 'request_ids'}:
+            return jsonify({'error': 'invalid_request', 'detail': 'Filters apply only with from_lab_id'}), 400
+        if not isinstance(request_ids, list) or not request_ids:
+            return jsonify({'error': 'invalid_request', 'detail': 'request_ids must be a non-empty list'}), 400
+        if len(request_ids) > MAX_REASSIGN_JOBS:
+            return jsonify({'error': 'invalid_request',
+                            'detail': f'At most {MAX_REASSIGN_JOBS} request_ids per call'}), 413
+        try:
+            request_ids = [str(uuid.UUID(request_id)) for request_id in request_ids]
+        except (TypeError, ValueError, AttributeError):
+            return jsonify({'error': 'Invalid request_id format'}), 400
+        try:
+            counts = reassign_ids(request_ids, lab_id)
+        except Exception:
+            logger.exception(f"Bulk reassignment to {lab_id} failed")
+            return jsonify({'error': 'Failed to update the database'}), 500
+        return jsonify(dict(counts, lab_id=lab_id, matched=counts["reassigned"] + counts["unchanged"])), 200
+
+    status = body.get('status')
+    urgent = body.get('urgent')
+    if not isinstance(from_lab_id, str) or not from_lab_id:
+        return jsonify({'error': 'invalid_request', 'detail': 'from_lab_id must be a lab identifier'}), 400
+    if from_lab_id == lab_id:
+        return jsonify({'error': 'invalid_request', 'detail': 'from_lab_id and lab_id are the same lab'}), 400
+    if status is not None and status not in rollup.VALID_RESULTS:
+        return jsonify({'error': 'Invalid status'}), 400
+    if urgent is not None and not isinstance(urgent, bool):
+        return jsonify({'error': 'Invalid urgent flag. Must be true or false'}), 400
+    try:
+        start = _to_naive_utc(datetime.fromisoformat(body['start'].replace("Z", "+00:00"))) if body.get('start') else None
+        end = _to_naive_utc(datetime.fromisoformat(body['end'].replace("Z", "+00:00"))) if body.get('end') else None
+    except (AttributeError, ValueError):
+        return jsonify({'error': 'Invalid date format. Must be in RFC3339 format'}), 400
+    if start and end and start > end:
+        return jsonify({'error': 'Start date must be before end date'}), 400
+
+    try:
+        counts = reassign_matching(lab_id, from_lab_id, status=status, start=start, end=end, urgent=urgent)
+    except Exception:
+        logger.exception(f"Bulk reassignment from {from_lab_id} to {lab_id} failed")
+        return jsonify({'error': 'Failed to update the database'}), 500
+    return jsonify(dict(counts, lab_id=lab_id, from_lab_id=from_lab_id, matched=counts["reassigned"])), 200
+
+
+@api.cli.command("sweep-staging")
+def sweep_staging():
+    """Delete staged image blobs older than STAGING_TTL."""
+    removed = blob_store.sweep()
+    print(f"Removed {removed} staged blobs from {blob_store.root}")
+
+
+@api.cli.command("migrate")
+def migrate():
+    """Apply pending schema migrations to the configured database."""
+    applied = apply_migrations(db.engine)
+    print(f"Applied {len(applied)} migration(s): {', '.join(applied) or 'none pending'}")
+
+
+@api.cli.command("rebuild-rollups")
+def rebuild_rollups():
+    """Recompute the LabRollup counters from the Todo table.
+
+    Buckets before the archive horizon are left alone: their jobs are no
+    longer in Todo to be counted.
+    """
+    rows = rollup.rebuild(since=archive_store.horizon())
+    print(f"Rebuilt {rows} lab rollup row(s)")
+
+
+@api.cli.command("sync-labs")
+def sync_labs():
+    """Upsert the lab registry into the Lab table and backfill activity from Todo."""
+    lab_model.sync_from_registry(lab_registry.labs())
+    rows = lab_model.backfill_activity()
+    print(f"Synced {len(lab_registry.labs())} registry lab(s), backfilled activity for {rows}")
+
+
+@api.cli.command("archive-results")
+def archive_results_command():
+    """Move finished jobs older than ARCHIVE_RETENTION_DAYS out of Todo into ARCHIVE_DIR."""
+    summary = archive_results()
+    print(f"Archived {summary['archived']} job(s) created before {summary['cutoff']} "
+          f"into {len(summary['files'])} file(s) under {archive_store.root}")
+    if summary['dropped_partitions']:
+        print(f"Dropped partitions: {', '.join(summary['dropped_partitions'])}")
+
+
+@api.cli.command("ensure-partitions")
+def ensure_partitions_command():
+    """Create Todo's monthly partitions through TODO_PARTITION_AHEAD_MONTHS from now."""
+    with db.engine.begin() as conn:
+        names = ensure_partitions(conn)
+    print(f"Checked {len(names)} partition(s)" if names else "Todo is not partitioned")
+
+
+@api.cli.command("relay-outbox")
+def relay_outbox():
+    """Publish outbox rows to the broker until interrupted."""
+    relay_forever(current_app._get_current_object())
+
+
+@api.cli.command("backlog-monitor")
+def backlog_monitor():
+    """Sample queue backlog and publish drain time and desired workers until interrupted."""
+    monitor_forever(current_app._get_current_object())
+
+
+@api.cli.command("purge-submission-keys")
+def purge_submission_keys():
+    """Delete expired Idempotency-Key and duplicate-collapsing entries."""
+    removed = submission_key.purge_expired()
+    print(f"Removed {removed} expired submission key(s)")
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import logging
+from collections import deque, namedtuple
+
+from celery.signals import task_prerun  # type: ignore
+from todo.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+JobClass = namedtuple("JobClass", "name queue deadline weight")
+
+JOB_CLASSES = {
+    "urgent": JobClass(
+        "urgent",
+        os.environ.get("URGENT_QUEUE", "urgentqueue"),
+        float(os.environ.get("URGENT_DEADLINE_SECONDS", "60")),
+        float(os.environ.get("URGENT_WEIGHT", "4")),
+    ),
+    "batch": JobClass(
+        "batch",
+        os.environ.get("CELERY_DEFAULT_QUEUE", "celerytaskqueue"),
+        float(os.environ.get("BATCH_DEADLINE_SECONDS", "3600")),
+        float(os.environ.get("BATCH_WEIGHT", "1")),
+    ),
+}
+
+queue_wait = Histogram(
+    "coughoverflow_queue_wait_seconds",
+    "Time from enqueue to a worker starting the task, by job class.",
+    labels=("job_class",),
+)
+
+
+def job_class(urgent):
+    return JOB_CLASSES["urgent" if urgent else "batch"]
+
+
+def submission_options(urgent, now=None):
+    """apply_async()/Signature.set() options routing a job to its class queue.
+
+    The enqueue time and deadline travel as message headers so the worker
+    can measure queue wait and see how much slack a job has left.
+    """
+    cls = job_class(urgent)
+    now = time.time() if now is None else now
+    return {
+        "queue": cls.queue,
+        "headers": {
+            "job_class": cls.name,
+            "enqueued_at": now,
+            "deadline": now + cls.deadline,
+        },
+    }
+
+
+def _header(request, name):
+    value = getattr(request, name, None)
+    if value is None:
+        value = (getattr(request, "headers", None) or {}).get(name)
+    return value
+
+
+@task_prerun.connect
+def _record_queue_wait(task=None, **kwargs):
+    request = getattr(task, "request", None)
+    enqueued_at = _header(request, "enqueued_at")
+    if enqueued_at is None:
+        return
+    now = time.time()
+    queue_wait.observe(max(now - float(enqueued_at), 0.0), _header(request, "job_class") or "unknown")
+    deadline = _header(request, "deadline")
+    if deadline is not None and now > float(deadline):
+        logger.warning(f"Task {request.id} started {now - float(deadline):.1f}s past its deadline")
+
+
+class WeightedFairScheduler:
+    """Chooses which waiting job a free worker slot runs next.
+
+    - Reserved slots only ever run urgent work, so urgent capacity exists
+      however deep the batch backlog is.
+    - Shared slots split service between classes in proportion to their
+      weights (stride scheduling on service time received). A job whose
+      deadline is about to pass jumps the weighting.
+    - Within a class, jobs run earliest-deadline-first.
+
+    This is the policy the worker topology in start-celery.sh approximates
+    (a reserved urgent pool, plus shared workers that prefer the urgent
+    queue and prefetch one message at a time). simulate() uses it directly.
+    """
+
+    def __init__(self, classes=JOB_CLASSES, slack=None):
+        self.classes = classes
+        self.slack = slack if slack is not None else {name: cls.deadline * 0.25 for name, cls in classes.items()}
+        self._queues = {name: [] for name in classes}
+        self._served = {name: 0.0 for name in classes}
+        self._seq = 0
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def push(self, job):
+        self._seq += 1
+        heapq.heappush(self._queues[job["class"]], (job["deadline"], self._seq, job))
+
+    def pop(self, now, reserved=False):
+        candidates = ["urgent"] if reserved else [name for name in self.classes]
+        waiting = [name for name in candidates if self._queues[name]]
+        if not waiting:
+            return None
+        at_risk = [name for name in waiting if self._queues[name][0][0] - now <= self.slack[name]]
+        if at_risk:
+            name = min(at_risk, key=lambda n: self._queues[n][0][0])
+        else:
+            name = min(waiting, key=lambda n: self._served[n] / self.classes[n].weight)
+        job = heapq.heappop(self._queues[name])[2]
+        self._served[name] += job["service"]
+        return job
+
+
+class FifoScheduler:
+    """Today's behaviour: one shared FIFO across both queues, no reservation."""
+
+    def __init__(self):
+        self._queue = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def push(self, job):
+        self._queue.append(job)
+
+    def pop(self, now, reserved=False):
+        return self._queue.popleft() if self._queue else None
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def simulate(policy="weighted", workers=4, reserved=1, prefetch=1, duration=3600.0,
+             urgent_rate=0.05, batch_rate=2.0, service_mean=2.0, seed=6400):
+    """Discrete-event run of one worker fleet; returns wait percentiles per class.
+
+    Defaults push batch arrivals well past fleet capacity (2 jobs/s against
+    4 workers at ~2 s each) with a light urgent stream, i.e. the surge case.
+    With policy="fifo" every slot is shared and each worker prefetches
+    `prefetch` messages, as a single worker on both queues does today.
+    """
+    rng = random.Random(seed)
+    arrivals = []
+    for name, rate in (("urgent", urgent_rate), ("batch", batch_rate)):
+        t = 0.0
+        while rate > 0:
+            t += rng.expovariate(rate)
+            if t >= duration:
+                break
+            arrivals.append((t, name, rng.expovariate(1.0 / service_mean)))
+    arrivals.sort()
+
+    if policy == "weighted":
+        scheduler = WeightedFairScheduler()
+        slots = [True] * reserved + [False] * (workers - reserved)
+    else:
+        scheduler = FifoScheduler()
+        slots = [False] * workers
+    buffers = [deque() for _ in slots]
+    free_at = [0.0] * len(slots)
+    waits = {name: [] for name in JOB_CLASSES}
+    completed = {name: 0 for name in JOB_CLASSES}
+    events = []
+    index = 0
+
+    def dispatch(now):
+        for slot, is_reserved in enumerate(slots):
+            if free_at[slot] > now:
+                continue
+            while policy == "fifo" and len(buffers[slot]) < prefetch:
+                job = scheduler.pop(now)
+                if job is None:
+                    break
+                buffers[slot].append(job)
+            job = buffers[slot].popleft() if buffers[slot] else scheduler.pop(now, reserved=is_reserved)
+            if job is None:
+                continue
+            waits[job["class"]].append(now - job["arrival"])
+            free_at[slot] = now + job["service"]
+            heapq.heappush(events, (free_at[slot], slot, job["class"]))
+
+    while index < len(arrivals) or events:
+        next_arrival = arrivals[index][0] if index < len(arrivals) else float("inf")
+        if events and events[0][0] <= next_arrival:
+            now, _, name = heapq.heappop(events)
+            completed[name] += 1
+        else:
+            now, name, service = arrivals[index]
+            index += 1
+            scheduler.push({
+                "class": name, "arrival": now, "service": service,
+                "deadline": now + JOB_CLASSES[name].deadline,
+            })
+        if now > duration:
+            break
+        dispatch(now)
+
+    result = {"policy": policy, "workers": workers, "duration": duration}
+    for name in JOB_CLASSES:
+        result[name] = {
+            "completed": completed[name],
+            "p50_wait": _percentile(waits[name], 0.50),
+            "p99_wait": _percentile(waits[name], 0.99),
+            "deadline_misses": sum(1 for w in waits[name] if w > JOB_CLASSES[name].deadline),
+        }
+    return result
+
+
+if __name__ == "__main__":
+    runs = [simulate("fifo", reserved=0, prefetch=4), simulate("weighted")]
+    json.dump(runs, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,68 @@
+import os
+import json
+import hashlib
+from datetime import timezone
+
+from flask import current_app, request # type: ignore
+from todo.export import EXPORT_COLUMNS
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+# Columns read for job listings: plain row tuples, no ORM instances.
+JOB_COLUMNS = EXPORT_COLUMNS
+# A job's result only changes again on lab reassignment, so finished jobs can
+# be cached by the client; pending ones must always revalidate.
+FINISHED_MAX_AGE = int(os.environ.get("FINISHED_MAX_AGE", "86400"))
+FINISHED_CACHE_CONTROL = f"private, max-age={FINISHED_MAX_AGE}"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+
+def dumps(value):
+    """JSON-encode to bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def stamp(value):
+    return value.replace(microsecond=0).isoformat() + "Z"
+
+
+def job_etag(rows):
+    """Weak validator over the (request_id, result, lab_id, updated_at) of each row."""
+    digest = hashlib.blake2b(digest_size=16)
+    for row in rows:
+        digest.update(f"{row.request_id}|{row.result}|{row.lab_id}|{row.updated_at.isoformat()}\n".encode())
+    return digest.hexdigest()
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+    return False
+
+
+def conditional_json(build, etag, last_modified=None, cache_control=REVALIDATE_CACHE_CONTROL,
+                     status=200, headers=None):
+    """A JSON response honouring If-None-Match / If-Modified-Since.
+
+    `build` is only called when the client's copy is stale, so a revalidating
+    poller costs the lookup that produced `etag` and nothing else. Pass
+    last_modified for single jobs only: a list's newest updated_at does not
+    change when a row drops out of it.
+    """
+    response = current_app.response_class(status=status, headers=headers, mimetype="application/json")
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    response.headers["Cache-Control"] = cache_control
+    if _not_modified(etag, last_modified):
+        response.status_code = 304
+        return response
+    response.set_data(dumps(build()))
+    return response
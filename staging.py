@@ -0,0 +1,169 @@
+import os
+import json
+import mmap
+import time
+import uuid
+import hashlib
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Local stand-in for an S3 bucket: the API and the workers must see the same
+# directory (a shared volume in docker-compose, EFS in staging.tf).
+STAGING_DIR = os.environ.get("STAGING_DIR", "/tmp/staging")
+# Blobs older than this are orphans (failed submits, lost tasks) and are swept.
+STAGING_TTL = int(os.environ.get("STAGING_TTL", str(24 * 3600)))
+STAGING_SWEEP_INTERVAL = int(os.environ.get("STAGING_SWEEP_INTERVAL", "600"))
+STAGING_CHUNK_SIZE = 64 * 1024
+# Samples the worker gave up on, kept for inspection; never swept.
+DEAD_LETTER_DIR = "dead-letter"
+
+
+def iter_chunks(stream, chunk_size=STAGING_CHUNK_SIZE):
+    """Read a file-like object as an iterator of chunks for put_stream()."""
+    return iter(lambda: stream.read(chunk_size), b"")
+
+
+class StagingError(Exception):
+    """Raised when a staged blob is missing or fails its checksum."""
+
+
+class BlobTooLarge(StagingError):
+    """Raised while streaming once an upload passes its size limit."""
+
+
+class BlobStore:
+    """Write-once image blobs addressed by a random key.
+
+    Broker messages carry only the key and the SHA-256 of the bytes. Writers
+    publish a blob with an atomic rename, and readers map the file instead of
+    copying it into Python.
+    """
+
+    def __init__(self, root=STAGING_DIR, ttl=STAGING_TTL, sweep_interval=STAGING_SWEEP_INTERVAL):
+        self.root = root
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+        self._sweeping = threading.Lock()
+
+    def path(self, key):
+        # Two-character shards keep directory listings small.
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, data):
+        """Store bytes and return (key, sha256 hex digest)."""
+        return self.put_stream([data])
+
+    def put_stream(self, chunks, max_bytes=None):
+        """Store an iterable of byte chunks and return (key, sha256 hex digest).
+
+        Chunks are hashed and written as they arrive, so memory use does not
+        depend on the blob size. BlobTooLarge is raised as soon as the
+        running total passes max_bytes and nothing is kept.
+        """
+        key = uuid.uuid4().hex
+        digest = hashlib.sha256()
+        size = 0
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as blob:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise BlobTooLarge(f"Upload exceeds {max_bytes} bytes")
+                    digest.update(chunk)
+                    blob.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.maybe_sweep()
+        return key, digest.hexdigest()
+
+    @contextmanager
+    def open(self, key, checksum=None):
+        """Yield a read-only memoryview of the blob, verifying checksum if given."""
+        try:
+            blob = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            raise StagingError(f"Staged blob {key} not found")
+        with blob:
+            if os.fstat(blob.fileno()).st_size == 0:
+                view = memoryview(b"")
+                mapped = None
+            else:
+                mapped = mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+            try:
+                if checksum is not None and hashlib.sha256(view).hexdigest() != checksum:
+                    raise StagingError(f"Staged blob {key} failed checksum verification")
+                yield view
+            finally:
+                view.release()
+                if mapped is not None:
+                    mapped.close()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def dead_letter(self, key, reason, **details):
+        """Move a blob out of staging, with a JSON note of why. Returns the new path."""
+        directory = os.path.join(self.root, DEAD_LETTER_DIR)
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, key)
+        try:
+            os.replace(self.path(key), target)
+        except FileNotFoundError:
+            target = None
+        with open(os.path.join(directory, f"{key}.json"), 'w') as note:
+            json.dump(dict(details, key=key, reason=reason, at=time.time()), note)
+        return target
+
+    def maybe_sweep(self):
+        """Run sweep() in the background at most once per sweep_interval."""
+        if time.monotonic() - self._last_sweep < self.sweep_interval:
+            return
+        if not self._sweeping.acquire(blocking=False):
+            return
+        self._last_sweep = time.monotonic()
+
+        def run():
+            try:
+                self.sweep()
+            finally:
+                self._sweeping.release()
+
+        threading.Thread(target=run, name="staging-sweep", daemon=True).start()
+
+    def sweep(self, max_age=None):
+        """Delete blobs older than max_age seconds and return how many went."""
+        max_age = self.ttl if max_age is None else max_age
+        cutoff = time.time() - max_age
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or shard.name == DEAD_LETTER_DIR:
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        if removed:
+            logger.info(f"Swept {removed} expired staged blobs from {self.root}")
+        return removed
+
+
+blob_store = BlobStore()
@@ -0,0 +1,43 @@
+# Shared staging directory for uploaded images (todo/staging.py).
+#
+# The API writes each image to STAGING_DIR and the task message carries only
+# its key, so the API and every worker must mount the same file system.
+
+locals {
+  staging_dir = "/var/lib/coughoverflow/staging"
+}
+
+resource "aws_efs_file_system" "staging" {
+  creation_token = "coughoverflow-staging"
+  encrypted      = true
+
+  tags = {
+    Name = "CoughOverflow_staging"
+  }
+}
+
+resource "aws_security_group" "staging" {
+  name        = "coughoverflow_staging"
+  description = "Allow NFS from the API and worker tasks"
+
+  ingress {
+    from_port       = 2049
+    to_port         = 2049
+    protocol        = "tcp"
+    security_groups = [aws_security_group.todo.id]
+  }
+
+  egress {
+    from_port   = 0
+    to_port     = 0
+    protocol    = "-1"
+    cidr_blocks = ["0.0.0.0/0"]
+  }
+}
+
+resource "aws_efs_mount_target" "staging" {
+  for_each        = toset(data.aws_subnets.private.ids)
+  file_system_id  = aws_efs_file_system.staging.id
+  subnet_id       = each.value
+  security_groups = [aws_security_group.staging.id]
+}
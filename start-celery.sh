@@ -18,5 +18,27 @@ echo "CELERY_LOGLEVEL=$CELERY_LOGLEVEL"  # Show the log level
 : ${CELERY_APP:="todo.tasks.ical"}  # Default if not set in aws.env
 : ${CELERY_LOGLEVEL:="info"}  # Default if not set in aws.env
 
+# Worker classes (see todo/scheduling.py):
+#   urgent - reserved capacity, consumes only urgentqueue
+#   shared - consumes both queues, urgent first, one message prefetched
+if [ -z "$WORKER_CLASS" ]; then
+  if [ "$CELERY_DEFAULT_QUEUE" = "urgentqueue" ]; then WORKER_CLASS=urgent; else WORKER_CLASS=shared; fi
+fi
+
+case "$WORKER_CLASS" in
+  urgent)
+    QUEUES="urgentqueue"
+    PREFETCH=${URGENT_PREFETCH:-1}
+    CONCURRENCY=${URGENT_CONCURRENCY:-2}
+    ;;
+  *)
+    QUEUES="urgentqueue,celerytaskqueue"
+    PREFETCH=${SHARED_PREFETCH:-1}
+    CONCURRENCY=${SHARED_CONCURRENCY:-4}
+    ;;
+esac
+echo "WORKER_CLASS=$WORKER_CLASS QUEUES=$QUEUES PREFETCH=$PREFETCH CONCURRENCY=$CONCURRENCY"
+
 # Now run the Celery worker (this is equivalent to the CMD in the Dockerfile)
-exec poetry run celery --app $CELERY_APP worker --loglevel $CELERY_LOGLEVEL -Q celerytaskqueue,urgentqueue
+exec poetry run celery --app $CELERY_APP worker --loglevel $CELERY_LOGLEVEL -Q $QUEUES \
+  --prefetch-multiplier $PREFETCH --concurrency $CONCURRENCY -O fair
@@ -0,0 +1,72 @@
+import os
+import datetime
+
+from . import db
+from .todo import Todo
+
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", str(24 * 3600)))
+# Identical (patient, image) submissions join the job already in flight
+COLLAPSE_DUPLICATES = os.environ.get("COLLAPSE_DUPLICATE_SUBMISSIONS", "false").lower() in ("1", "true", "yes")
+COLLAPSE_TTL = float(os.environ.get("COLLAPSE_TTL", "3600"))
+
+
+class SubmissionKey(db.Model):
+    """Maps a submission fingerprint to the job it created.
+
+    Two kinds of key share the table: "key:<lab_id>:<Idempotency-Key>" for
+    client retries, and "sha:<patient_id>:<image sha256>" for collapsing
+    identical submissions while the first is still pending.
+    """
+    __tablename__ = 'SubmissionKey'
+
+    key = db.Column(db.String(255), primary_key=True)
+    request_id = db.Column(db.String(36), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<SubmissionKey key={self.key} request_id={self.request_id}>'
+
+
+def idempotency_key(lab_id, header_value):
+    return f"key:{lab_id}:{header_value}"
+
+
+def content_key(patient_id, checksum):
+    return f"sha:{patient_id}:{checksum}"
+
+
+def find_job(key, pending_only=False):
+    """The job recorded under key, if the key is live; stale keys are dropped."""
+    now = datetime.datetime.utcnow()
+    entry = db.session.get(SubmissionKey, key)
+    if entry is None:
+        return None
+    job = db.session.get(Todo, entry.request_id) if entry.expires_at > now else None
+    if job is None or (pending_only and job.result != 'pending'):
+        db.session.delete(entry)
+        db.session.flush()
+        return None
+    return job
+
+
+def remember(job, keys):
+    """Record keys for a new job in the caller's transaction.
+
+    keys is [(key, ttl seconds)]. A concurrent submission claiming the same
+    key makes the commit fail with IntegrityError; the caller then looks the
+    key up again and returns the winner's job.
+    """
+    now = datetime.datetime.utcnow()
+    for key, ttl in keys:
+        db.session.add(SubmissionKey(key=key, request_id=job.request_id, created_at=now,
+                                     expires_at=now + datetime.timedelta(seconds=ttl)))
+
+
+def purge_expired():
+    """Delete expired keys. Commits; returns the number removed."""
+    removed = (db.session.query(SubmissionKey)
+               .filter(SubmissionKey.expires_at <= datetime.datetime.utcnow())
+               .delete(synchronize_session=False))
+    db.session.commit()
+    return removed
@@ -2,42 +2,21 @@ import uuid
 import datetime
 import re
 from . import db
-import requests  # type: ignore
-import csv
-
-
-def get_valid_lab_ids():
-    url = "https://csse6400.uqcloud.net/resources/labs.csv"
-    try:
-        response = requests.get(url)
-        response.raise_for_status() 
-        
-        valid_lab_ids = set()
-        
-       
-        cleaned_text = response.text.lstrip('\ufeff')
-        
-        csv_reader = csv.reader(cleaned_text.splitlines())
-        
-        for row in csv_reader:
-            if row:
-                lab_id = row[0].strip()  # Ensure no leading/trailing spaces
-                valid_lab_ids.add(lab_id)
-        
-        return valid_lab_ids
-    except Exception as e:
-        print(f"Warning: Failed to fetch valid lab IDs: {e}")
-        return set() 
-
-
-VALID_LABS = get_valid_lab_ids()
+from todo.labs import lab_registry
 
 
 VALID_RESULTS = {"pending", "covid", "h5n1", "healthy", "failed"}
 
 class Todo(db.Model):
     __tablename__ = 'Todo'
-    
+    # Keep in step with migrations.py, which adds them to existing databases.
+    # On Postgres the table is partitioned by month of created_at and its key
+    # is (request_id, created_at); see todo.models.partitions.
+    __table_args__ = (
+        db.Index('ix_todo_lab_id_created_at', 'lab_id', 'created_at'),
+        db.Index('ix_todo_patient_id_created_at', 'patient_id', 'created_at'),
+    )
+
     request_id = db.Column(db.String(36), primary_key=True, nullable=False)
     lab_id = db.Column(db.String(50), nullable=False)
     patient_id = db.Column(db.String(11), nullable=False)  
@@ -57,8 +36,8 @@ class Todo(db.Model):
         if not re.match(r'^\d{11}$', self.patient_id):
             raise ValueError("Patient ID must be an 11-digit Medicare number")
 
-        if self.lab_id not in VALID_LABS:
-            raise ValueError(f"Invalid lab_id: {self.lab_id}. Must be one of {VALID_LABS}")
+        if self.lab_id not in lab_registry:
+            raise ValueError(f"Invalid lab_id: {self.lab_id}. Not in the lab registry")
 
 
         if not isinstance(self.urgent, bool):
@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import uuid
+import shlex
+import signal
+import threading
+import subprocess
+import logging
+
+from celery.signals import worker_process_init  # type: ignore
+from todo import metrics
+
+logger = logging.getLogger(__name__)
+
+OVERFLOWENGINE_PATH = os.environ.get("OVERFLOWENGINE_PATH", "/app/overflowengine")
+# Per-run limit for one overflowengine invocation.
+ENGINE_TIMEOUT = float(os.environ.get("ENGINE_TIMEOUT", "60"))
+# Consecutive engine failures before a worker process stops taking work,
+# and how long it pauses before trying again.
+ENGINE_BREAKER_THRESHOLD = int(os.environ.get("ENGINE_BREAKER_THRESHOLD", "5"))
+ENGINE_BREAKER_COOLDOWN = float(os.environ.get("ENGINE_BREAKER_COOLDOWN", "60"))
+# Each pool child serves its own metrics on WORKER_METRICS_PORT + child index.
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", "0"))
+# tmpfs keeps the per-sample input/output files off the container disk.
+ENGINE_SCRATCH_DIR = os.environ.get(
+    "ENGINE_SCRATCH_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp")
+
+
+class EngineError(Exception):
+    """overflowengine did not produce a result."""
+
+
+class EngineTimeout(EngineError):
+    """overflowengine ran past its timeout and was killed."""
+
+
+class EngineCrashed(EngineError):
+    """overflowengine exited non-zero or wrote no output."""
+
+
+class EngineRunner:
+    """Runs overflowengine directly, without an intermediate shell.
+
+    The engine is a one-shot CLI (one --input, one --output, then exit), so
+    there is no long-lived process to keep warm or feed several images to.
+    What we can drop is the /bin/sh fork and the command-line parsing that
+    shell=True paid for on every sample.
+    """
+
+    def __init__(self, binary_path=OVERFLOWENGINE_PATH, scratch_dir=ENGINE_SCRATCH_DIR, timeout=ENGINE_TIMEOUT):
+        self.binary_path = binary_path
+        self.scratch_dir = scratch_dir
+        self.timeout = timeout
+
+    def scratch_path(self, prefix, suffix):
+        return os.path.join(self.scratch_dir, f"{prefix}_{uuid.uuid4()}{suffix}")
+
+    def run(self, image_path):
+        """Analyse the image at image_path and return the engine's output text.
+
+        The engine runs in its own session, so on timeout the whole process
+        group (including anything it forked) is killed, not just the parent.
+        """
+        result_path = self.scratch_path("result", ".txt")
+        try:
+            process = subprocess.Popen(
+                [self.binary_path, "--input", image_path, "--output", result_path],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True,
+            )
+            try:
+                _, stderr = process.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.communicate()
+                raise EngineTimeout(f"overflowengine exceeded {self.timeout:.0f}s on {image_path}")
+            if process.returncode != 0:
+                detail = stderr.decode(errors="replace").strip()[-500:]
+                raise EngineCrashed(f"overflowengine exited {process.returncode}: {detail}")
+            try:
+                with open(result_path, 'r') as result_file:
+                    return result_file.read()
+            except FileNotFoundError:
+                raise EngineCrashed("overflowengine exited 0 without writing a result")
+        finally:
+            if os.path.exists(result_path):
+                os.remove(result_path)
+
+
+class CircuitBreaker:
+    """Stops a worker process taking work while the engine keeps failing.
+
+    After `threshold` consecutive failures the breaker opens: on_open is
+    called (the task pauses consumption of its queue) and, `cooldown`
+    seconds later, on_half_open resumes it so the next task is a trial run.
+    Only one trial runs at a time; other tasks are deferred until it
+    reports. A success closes the breaker; a failure in the trial re-opens
+    it. A trial that ends without touching the engine (a cache hit, an
+    unreadable sample) hands the slot to the next task via end_trial().
+    """
+
+    def __init__(self, threshold=ENGINE_BREAKER_THRESHOLD, cooldown=ENGINE_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a task may run now: True, "trial" for the half-open trial, or False."""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return "trial"
+            return False
+
+    def end_trial(self):
+        """Release the trial slot if the trial finished without reporting."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def remaining(self):
+        if self.state != "open":
+            return 0.0
+        return max(self.cooldown - (time.monotonic() - self.opened_at), 0.0)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = "closed"
+            self._trial_in_flight = False
+
+    def record_failure(self, on_open=None, on_half_open=None):
+        """Count a failure; returns True if this one opened the breaker."""
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "open" or (self.state == "closed" and self.failures < self.threshold):
+                return False
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.trips += 1
+        logger.error(f"Engine circuit open after {self.failures} consecutive failures; "
+                     f"pausing for {self.cooldown:.0f}s")
+        if on_open is not None:
+            on_open()
+        if on_half_open is not None:
+            timer = threading.Timer(self.cooldown, on_half_open)
+            timer.daemon = True
+            timer.start()
+        return True
+
+    def stats(self):
+        return {"state": self.state, "open": self.state == "open", "failures": self.failures,
+                "trips": self.trips, "remaining_seconds": round(self.remaining(), 1)}
+
+
+class WorkerRuntime:
+    """Per-process state shared by every task a worker child runs.
+
+    The Flask app (and with it the SQLAlchemy engine and its connection pool)
+    is built once per process instead of once per task.
+    """
+
+    def __init__(self):
+        self._app = None
+        self._pid = None
+        self.engine = EngineRunner()
+        self.breaker = CircuitBreaker()
+
+    @property
+    def app(self):
+        if self._app is None or self._pid != os.getpid():
+            # Import create_app lazily to avoid circular imports
+            from todo import create_app
+            self._app = create_app()
+            self._pid = os.getpid()
+        return self._app
+
+    def warm(self):
+        """Build the app and open a pooled DB connection ahead of the first task."""
+        from todo.models import db
+        with self.app.app_context():
+            try:
+                with db.engine.connect():
+                    pass
+            except Exception as e:
+                logger.warning(f"Could not pre-connect to the database: {e}")
+
+
+runtime = WorkerRuntime()
+metrics.stats_gauge("coughoverflow_engine_breaker", "Engine circuit breaker state for this worker process.",
+                    runtime.breaker.stats)
+
+
+@worker_process_init.connect
+def _warm_worker_process(**kwargs):
+    runtime.warm()
+    if WORKER_METRICS_PORT:
+        _serve_worker_metrics()
+
+
+def _serve_worker_metrics():
+    from billiard.process import current_process  # type: ignore
+    index = getattr(current_process(), "index", None) or 0
+    try:
+        metrics.serve(WORKER_METRICS_PORT + index)
+    except OSError as e:
+        logger.warning(f"Could not serve worker metrics on {WORKER_METRICS_PORT + index}: {e}")
+
+
+def measure_overhead(image_path, runs=20):
+    """Compare the old per-sample setup with the warm runtime, in seconds per sample."""
+    from todo import create_app
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(runs):
+            fn()
+        return (time.perf_counter() - start) / runs
+
+    def legacy():
+        create_app()
+        result_path = runtime.engine.scratch_path("result", ".txt")
+        command = f"{runtime.engine.binary_path} --input {shlex.quote(image_path)} --output {result_path}"
+        subprocess.run(command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.remove(result_path)
+
+    def warm():
+        runtime.app
+        runtime.engine.run(image_path)
+
+    runtime.warm()
+    return {"runs": runs, "legacy": timed(legacy), "warm": timed(warm)}
+
+
+if __name__ == "__main__":
+    print(measure_overhead(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 20))
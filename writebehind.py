@@ -0,0 +1,201 @@
+import os
+import time
+import atexit
+import threading
+import logging
+from collections import defaultdict
+
+from celery.signals import worker_process_shutdown  # type: ignore
+from sqlalchemy import text # type: ignore
+from todo.metrics import stats_gauge
+from todo.job_cache import job_cache, cached_job
+
+logger = logging.getLogger(__name__)
+
+RESULT_WRITE_BEHIND = os.environ.get("RESULT_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get("WRITE_BEHIND_MAX_BATCH", "200"))
+# Upper bound on how long a verdict can sit in memory, i.e. the loss window
+# if the process dies without running its shutdown flush.
+WRITE_BEHIND_MAX_DELAY = float(os.environ.get("WRITE_BEHIND_MAX_DELAY", "0.5"))
+
+
+class ResultWriteBuffer:
+    """Coalesces worker verdict writes into one bulk UPDATE per flush.
+
+    A flush runs when max_batch results are waiting, when the oldest has
+    waited max_delay seconds, and at process shutdown. Each flush is a
+    single transaction: one SELECT of the affected rows (for the rollup
+    deltas), one UPDATE ... FROM (VALUES ...), the rollup upserts and a
+    commit. Job events are published after the commit.
+    """
+
+    def __init__(self, app_provider, max_batch=WRITE_BEHIND_MAX_BATCH, max_delay=WRITE_BEHIND_MAX_DELAY):
+        self.app_provider = app_provider
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self.flushes = 0
+        self.rows = 0
+        self.failures = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def add(self, request_id, status, updated_at):
+        self._ensure_timer()
+        with self._lock:
+            # Last write wins when a job is updated twice within a window
+            self._pending[request_id] = (status, updated_at)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self.flush()
+
+    def _ensure_timer(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(timeout=self.max_delay / 2)
+            self._wakeup.clear()
+            oldest = self._oldest
+            if oldest is not None and time.monotonic() - oldest >= self.max_delay:
+                self.flush()
+
+    def flush(self):
+        """Write everything buffered so far. Returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._oldest = None
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            try:
+                messages, cached = self._write(batch)
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Write-behind flush of {len(batch)} results failed, will retry: {e}")
+                with self._lock:
+                    for request_id, value in batch.items():
+                        self._pending.setdefault(request_id, value)
+                    self._oldest = self._oldest or time.monotonic()
+                return 0
+            elapsed = time.perf_counter() - started
+            self.flushes += 1
+            self.rows += len(cached)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+        from todo.events import publish_message
+        for job in cached:
+            job_cache.put(job)
+        for message in messages:
+            publish_message(message)
+        return len(cached)
+
+    def _write(self, batch):
+        from todo.models import db
+        from todo.models.todo import Todo
+        from todo.models import rollup
+
+        with self.app_provider().app_context():
+            try:
+                # Only pending jobs take a verdict; a duplicate delivery of a
+                # finished job must not overwrite it. The rows stay locked
+                # until commit so the rollup deltas match what is updated.
+                jobs = (Todo.query
+                        .filter(Todo.request_id.in_(list(batch)), Todo.result == 'pending')
+                        .with_for_update()
+                        .all())
+                if not jobs:
+                    db.session.rollback()
+                    return [], []
+                deltas = defaultdict(lambda: defaultdict(int))
+                for job in jobs:
+                    status, updated_at = batch[job.request_id]
+                    counters = deltas[(job.lab_id, rollup.bucket_for(job.created_at))]
+                    counters['pending'] -= 1
+                    counters[status] += 1
+                rows = [
+                    {"request_id": job.request_id, "result": batch[job.request_id][0],
+                     "updated_at": batch[job.request_id][1]}
+                    for job in jobs
+                ]
+                if db.session.get_bind().dialect.name == "postgresql":
+                    values = ", ".join(
+                        f"(:request_id_{i}, :result_{i}, CAST(:updated_at_{i} AS TIMESTAMP))"
+                        for i in range(len(rows)))
+                    params = {f"{key}_{i}": value for i, row in enumerate(rows) for key, value in row.items()}
+                    db.session.execute(text(
+                        'UPDATE "Todo" AS t SET result = v.result, updated_at = v.updated_at '
+                        f'FROM (VALUES {values}) AS v(request_id, result, updated_at) '
+                        "WHERE t.request_id = v.request_id AND t.result = 'pending'"
+                    ), params)
+                else:
+                    # No VALUES column aliases here; still one transaction
+                    db.session.execute(text(
+                        'UPDATE "Todo" SET result = :result, updated_at = :updated_at '
+                        "WHERE request_id = :request_id AND result = 'pending'"
+                    ), rows)
+                rollup.apply_deltas(deltas)
+                # Build event payloads now; commit expires the loaded rows
+                messages = []
+                cached = []
+                for job in jobs:
+                    status, updated_at = batch[job.request_id]
+                    message = job.to_dict()
+                    message["result"] = status
+                    message["updated_at"] = updated_at.replace(microsecond=0).isoformat() + "Z"
+                    messages.append(message)
+                    cached.append(cached_job(job, result=status, updated_at=updated_at))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            return messages, cached
+
+    def stats(self):
+        return {
+            "enabled": RESULT_WRITE_BEHIND,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "commits": self.flushes,
+            "rows": self.rows,
+            "failures": self.failures,
+            "rows_per_commit": round(self.rows / self.flushes, 2) if self.flushes else 0.0,
+            "last_flush_seconds": round(self.last_flush_seconds, 6),
+            "max_flush_seconds": round(self.max_flush_seconds, 6),
+        }
+
+
+def _worker_app():
+    from todo.worker import runtime
+    return runtime.app
+
+
+result_buffer = ResultWriteBuffer(_worker_app)
+stats_gauge("coughoverflow_write_behind", "Buffered verdict writes and flush timings.", result_buffer.stats)
+
+
+@atexit.register
+def _flush_at_exit():
+    if result_buffer._pending:
+        result_buffer.flush()
+
+
+@worker_process_shutdown.connect
+def _flush_at_worker_shutdown(**kwargs):
+    # Prefork children leave via os._exit, which skips atexit handlers
+    _flush_at_exit()